@@ -0,0 +1,120 @@
+"""
+Admission control for the GUI's renders.
+
+All renders share one worker pool (see sessions.py), so running more of them
+at once does not finish any sooner: their tiles only interleave and every
+user waits longer. render_queue lets at most max_renders run; the others wait
+in priority order (interactive before batch, first come first served within a
+priority) up to max_waiting of them, and beyond that a request is turned away
+with QueueFull, which carries how many seconds to wait before retrying (for
+a Retry-After header), estimated from the recent render times.
+
+Batch renders may only take half of the waiting places, so a queue of large
+renders never keeps out an interactive one. A render cancelled while it waits
+(see incremental.cancel_token: superseded, timed out) leaves the queue at once.
+"""
+
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# priorities, lower goes first
+interactive = 0
+batch = 1
+
+
+class QueueFull(Exception):
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, 'render queue full, retry after %d s' % retry_after)
+        self.retry_after = retry_after
+
+
+class render_queue():
+
+    def __init__(self, max_renders=2, max_waiting=8):
+        self.max_renders = max_renders
+        self.max_waiting = max_waiting
+        self.condition = threading.Condition()
+        self.running = 0
+        # heap of (priority, arrival) of the waiting renders
+        self.waiting = []
+        self.waiting_batch = 0
+        self.arrivals = itertools.count()
+        # moving average of the render times, seconds
+        self.mean_duration = None
+        # requests turned away with QueueFull
+        self.rejected = 0
+        # seconds between two looks at the cancel token of a waiting render
+        self.cancel_interval = 0.05
+
+    # seconds until a place is likely to be free
+    def retry_after(self):
+        duration = self.mean_duration if self.mean_duration is not None else 1.0
+        return max(1, int(math.ceil(duration * (len(self.waiting) + 1) / self.max_renders)))
+
+    # wait for a place to render at priority; raises QueueFull when there is
+    # no place to wait either. Gives up the wait with cancel.check()'s
+    # exception once cancel (an incremental.cancel_token) is cancelled.
+    def acquire(self, priority=interactive, cancel=None):
+        with self.condition:
+            if self.running < self.max_renders and not self.waiting:
+                self.running += 1
+                return
+            if len(self.waiting) >= self.max_waiting or \
+                    (priority == batch and self.waiting_batch >= self.max_waiting // 2):
+                self.rejected += 1
+                raise QueueFull(self.retry_after())
+            entry = (priority, next(self.arrivals))
+            heapq.heappush(self.waiting, entry)
+            if priority == batch:
+                self.waiting_batch += 1
+            try:
+                while self.running >= self.max_renders or self.waiting[0] != entry:
+                    if cancel is None:
+                        self.condition.wait()
+                    else:
+                        cancel.check()
+                        self.condition.wait(self.cancel_interval)
+            except BaseException:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                if priority == batch:
+                    self.waiting_batch -= 1
+                # the one behind may be first now
+                self.condition.notify_all()
+                raise
+            heapq.heappop(self.waiting)
+            if priority == batch:
+                self.waiting_batch -= 1
+            self.running += 1
+            # the next one in line may have a place too
+            self.condition.notify_all()
+
+    def release(self, duration=None):
+        with self.condition:
+            self.running -= 1
+            if duration is not None:
+                if self.mean_duration is None:
+                    self.mean_duration = duration
+                else:
+                    self.mean_duration = 0.8 * self.mean_duration + 0.2 * duration
+            self.condition.notify_all()
+
+    # with queue.place(priority, cancel): render
+    @contextmanager
+    def place(self, priority=interactive, cancel=None):
+        self.acquire(priority, cancel)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.release(time.time() - start)
+
+    def status(self):
+        with self.condition:
+            return {'running': self.running, 'waiting': len(self.waiting), 'max_renders': self.max_renders,
+                    'max_waiting': self.max_waiting, 'mean_duration': self.mean_duration, 'rejected': self.rejected}
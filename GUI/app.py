@@ -1,27 +1,92 @@
-from flask import Flask,request, render_template
+from flask import Flask,request, render_template, jsonify, session, url_for, Response
 from generate_output import OutputGenerator
-from raytracing import PositionType,camera,project_block,ray,plane,sphere,triangle_plane,tetrahedron,cube,circle_plane,cylinder,cone,normalize,intersect_plane,intersect_sphere,intersect_TriangleSet,PointinTriangle,add_sphere,add_plane,add_tetrahedron,add_cube,add_cylinder,add_cone,split_square_to_triangle,rotation,rotation_vector,trace_ray_main,reflect_and_refract,refraction,fresnel,getRefractiveIndices,getSimpleRefractive,analyse_input
+from raytracing import PositionType,camera,project_block,ray,plane,sphere,triangle_plane,tetrahedron,cube,circle_plane,cylinder,cone,normalize,intersect_plane,intersect_sphere,intersect_TriangleSet,PointinTriangle,add_sphere,add_plane,add_tetrahedron,add_cube,add_cylinder,add_cone,split_square_to_triangle,rotation,rotation_vector,reflect_and_refract,refraction,fresnel,getRefractiveIndices,getSimpleRefractive,analyse_input
+from sessions import session_store
+from incremental import RenderCancelled
+import admission
+import image_output
+import metrics
+import preview
+import progress
+import render
+import scene_patch
+import scene_schema
 import numpy as np
-import matplotlib.pyplot as plt
 import multiprocessing as mp
 import json
 import math
-
-OutputFile = OutputGenerator()
+import os
 
 app = Flask(__name__)
+app.secret_key = os.environ.get('SECRET_KEY') or os.urandom(24)
+
+# every browser session has its own scene, renderer (which keeps the last image
+# so an edit only re-traces the pixels it can change) and image file. Renders
+# of all sessions share one pool of RENDER_WORKERS processes, one per CPU by
+# default. Set SCENE_SNAPSHOT_DIR to keep a copy of each session's last scene
+# on disk. A render is cancelled by the next one of its session, or after
+# RENDER_TIMEOUT seconds (default 600). Every render is counted in Metrics.
+# MAX_SESSIONS sessions (default 64) are kept, whose renderers keep at most
+# SESSION_MEMORY_MB (default 1024) of buffers for incremental renders.
+Metrics = metrics.render_metrics()
+Sessions = session_store(render.make_options(width=512, height=512, depth=4, tile=64),
+    os.path.join(app.static_folder, 'renders'),
+    workers=int(os.environ['RENDER_WORKERS']) if os.environ.get('RENDER_WORKERS') else None,
+    max_sessions=int(os.environ.get('MAX_SESSIONS', 64)),
+    snapshot_dir=os.environ.get('SCENE_SNAPSHOT_DIR'),
+    render_timeout=float(os.environ.get('RENDER_TIMEOUT', 600)),
+    metrics=Metrics,
+    max_memory=float(os.environ.get('SESSION_MEMORY_MB', 1024)) * (1 << 20))
+
+# at most MAX_RENDERS renders at once, MAX_WAITING more waiting for a place;
+# interactive ones (the form, small /Scene renders) go before batch ones
+Renders = admission.render_queue(int(os.environ.get('MAX_RENDERS', 2)), int(os.environ.get('MAX_WAITING', 8)))
+# /Scene renders of up to this many pixels are interactive by default
+preview_pixels = 256 * 256
+# largest width, height and depth a /Scene render may ask for
+scene_limits = {'width': 2048, 'height': 2048, 'depth': 10}
+
+# read when /metrics is scraped
+Metrics.gauge('raytracer_render_queue_running', 'Renders holding a place in the render queue.',
+    lambda: Renders.status()['running'])
+Metrics.gauge('raytracer_render_queue_waiting', 'Renders waiting for a place in the render queue.',
+    lambda: Renders.status()['waiting'])
+Metrics.counter_function('raytracer_render_queue_rejections_total', 'Renders turned away with 503, the queue full.',
+    lambda: Renders.status()['rejected'])
+Metrics.gauge('raytracer_sessions', 'Browser and API sessions kept.', lambda: Sessions.status()['sessions'])
+Metrics.gauge('raytracer_workers', 'Processes of the render pool, 0 before it starts.',
+    lambda: Sessions.status()['workers'])
+Metrics.gauge('raytracer_workers_busy', 'Workers with a render task.', lambda: Sessions.status()['workers_busy'])
+Metrics.gauge('raytracer_tasks_in_flight', 'Render tasks handed to the pool and not collected yet.',
+    lambda: Sessions.status()['tasks_in_flight'])
+Metrics.gauge('raytracer_rays_per_second', 'Rays per second of the renders running now, added up.',
+    lambda: Sessions.status()['rays_per_second'])
+Metrics.counter_function('raytracer_worker_crashes_total', 'Render pool workers that died.',
+    lambda: Sessions.status()['worker_crashes'])
+
+def current_session():
+    user = Sessions.get(session.get('id'))
+    session['id'] = user.id
+    return user
+
+def image_url(user):
+    return url_for('static', filename='renders/' + user.image_name)
+
 
 @app.after_request
-def add_header(r): # disabled static file cache
+def add_header(r):
     """
-    Add headers to both force latest IE rendering engine or Chrome Frame,
-    and also to cache the rendered page for 10 minutes.
+    Rendered images are named by the hash of their content and never change,
+    so they are cached for good; other static files (bootstrap, jQuery) get
+    the default static file caching. Pages are built per request and are not
+    stored.
     """
-    r.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    r.headers["Pragma"] = "no-cache"
-    r.headers["Expires"] = "0"
-    r.headers['Cache-Control'] = 'public, max-age=0'
-    return r 
+    if request.path.startswith('/static/renders/'):
+        if r.status_code == 200:
+            r.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    elif not request.path.startswith('/static/'):
+        r.headers['Cache-Control'] = 'no-store'
+    return r
 
  
 @app.route('/')
@@ -42,40 +107,112 @@ def ObjectQuantity():
             print "something went wrong"
     return render_template('ObjectQuantity.html')
 
+# the figure page; it renders the scene through /Render and paints the tiles
+# of /Progress as they come. Dragging the image moves the camera around the
+# point it looks at with /Preview, and renders again from there once let go.
 @app.route('/Figure', methods=['POST', 'GET'])
 def Figure():
-    global OutputFile
-    OutputFile.Generate_File() # generate json file
-    w = 512
-    h = 512
-    L = np.array([5., 5., -10.])
-    color_light = np.ones(3)
-    ambient = .05
-    diffuse_c = 1.
-    specular_c = 1.
-    specular_k = 50
-    depth_max = 4  # Maximum number of light reflections.
-    processes_divided = 8
-    with open('data.json', 'r') as inputFile:
-        scene_input = inputFile.read()  
-    result_queue = mp.Queue()
-    ps = []
-    for i in range(processes_divided**2):
-        ps.append(mp.Process(target=trace_ray_main, args=(result_queue, i,
-        scene_input, )))
-    img = np.zeros((h, w, 3))
-    # start processes
-    for p in ps:
-        p.start()
-    for i in range(len(ps)):
-        img = img + result_queue.get()
-    plt.imsave('./static/Grey_Hats.png', img)
-    return render_template('Figure.html')
+    user = current_session()
+    return render_template('Figure.html',
+        camera_position=user.scene.camera_position or scene_schema.default_camera_position,
+        camera_point_to=user.scene.camera_point_to or scene_schema.default_camera_point_to)
+
+
+# render the scene of the form, answers json with the image URL. A json body
+# {"camera_position": [...], "camera_point_to": [...]} moves the camera first.
+@app.route('/Render', methods=['POST'])
+def Render():
+    user = current_session()
+    camera = request.get_json(silent=True) or {}
+    cancel = user.new_render()
+    try:
+        with user.lock:
+            if camera:
+                user.scene.camera_position, user.scene.camera_point_to = scene_schema.validate_camera(
+                    camera.get('camera_position'), camera.get('camera_point_to'))
+            # rejected before any worker starts or the render queues
+            scene = scene_schema.validate_scene(user.scene.Scene())
+        # queued without the session's lock, so a render that supersedes this
+        # one never waits behind it in the queue
+        with Renders.place(admission.interactive, cancel):
+            with user.lock:
+                cancel.check()
+                img, traced = user.renderer.render(scene, cancel=cancel)
+                Sessions.set_image(user, img)
+                user.scene.Generate_File() # optional snapshot of the scene
+                # the next camera drag previews this scene
+                Sessions.preview.preload(json.dumps(user.renderer.data, sort_keys=True))
+    except scene_schema.SceneError as e:
+        return "Invalid scene: %s" % e, 400
+    except RenderCancelled as e:
+        return "Render %s." % e, 409
+    except admission.QueueFull as e:
+        return "The server is busy, please try again in %d seconds." % e.retry_after, 503, \
+            {'Retry-After': str(e.retry_after)}
+    return jsonify(image=image_url(user), traced=traced)
+
+
+# a quick look at the session's last rendered scene (or its form, before the
+# first render) from another camera: POST json {"camera_position": [...],
+# "camera_point_to": [...]}, either left out for the scene's own, with
+# ?width= and ?height= up to preview.max_width x preview.max_height. Traces
+# primary rays only, without shadows (see preview.py), and answers a png.
+@app.route('/Preview', methods=['POST'])
+def Preview():
+    user = current_session()
+    width = request.args.get('width', preview.default_width, type=int)
+    height = request.args.get('height', preview.default_height, type=int)
+    if not (0 < width <= preview.max_width and 0 < height <= preview.max_height):
+        return jsonify(error='the preview must be from 1x1 to %dx%d' % (preview.max_width, preview.max_height)), 400
+    camera = request.get_json(force=True, silent=True) or {}
+    try:
+        scene = user.renderer.data
+        if scene is None:
+            scene = scene_schema.validate_scene(user.scene.Scene())
+        position, point_to = scene_schema.validate_camera(
+            camera.get('camera_position', scene.get('camera_position')),
+            camera.get('camera_point_to', scene.get('camera_point_to')))
+    except scene_schema.SceneError as e:
+        return jsonify(error='invalid scene', problems=e.problems), 400
+    options = preview.preview_options(width, height, position, point_to)
+    data = Sessions.preview.render_png(json.dumps(scene, sort_keys=True), options)
+    return Response(data, mimetype='image/png')
+
+
+# the render service's metrics in the Prometheus text format (see metrics.py)
+@app.route('/metrics')
+def Metrics_page():
+    return Response(Metrics.exposition(), content_type=metrics.content_type)
+
+
+# server-sent events with the progress of this session's next or running
+# render: tiles done, rays per second and time left (see progress.py). The
+# render is cancelled if the page watching it goes away before it is done.
+@app.route('/Progress')
+def Progress():
+    user = current_session()
+    return Response(watch_progress(user), mimetype='text/event-stream', headers={'X-Accel-Buffering': 'no'})
+
+def watch_progress(user):
+    finished = False
+    try:
+        # a dropped connection shows on the next event or heartbeat written
+        for event in progress.event_stream(user.renderer.progress, heartbeat=2.0):
+            yield event
+        finished = True
+    finally:
+        if not finished:
+            user.cancel_render('client disconnected')
 
 
 @app.route('/ObjectFeature', methods=['POST', 'GET'])
 def ObjectFeature():
-    global OutputFile
+    user = current_session()
+    with user.lock:
+        return read_object_feature(user.scene)
+
+# read the form of /ObjectFeature into the scene OutputFile
+def read_object_feature(OutputFile):
     OutputFile.Truncate_File()
     object_quantity = 0
     if request.method == 'POST':
@@ -2509,5 +2646,100 @@ def ObjectFeature():
         return "Object saved successfully!"
 
 
+# render options of this request: the server's, with the width, height and
+# depth of the query arguments (up to scene_limits). Returns the options, and
+# the answer to give instead if an argument is out of its limits.
+def request_options():
+    options = dict(Sessions.options)
+    for name in ('width', 'height', 'depth'):
+        value = request.args.get(name, type=int)
+        if value is not None:
+            if not 0 < value <= scene_limits[name]:
+                return options, (jsonify(error='%s must be from 1 to %d' % (name, scene_limits[name])), 400)
+            options[name] = value
+    return options, None
+
+
+# Scene json posted as the body, any number of objects of each type, in the
+# format of data.json. Checked in bulk (see scene_schema) and rendered straight
+# from the request; width, height, depth (up to scene_limits) and priority
+# ('interactive' or 'batch', by default from the image size) may be given as
+# query arguments, for this render only.
+# The answer names the scene rendered by its id, for /Scene/<id> patches.
+@app.route('/Scene', methods=['POST'])
+def Scene():
+    user = current_session()
+    options, error = request_options()
+    if error is not None:
+        return error
+    priority = request.args.get('priority')
+    if priority not in (None, 'interactive', 'batch'):
+        return jsonify(error="priority must be 'interactive' or 'batch'"), 400
+    if priority is None:
+        priority = 'interactive' if options['width'] * options['height'] <= preview_pixels else 'batch'
+    cancel = user.new_render()
+    try:
+        scene = scene_schema.validate_scene(request.get_data(as_text=True))
+        with Renders.place(getattr(admission, priority), cancel):
+            with user.lock:
+                cancel.check()
+                img, traced = user.renderer.render(scene, options, cancel=cancel)
+                Sessions.set_image(user, img)
+                return scene_answer(user, traced)
+    except scene_schema.SceneError as e:
+        return jsonify(error='invalid scene', problems=e.problems), 400
+    except RenderCancelled as e:
+        return jsonify(error='cancelled', reason=str(e)), 409
+    except admission.QueueFull as e:
+        return jsonify(error='busy', retry_after=e.retry_after), 503, {'Retry-After': str(e.retry_after)}
+
+
+def scene_answer(user, traced):
+    scene = user.renderer.data
+    return jsonify(image=image_url(user), scene=user.renderer.key,
+                   objects=sum(len(scene.get(object_type, [])) for object_type in scene_schema.object_fields),
+                   traced=traced)
+
+
+# PATCH json with a small edit (see scene_patch.py) of the session's last
+# rendered scene, scene_id, and render the result. Only the objects the patch
+# touches are compiled again. A scene_id other than the last one answers 409
+# with the last one's id, so a client never patches a scene it has not seen.
+# width, height and depth may be given as for /Scene.
+@app.route('/Scene/<scene_id>', methods=['PATCH'])
+def Patch_scene(scene_id):
+    user = current_session()
+    patch = request.get_json(force=True, silent=True)
+    if patch is None:
+        return jsonify(error='the patch must be json'), 400
+    options, error = request_options()
+    if error is not None:
+        return error
+    with user.lock:
+        if user.renderer.data is None:
+            return jsonify(error='no scene rendered'), 404
+    priority = 'interactive' if options['width'] * options['height'] <= preview_pixels else 'batch'
+    cancel = user.new_render()
+    try:
+        # queued without the session's lock (see Render); the scene to patch
+        # is the last one rendered once this render has its place
+        with Renders.place(getattr(admission, priority), cancel):
+            with user.lock:
+                cancel.check()
+                if scene_id != user.renderer.key:
+                    return jsonify(error='not the last scene', scene=user.renderer.key), 409
+                scene, sources = scene_patch.apply_patch(user.renderer.data, patch)
+                scene = scene_schema.validate_scene(scene)
+                img, traced = user.renderer.render(scene, options, cancel=cancel, sources=sources)
+                Sessions.set_image(user, img)
+                return scene_answer(user, traced)
+    except scene_schema.SceneError as e:
+        return jsonify(error='invalid patch', problems=e.problems), 400
+    except RenderCancelled as e:
+        return jsonify(error='cancelled', reason=str(e)), 409
+    except admission.QueueFull as e:
+        return jsonify(error='busy', retry_after=e.retry_after), 503, {'Retry-After': str(e.retry_after)}
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0')
\ No newline at end of file
+    app.run(host='0.0.0.0', threaded=True)
\ No newline at end of file
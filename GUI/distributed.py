@@ -0,0 +1,252 @@
+"""
+Render one scene on several machines.
+
+The coordinator compiles the scene, then hands out blocks (tiles) to worker
+processes that connect to it over TCP and streams the traced blocks into the
+image writer as they come back. A block whose worker disconnects or does not
+answer within the timeout is handed to another worker.
+
+    python distributed.py coordinator data.json -o fig.png --port 5005
+    python distributed.py worker coordinator-host:5005 --processes 8
+
+--local-workers starts worker processes on the coordinator's machine as well,
+which is also the easiest way to try it on one host.
+
+Messages are a 4 byte length, a json header and an optional binary payload of
+header['size'] bytes (the scene for 'scene', the block pixels for 'result').
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+import render
+import scene_schema
+
+
+def send_message(sock, header, payload=b''):
+    header = dict(header, size=len(payload))
+    data = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(data)) + data + payload)
+
+
+def recv_exact(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recv_message(sock):
+    size = struct.unpack('>I', recv_exact(sock, 4))[0]
+    header = json.loads(recv_exact(sock, size).decode('utf-8'))
+    return header, recv_exact(sock, header['size'])
+
+
+class coordinator():
+
+    def __init__(self, scene_input, options, writer, host='0.0.0.0', port=0, timeout=300.0):
+        scene_input = render.load_scene(scene_input)
+        self.scene_input = scene_input
+        self.options = options
+        self.writer = writer
+        self.timeout = timeout
+        self.key = render.scene_key(scene_input)
+
+        # checked above and compiled here first, so a broken scene fails
+        # before any worker starts
+        render.compile_scene(self.key, scene_input, options)
+
+        self.tiles = render.tile_count(options)
+        self.pending = deque(range(self.tiles))
+        self.done = set()
+        self.condition = threading.Condition()
+        self.workers = 0
+        self.lost_workers = 0
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(64)
+        self.server.settimeout(0.5)
+        self.port = self.server.getsockname()[1]
+
+    def finished(self):
+        return len(self.done) == self.tiles
+
+    # wait for the next block to hand out, None once every block is done
+    def next_tile(self):
+        with self.condition:
+            while not self.pending and not self.finished():
+                self.condition.wait(0.5)
+            if self.finished():
+                return None
+            return self.pending.popleft()
+
+    def handle_worker(self, conn):
+        tile = None
+        try:
+            conn.settimeout(self.timeout)
+            scene_data = self.scene_input
+            if not isinstance(scene_data, bytes):
+                scene_data = scene_data.encode('utf-8')
+            send_message(conn, {'type': 'scene', 'key': self.key, 'options': self.options}, scene_data)
+            while True:
+                tile = self.next_tile()
+                if tile is None:
+                    send_message(conn, {'type': 'done'})
+                    return
+                send_message(conn, {'type': 'tile', 'index': tile})
+                header, payload = recv_message(conn)
+                img = np.frombuffer(payload, dtype=header.get('dtype', '<f8')).reshape(header['shape'])
+                with self.condition:
+                    if tile not in self.done:
+                        self.writer.add_tile(header['row'], header['col'], img)
+                        self.done.add(tile)
+                    self.condition.notify_all()
+                tile = None
+        except (socket.error, EOFError, ValueError, KeyError):
+            # worker lost or broken reply: give its block to someone else
+            with self.condition:
+                self.lost_workers += 1
+                if tile is not None and tile not in self.done:
+                    self.pending.appendleft(tile)
+                self.condition.notify_all()
+        finally:
+            conn.close()
+
+    def run(self):
+        threads = []
+        try:
+            while not self.finished():
+                try:
+                    conn, address = self.server.accept()
+                except socket.timeout:
+                    continue
+                self.workers += 1
+                thread = threading.Thread(target=self.handle_worker, args=(conn,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        finally:
+            self.server.close()
+        for thread in threads:
+            thread.join(1.0)
+        return self.writer.close()
+
+
+# trace the blocks a coordinator hands out until it says done
+def worker_main(host, port, retry=10.0):
+    deadline = time.time() + retry
+    while True:
+        try:
+            sock = socket.create_connection((host, port))
+            break
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+    try:
+        header, payload = recv_message(sock)
+        key, options = header['key'], header['options']
+        render.compile_scene(key, payload.decode('utf-8'), options)
+        while True:
+            header, payload = recv_message(sock)
+            if header['type'] == 'done':
+                return
+            project_block_index, row, col, img = render.render_tile((key, None, options, header['index']))
+            # float32 renders send half the bytes
+            img = np.ascontiguousarray(img)
+            send_message(sock, {'type': 'result', 'index': project_block_index, 'row': row, 'col': col,
+                'shape': list(img.shape), 'dtype': img.dtype.str}, img.tobytes())
+    except EOFError:
+        # coordinator went away
+        return
+    finally:
+        sock.close()
+
+
+def start_workers(host, port, processes):
+    ps = []
+    for i in range(processes):
+        p = mp.Process(target=worker_main, args=(host, port))
+        p.daemon = True
+        p.start()
+        ps.append(p)
+    return ps
+
+
+def split_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Render a scene on worker processes spread over several hosts.')
+    subparsers = parser.add_subparsers(dest='mode')
+
+    coordinator_parser = subparsers.add_parser('coordinator', help='compile the scene and hand out tiles')
+    coordinator_parser.add_argument('scene', help="scene json or binary scene (.npz) file, '-' reads stdin")
+    coordinator_parser.add_argument('--host', default='0.0.0.0')
+    coordinator_parser.add_argument('--port', type=int, default=5005, help='0 picks a free port')
+    coordinator_parser.add_argument('--local-workers', type=int, default=0,
+        help='worker processes to start on this host')
+    coordinator_parser.add_argument('--timeout', type=float, default=300.0,
+        help='seconds to wait for a tile before handing it to another worker')
+    render.add_render_arguments(coordinator_parser)
+
+    worker_parser = subparsers.add_parser('worker', help='trace tiles for a coordinator')
+    worker_parser.add_argument('address', help='coordinator host:port')
+    worker_parser.add_argument('--processes', type=int, default=mp.cpu_count())
+
+    args = parser.parse_args(argv)
+    options = None
+    if args.mode == 'coordinator':
+        options = render.check_render_arguments(coordinator_parser, args)
+    return args, options
+
+
+def main(argv=None):
+    args, options = parse_args(argv)
+
+    if args.mode == 'worker':
+        host, port = split_address(args.address)
+        for p in start_workers(host, port, args.processes):
+            p.join()
+        return
+
+    start = time.time()
+    try:
+        scene_input = render.load_scene(render.read_scene(args.scene))
+    except scene_schema.SceneError as e:
+        sys.exit('%s: invalid scene: %s' % (args.scene, e))
+    writer = render.open_writer(args.output, options, args.format, args.gamma)
+    server = coordinator(scene_input, options, writer, args.host, args.port, args.timeout)
+    sys.stderr.write('Coordinator listening on %s:%d\n' % (args.host, server.port))
+    ps = start_workers('127.0.0.1', server.port, args.local_workers)
+    render_start = time.time()
+    server.run()
+    end = time.time()
+    for p in ps:
+        p.join(1.0)
+
+    render.print_summary(options, server.workers, args.output, start, render_start, end)
+    if server.lost_workers:
+        sys.stderr.write('  %d worker connections lost, their tiles were re-issued\n' % server.lost_workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+Per pixel buffers of a render, and relighting from them.
+
+The buffers hold what the primary ray of every pixel hit (object index, point,
+normal and colour, the geometry buffer). Next to them are tables of one row per
+entry: the nodes keep every hit of every ray tree: pixel, object, point,
+normal, colour, the origin of the ray that hit it and its share of the pixel
+colour (the path loss, 0 when the ray hit the inside of an object), the
+escapes every ray of the trees that hit nothing: pixel, origin and direction,
+and touched the objects each ray tree touched, hit or in the way of a shadow
+ray: pixel and object. Between them they hold every ray a pixel traced, in
+memory that grows with the rays, not with pixels times objects.
+
+Moving the light or changing color_light, ambient or specular_k changes
+neither what the primary rays hit nor where the reflected and refracted rays
+go, only the direct light and the shadows at each node. A pixel is the sum of
+share * direct light * transmittance ** 2 over its nodes, so relighting shades
+all nodes in one vectorized pass and traces only their shadow rays.
+"""
+
+import numpy as np
+
+import raytracing
+
+# scene keys that only change the lighting (see raytracing.default_lighting)
+lighting_keys = ('light', 'color_light', 'ambient', 'specular_k', 'lights')
+
+
+def empty_buffers(height, width):
+    return {
+        'object': np.full((height, width), -1, dtype=int),
+        'hit': np.full((height, width, 3), np.nan, dtype=raytracing.dtype),
+        'normal': np.full((height, width, 3), np.nan, dtype=raytracing.dtype),
+        'color': np.zeros((height, width, 3), dtype=raytracing.dtype),
+    }
+
+
+def empty_nodes():
+    return {
+        'row': np.zeros(0, dtype=int),
+        'col': np.zeros(0, dtype=int),
+        'object': np.zeros(0, dtype=int),
+        'hit': np.zeros((0, 3), dtype=raytracing.dtype),
+        'normal': np.zeros((0, 3), dtype=raytracing.dtype),
+        'color': np.zeros((0, 3), dtype=raytracing.dtype),
+        'origin': np.zeros((0, 3), dtype=raytracing.dtype),
+        'weight': np.zeros(0, dtype=raytracing.dtype),
+    }
+
+
+def empty_escapes():
+    return {
+        'row': np.zeros(0, dtype=int),
+        'col': np.zeros(0, dtype=int),
+        'origin': np.zeros((0, 3), dtype=raytracing.dtype),
+        'direction': np.zeros((0, 3), dtype=raytracing.dtype),
+    }
+
+
+def empty_touched():
+    return {
+        'row': np.zeros(0, dtype=int),
+        'col': np.zeros(0, dtype=int),
+        'object': np.zeros(0, dtype=int),
+    }
+
+
+# names and values of a list to arrays shaped and typed like those of empty
+def row_arrays(rows, empty):
+    return dict((name, np.array(values, dtype=empty[name].dtype).reshape((-1,) + empty[name].shape[1:]))
+                for name, values in rows.items())
+
+
+# buffers, nodes, escapes and touched of a list of rows of
+# raytracing.ray_record, the tables at (row, col) in the list
+def record_arrays(records):
+    rows, cols = len(records), len(records[0])
+    buffers = empty_buffers(rows, cols)
+    nodes = dict((name, []) for name in empty_nodes())
+    escapes = dict((name, []) for name in empty_escapes())
+    touched = dict((name, []) for name in empty_touched())
+    for row in range(rows):
+        for col in range(cols):
+            record = records[row][col]
+            for obj_idx in sorted(record.objects):
+                for name, value in zip(('row', 'col', 'object'), (row, col, obj_idx)):
+                    touched[name].append(value)
+            if record.object is not None:
+                buffers['object'][row, col] = record.object
+                buffers['hit'][row, col] = record.hit
+                buffers['normal'][row, col] = record.normal
+                buffers['color'][row, col] = record.color
+            for obj_idx, M, N, color, origin, weight in record.nodes:
+                for name, value in zip(('row', 'col', 'object', 'hit', 'normal', 'color', 'origin', 'weight'),
+                                       (row, col, obj_idx, M, N, color, origin, weight)):
+                    nodes[name].append(value)
+            for escaped_ray in record.escaped:
+                for name, value in zip(('row', 'col', 'origin', 'direction'),
+                                       (row, col, escaped_ray.origin, escaped_ray.direction)):
+                    escapes[name].append(value)
+    return (buffers, row_arrays(nodes, empty_nodes()), row_arrays(escapes, empty_escapes()),
+            row_arrays(touched, empty_touched()))
+
+
+# nodes (or another table) with every row and col moved by row, col
+def offset_nodes(nodes, row, col):
+    return dict(nodes, row=nodes['row'] + row, col=nodes['col'] + col)
+
+
+# node_list, a list of nodes or of another table (empty), as one
+def concatenate_nodes(node_list, empty=empty_nodes):
+    if not node_list:
+        return empty()
+    return dict((name, np.concatenate([nodes[name] for nodes in node_list])) for name in node_list[0])
+
+
+# nodes (or another table) without those of the pixels where mask (height, width) is set
+def drop_nodes(nodes, mask):
+    keep = ~mask[nodes['row'], nodes['col']]
+    return dict((name, values[keep]) for name, values in nodes.items())
+
+
+# primary ray directions of every pixel, in image orientation
+def primary_directions(camera_seeting, width, height):
+    x = np.arange(width)[np.newaxis, :, np.newaxis]
+    y = (height - 1 - np.arange(height))[:, np.newaxis, np.newaxis]
+    Q = camera_seeting.project_start + x * camera_seeting.x_project_size_pre_pixel * camera_seeting.x_coordinate_vector + y * camera_seeting.y_project_size_pre_pixel * camera_seeting.y_coordinate_vector
+    D = Q - camera_seeting.position
+    return D / np.linalg.norm(D, axis=2)[:, :, np.newaxis]
+
+
+def normalize_rows(x):
+    return x / np.linalg.norm(x, axis=-1)[..., np.newaxis]
+
+
+# which rays of origins + t * directions (t >= 0, up to max_t) pass through the sphere
+def rays_hit_sphere(origins, directions, centre, radius, max_t=np.inf):
+    with np.errstate(invalid='ignore'):
+        OS = origins - centre
+        b = np.sum(directions * OS, axis=-1)
+        c = np.sum(OS * OS, axis=-1) - radius * radius
+        a = np.sum(directions * directions, axis=-1)
+        disc = b * b - a * c
+        sqrt_disc = np.sqrt(np.maximum(disc, 0))
+        t0 = (-b - sqrt_disc) / a
+        t1 = (-b + sqrt_disc) / a
+        return (disc > 0) & (t1 >= 0) & (t0 <= max_t)
+
+
+# which nodes and which escapes have a ray through one of the spheres
+# (centre, radius): the ray that hit the node, up to the hit, an escaped ray,
+# or a shadow ray from the node to one of lights, a list of (position, range).
+# Shadow rays are tested as the tracer traces them, from M + N * surface_bias
+# on past the light, towards every light in range.
+def traced_rays_hit_spheres(nodes, escapes, lights, spheres):
+    node_hit = np.zeros(len(nodes['row']), dtype=bool)
+    escape_hit = np.zeros(len(escapes['row']), dtype=bool)
+    segments = nodes['hit'] - nodes['origin']
+    for centre, radius in spheres:
+        node_hit |= rays_hit_sphere(nodes['origin'], segments, centre, radius, 1.0)
+        escape_hit |= rays_hit_sphere(escapes['origin'], escapes['direction'], centre, radius)
+    shadow_origins = nodes['hit'] + nodes['normal'] * raytracing.surface_bias
+    for position, light_range in lights:
+        toL = position - nodes['hit']
+        in_range = np.sum(toL * toL, axis=-1) < light_range ** 2
+        for centre, radius in spheres:
+            node_hit |= in_range & rays_hit_sphere(shadow_origins, toL, centre, radius)
+    return node_hit, escape_hit
+
+
+# which rays (origins, directions) obj.intersect would hit: exact for
+# spheres and planes, other objects only test the rays through their
+# bounding sphere one by one
+def rays_hit_object(obj, origins, directions):
+    if obj.type == 'sphere':
+        return rays_hit_sphere(origins, directions, obj.position, obj.radius)
+    if obj.type == 'plane':
+        denom = np.dot(directions, obj.normal_vector)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d = np.dot(obj.point - origins, obj.normal_vector) / denom
+        return (np.abs(denom) >= raytracing.parallel_epsilon) & (d >= 0)
+    hit = rays_hit_sphere(origins, directions, obj.position, obj.bounding_radius)
+    for n in np.nonzero(hit)[0]:
+        hit[n] = obj.intersect(raytracing.ray(origins[n], directions[n])) < np.inf
+    return hit
+
+
+# raytracing.shadow_transmittance of every point M (normal N) on the object
+# objects at once. Returns the transmittance and which points each object
+# shadows, as the indices of the points and of the object shadowing them.
+def shadow_transmittance(M, N, objects, scene, light):
+    origins = M + N * raytracing.surface_bias
+    toL = normalize_rows(light - M)
+    transmittance = np.ones(len(M))
+    points, shadows = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+    for k, obj_sh in enumerate(scene):
+        hit = rays_hit_object(obj_sh, origins, toL) & (objects != k)
+        transmittance[hit] *= obj_sh.simple_refractive
+        points.append(np.nonzero(hit)[0])
+        shadows.append(np.full(len(points[-1]), k, dtype=int))
+    return transmittance, (np.concatenate(points), np.concatenate(shadows))
+
+
+# raytracing.direct_light of every point M at once
+def direct_light(M, N, color, origin, lighting):
+    toL = normalize_rows(lighting['light'] - M)
+    toO = normalize_rows(origin - M)
+    diffuse = np.maximum(np.sum(N * toL, axis=-1), 0)
+    specular = np.maximum(np.sum(N * normalize_rows(toL + toO), axis=-1), 0) ** lighting['specular_k']
+    col = lighting['ambient'] + raytracing.diffuse_c * diffuse[:, np.newaxis] * color
+    col += raytracing.specular_c * specular[:, np.newaxis] * lighting['color_light']
+    return col
+
+
+# relight the image of buffers and nodes with lighting (the single light, not
+# a light list); scene holds the objects they were rendered with. Returns the
+# new image and the touched objects under the new shadows.
+def relight(buffers, nodes, scene, lighting):
+    height, width = buffers['object'].shape
+    transmittance, (points, shadows) = shadow_transmittance(nodes['hit'], nodes['normal'], nodes['object'],
+        scene, lighting['light'])
+    lit = nodes['weight'] > 0
+    direct = direct_light(nodes['hit'][lit], nodes['normal'][lit], nodes['color'][lit], nodes['origin'][lit], lighting)
+
+    img = np.zeros((height, width, 3), dtype=raytracing.dtype)
+    np.add.at(img, (nodes['row'][lit], nodes['col'][lit]),
+        direct * (nodes['weight'][lit] * transmittance[lit] ** 2)[:, np.newaxis])
+
+    # each (pixel, object) once
+    object_count = max(len(scene), 1)
+    pixel = nodes['row'].astype(np.int64) * width + nodes['col']
+    pairs = np.unique(np.concatenate([pixel * object_count + nodes['object'],
+                                      pixel[points] * object_count + shadows]))
+    pixel, objects = np.divmod(pairs, object_count)
+    touched = {'row': (pixel // width).astype(int), 'col': (pixel % width).astype(int), 'object': objects.astype(int)}
+    return np.clip(img, 0, 1), touched
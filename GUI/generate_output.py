@@ -1,9 +1,14 @@
 import json
 
+import scene_file
+
 class OutputGenerator:
-    def __init__(self):
+    # output_file: where Generate_File writes a snapshot of the scene, as a
+    # binary scene file (see scene_file.py) if it ends in .npz; None keeps the
+    # scene in memory only
+    def __init__(self, output_file="data.json"):
         self.object_count = 0
-        self.output_file = "data.json"
+        self.output_file = output_file
         # Configure the right format for json      
         self.Configure_dict = {}
         self.Sphere_list = []
@@ -16,10 +21,8 @@ class OutputGenerator:
         self.camera_point_to = []
         self.light = []
 
+    # start a new scene; the snapshot on disk is left until the next Generate_File
     def Truncate_File(self):
-        with open(self.output_file, 'r+') as f:
-            f.seek(0)
-            f.truncate()
         self.object_count = 0
         self.Configure_dict = {}
         self.Sphere_list = []
@@ -95,7 +98,9 @@ class OutputGenerator:
         Cone_dict_temp["transparency_level"] = transparency
         self.Cone_list.append(Cone_dict_temp)
 
-    def Generate_File(self):
+    # the scene as the dict analyse_input reads
+    def Scene(self):
+        self.Configure_dict = {}
         if self.Tetrahedron_list: # if there is at least one Tetrahedron in the scene
             self.Configure_dict["tetrahedron"] = self.Tetrahedron_list
         if self.Cube_list:
@@ -110,7 +115,15 @@ class OutputGenerator:
         self.Configure_dict["camera_position"] = self.camera_position
         self.Configure_dict["camera_point_to"] = self.camera_point_to
         self.Configure_dict["light"] = self.light
-        content = json.dumps(self.Configure_dict, sort_keys=True, indent=4)
+        return self.Configure_dict
+
+    # write the scene to output_file, if there is one
+    def Generate_File(self):
+        if self.output_file is None:
+            return
+        if self.output_file.endswith('.npz'):
+            scene_file.save_scene(self.output_file, self.Scene())
+            return
+        content = json.dumps(self.Scene(), sort_keys=True, indent=4)
         with open(self.output_file, 'w') as f:
             f.write(content)
-            f.close()
@@ -0,0 +1,170 @@
+"""
+Output stage of the ray tracer.
+
+Quantizes the float framebuffer (with gamma) and encodes it as PNG, PPM or a
+raw .npy file. Finished tiles are collected by tile_writer and every run of
+complete rows is handed to the encoder straight away, so the image is encoded
+while the remaining tiles are still being traced.
+"""
+
+import io
+import os
+import struct
+import zlib
+
+import numpy as np
+
+FORMATS = ('png', 'ppm', 'npy')
+
+
+# float image in [0, 1] -> 8 bit image
+def quantize(img, gamma=1.0):
+    img = np.clip(img, 0.0, 1.0)
+    if gamma != 1.0:
+        img = img ** (1.0 / gamma)
+    return (img * 255.0 + 0.5).astype(np.uint8)
+
+
+class png_writer():
+
+    def __init__(self, f, width, height, gamma=1.0, compress_level=6):
+        self.f = f
+        self.width = width
+        self.height = height
+        self.gamma = gamma
+        self.compressor = zlib.compressobj(compress_level)
+
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bit RGB, no interlace
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def write_chunk(self, chunk_type, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(chunk_type)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    def write_rows(self, rows):
+        pixels = quantize(rows, self.gamma).reshape(len(rows), self.width * 3)
+        # every scanline starts with filter type 0 (none)
+        scanlines = np.zeros((len(rows), self.width * 3 + 1), dtype=np.uint8)
+        scanlines[:, 1:] = pixels
+        data = self.compressor.compress(scanlines.tobytes())
+        if data:
+            self.write_chunk(b'IDAT', data)
+
+    def close(self):
+        self.write_chunk(b'IDAT', self.compressor.flush())
+        self.write_chunk(b'IEND', b'')
+
+
+class ppm_writer():
+
+    def __init__(self, f, width, height, gamma=1.0):
+        self.f = f
+        self.width = width
+        self.height = height
+        self.gamma = gamma
+        self.f.write(('P6\n%d %d\n255\n' % (width, height)).encode('ascii'))
+
+    def write_rows(self, rows):
+        self.f.write(quantize(rows, self.gamma).tobytes())
+
+    def close(self):
+        pass
+
+
+# raw float framebuffer, readable with np.load
+class npy_writer():
+
+    def __init__(self, f, width, height, dtype=np.float64):
+        self.f = f
+        self.dtype = np.dtype(dtype)
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                  'fortran_order': False,
+                  'shape': (height, width, 3)}
+        np.lib.format.write_array_header_1_0(self.f, header)
+
+    def write_rows(self, rows):
+        self.f.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+
+    def close(self):
+        pass
+
+
+# collects tiles into the image and passes on every complete row to the
+# encoder; without an encoder it only keeps the image
+class tile_writer():
+
+    def __init__(self, encoder, width, height, f=None, dtype=np.float64):
+        self.encoder = encoder
+        self.width = width
+        self.height = height
+        self.f = f
+        self.buffer = np.zeros((height, width, 3), dtype=dtype)
+        self.row_filled = np.zeros(height, dtype=int)
+        self.next_row = 0
+
+    def add_tile(self, row, col, tile):
+        tile_h, tile_w = tile.shape[0], tile.shape[1]
+        self.buffer[row:row + tile_h, col:col + tile_w, :] = tile
+        self.row_filled[row:row + tile_h] += tile_w
+
+        # pass on every complete row below the rows already encoded
+        end = self.next_row
+        while end < self.height and self.row_filled[end] >= self.width:
+            end += 1
+        if end > self.next_row:
+            if self.encoder is not None:
+                self.encoder.write_rows(self.buffer[self.next_row:end])
+            self.next_row = end
+
+    def close(self):
+        if self.encoder is not None:
+            if self.next_row < self.height:
+                self.encoder.write_rows(self.buffer[self.next_row:])
+            self.encoder.close()
+        self.next_row = self.height
+        if self.f is not None:
+            self.f.close()
+        return self.buffer
+
+
+# dtype: the array type npy files are written in, the other formats are 8 bit
+def make_encoder(f, fmt, width, height, gamma=1.0, dtype=np.float64):
+    if fmt == 'png':
+        return png_writer(f, width, height, gamma)
+    elif fmt == 'ppm':
+        return ppm_writer(f, width, height, gamma)
+    elif fmt == 'npy':
+        return npy_writer(f, width, height, dtype)
+    raise ValueError('Unknown image format: %s' % fmt)
+
+
+def format_from_path(path):
+    fmt = os.path.splitext(path)[1][1:].lower()
+    if fmt not in FORMATS:
+        return 'png'
+    return fmt
+
+
+# open a tile_writer which encodes into the file at path
+def open_image_writer(path, width, height, fmt=None, gamma=1.0, dtype=np.float64):
+    if fmt is None:
+        fmt = format_from_path(path)
+    f = open(path, 'wb')
+    return tile_writer(make_encoder(f, fmt, width, height, gamma, dtype), width, height, f, dtype)
+
+
+def save_image(path, img, fmt=None, gamma=1.0):
+    writer = open_image_writer(path, img.shape[1], img.shape[0], fmt, gamma, img.dtype)
+    writer.add_tile(0, 0, img)
+    writer.close()
+
+
+def encode_image(img, fmt='png', gamma=1.0):
+    f = io.BytesIO()
+    encoder = make_encoder(f, fmt, img.shape[1], img.shape[0], gamma, img.dtype)
+    encoder.write_rows(img)
+    encoder.close()
+    return f.getvalue()
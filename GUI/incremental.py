@@ -0,0 +1,378 @@
+"""
+Re-render only the pixels an edit can change.
+
+A full render keeps the per pixel buffers, ray tree nodes and escapes of
+gbuffer.py: which objects the ray tree of each pixel touched (primary,
+reflected, refracted and shadow rays), what its primary ray hit and every ray
+it traced. When the next scene only changes objects (colour, size, position,
+...), the pixels re-traced are those
+
+  - whose ray tree touched a changed object,
+  - one of whose rays (up to what it hit) or shadow rays passes through the
+    bounding sphere of a changed object in its new place.
+
+Every other pixel traces the same rays to the same hits and shadows, so the
+image is the one a full render would give. When only the light or the
+lighting parameters change, the image is relit from the nodes without
+tracing anything but shadow rays (see gbuffer.relight). Changing the camera,
+a plane or a scene's light list, or adding or removing objects, re-renders
+everything.
+
+Whatever the render, the workers build only the objects that differ from the
+scene before (render.scene_delta) and reuse the others as compiled then.
+"""
+
+import json
+import multiprocessing as mp
+import time
+
+import numpy as np
+
+import gbuffer
+import progress
+import raytracing
+import render
+import scene_schema
+
+
+# counters of this worker process a task reports the change of: rays traced
+# and compiled scene cache hits and misses
+def worker_counts():
+    return {'rays': raytracing.rays_traced, 'scene_hits': render.scene_cache_hits,
+            'scene_misses': render.scene_cache_misses}
+
+
+def counts_since(before):
+    now = worker_counts()
+    return dict((name, now[name] - before[name]) for name in now)
+
+
+# worker task: render.render_tile task, also returns the buffers, nodes and
+# escapes of the tile and the worker counts of the task
+def render_tile_records(task):
+    key, scene_input, options, project_block_index = task
+    before = worker_counts()
+    camera_seeting, scene, lighting = render.use_scene(key, scene_input, options)
+    current_project_block = camera_seeting.project_blocks[project_block_index]
+    records = [[None] * current_project_block.x_pixel_size for j in range(current_project_block.y_pixel_size)]
+    img = raytracing.trace_block(camera_seeting, current_project_block, scene, records)
+    return (current_project_block.row, current_project_block.col, img, gbuffer.record_arrays(records),
+            counts_since(before))
+
+
+# worker task: render.render_tile task, returned as render_tile_records
+# returns it without buffers and tables (None)
+def render_tile_counted(task):
+    before = worker_counts()
+    project_block_index, row, col, img = render.render_tile(task)
+    return row, col, img, None, counts_since(before)
+
+
+# worker task: (scene key, scene, options, list of (row, col)), re-traces those
+# pixels. Also returns the worker counts of the task.
+def retrace_pixels(task):
+    key, scene_input, options, pixels = task
+    before = worker_counts()
+    camera_seeting, scene, lighting = render.use_scene(key, scene_input, options)
+    colors = np.zeros((len(pixels), 3))
+    records = [[]]
+    for n, (row, col) in enumerate(pixels):
+        record = raytracing.ray_record()
+        colors[n] = raytracing.trace_pixel(camera_seeting, col, options['height'] - row - 1, scene, record)
+        records[0].append(record)
+    buffers, nodes, escapes, touched = gbuffer.record_arrays(records)
+    # the tables are at (0, n), move them to the pixel they belong to
+    rows, cols = np.array(pixels, dtype=int).reshape(-1, 2).T
+    nodes, escapes, touched = [dict(table, row=rows[table['col']], col=cols[table['col']])
+                               for table in (nodes, escapes, touched)]
+    return pixels, colors, buffers, nodes, escapes, touched, counts_since(before)
+
+
+# what differs between two scenes: ('none', []), ('objects', indices in the
+# compiled scene of the changed objects), ('lighting', []) or ('full', [])
+def scene_changes(old_data, new_data):
+    for name in ('camera_position', 'camera_point_to'):
+        if old_data.get(name) != new_data.get(name):
+            return 'full', []
+    lighting_changed = any(old_data.get(name) != new_data.get(name) for name in gbuffer.lighting_keys)
+
+    changed = []
+    index = 0
+    for object_type in raytracing.object_types:
+        old_objects = old_data.get(object_type) or []
+        new_objects = new_data.get(object_type) or []
+        if len(old_objects) != len(new_objects):
+            return 'full', []
+        for i in range(len(new_objects)):
+            if old_objects[i] != new_objects[i]:
+                if object_type == 'plane':
+                    return 'full', []
+                changed.append(index + i)
+        index += len(new_objects)
+
+    if lighting_changed:
+        # relighting only knows the single light
+        if changed or old_data.get('lights') or new_data.get('lights'):
+            return 'full', []
+        return 'lighting', []
+    if changed:
+        return 'objects', changed
+    return 'none', []
+
+
+class RenderCancelled(Exception):
+    pass
+
+
+# cancels a render: by cancel(reason), or once timeout seconds have passed
+class cancel_token():
+
+    def __init__(self, timeout=None):
+        self.deadline = time.time() + timeout if timeout else None
+        self.reason = None
+
+    def cancel(self, reason='cancelled'):
+        if self.reason is None:
+            self.reason = reason
+
+    def check(self):
+        if self.reason is None and self.deadline is not None and time.time() > self.deadline:
+            self.reason = 'timed out'
+        if self.reason is not None:
+            raise RenderCancelled(self.reason)
+
+
+class incremental_renderer():
+
+    # options: of every render that does not give its own.
+    # keep_gbuffer: keep the buffers and tables of gbuffer.py, to re-trace
+    # only what an object edit changes and relight light-only changes; without
+    # them every render is a full one.
+    # pool: a worker pool shared with other renderers, left open by close().
+    # Tasks are handed to the pool a few at a time, at most max_tasks (by
+    # default twice the workers) waiting or running at once, so a cancelled
+    # render leaves nothing queued behind. The progress of each render is
+    # reported to self.progress (progress.render_progress), and its outcome to
+    # metrics (metrics.render_metrics) if given.
+    def __init__(self, options=None, workers=None, pixels_per_task=256, keep_gbuffer=True, pool=None,
+                 max_tasks=None, metrics=None):
+        self.default_options = options or render.make_options()
+        # options of the last render, which the image and buffers are of
+        self.options = self.default_options
+        self.workers = workers
+        self.max_tasks = max_tasks or 2 * (workers or mp.cpu_count())
+        self.pixels_per_task = pixels_per_task
+        self.keep_gbuffer = keep_gbuffer
+        self.pool = pool
+        self.own_pool = pool is None
+        self.progress = progress.render_progress()
+        self.metrics = metrics
+        # tasks handed to the pool and not collected yet
+        self.in_flight = 0
+        # worker counts of the current render's tasks
+        self.counts = {}
+        self.data = None
+        self.key = None
+        self.img = None
+        self.buffers = None
+        self.nodes = None
+        self.escapes = None
+        self.touched = None
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = mp.Pool(self.workers)
+        return self.pool
+
+    def close(self):
+        if self.pool is not None and self.own_pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    # results of function over tasks, in the order they finish; function
+    # returns its worker counts last, which are added up in self.counts. Stops with
+    # RenderCancelled as soon as cancel (a cancel_token) is cancelled; the
+    # tasks already handed out finish, the rest never start.
+    def run_tasks(self, function, tasks, cancel=None):
+        pool = self.get_pool()
+        tasks = iter(tasks)
+        running = []
+        while True:
+            if cancel is not None:
+                cancel.check()
+            while len(running) < self.max_tasks:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                running.append(pool.apply_async(function, (task,)))
+            self.in_flight = len(running)
+            if not running:
+                return
+            finished = [result for result in running if result.ready()]
+            if not finished:
+                running[0].wait(0.05)
+                continue
+            for result in finished:
+                running.remove(result)
+                self.in_flight = len(running)
+                value = result.get()
+                for name, count in value[-1].items():
+                    self.counts[name] = self.counts.get(name, 0) + count
+                yield value
+
+    # render scene_input (json or a dict), re-using the last image where possible. Returns the
+    # image and the number of pixels traced (relit pixels count as traced).
+    # Raises RenderCancelled if cancel (a cancel_token) is cancelled first;
+    # the next render is then a full one. sources (see render.scene_delta)
+    # tells which objects are new or changed since the last render, when the
+    # caller knows; otherwise the scenes are compared.
+    def render(self, scene_input, options=None, full=False, cancel=None, sources=None):
+        options = options or self.default_options
+        # raises scene_schema.SceneError before any worker is involved
+        data = scene_schema.validate_scene(scene_input)
+        scene_input = json.dumps(data, sort_keys=True)
+        key = render.scene_key(scene_input)
+        if self.data is not None and key != self.key:
+            # the workers compile only what changed since the last scene
+            if sources is None:
+                sources = render.object_sources(self.data, data)
+            task_scene = render.scene_delta(scene_input, self.key, sources)
+        else:
+            task_scene = scene_input
+
+        kind, changed = 'full', []
+        if not full and self.data is not None and options == self.options:
+            kind, changed = scene_changes(self.data, data)
+        if kind in ('objects', 'lighting') and self.nodes is None:
+            kind = 'full'
+        self.options = options
+        self.counts = {}
+        start = time.time()
+
+        try:
+            if kind == 'full':
+                self.full_render(key, task_scene, cancel)
+                traced = options['width'] * options['height']
+            elif kind == 'objects':
+                traced = self.partial_render(key, task_scene, changed, cancel)
+            elif kind == 'lighting':
+                traced = int(np.count_nonzero(self.buffers['object'] >= 0))
+                self.progress.start(kind, 1, traced, options['width'], options['height'])
+                with render.scene_lock:
+                    camera_seeting, scene, lighting = render.use_scene(key, task_scene, options)
+                    self.img, self.touched = gbuffer.relight(self.buffers, self.nodes, scene, lighting)
+                # one shadow ray per ray tree node
+                self.counts['rays'] = len(self.nodes['object'])
+                self.progress.tile_done(traced, self.counts['rays'], (0, 0, self.img.copy()))
+            else:
+                self.progress.start(kind, 0, 0, options['width'], options['height'])
+                traced = 0
+        except Exception as e:
+            # the image and buffers may be half updated
+            self.data = None
+            self.in_flight = 0
+            self.progress.finish(str(e) or e.__class__.__name__)
+            self.report(kind, 'cancelled' if isinstance(e, RenderCancelled) else 'error', start, 0)
+            raise
+        self.progress.finish()
+        self.report(kind, 'done', start, traced)
+        self.data = data
+        self.key = key
+        return self.img.copy(), traced
+
+    # bytes held by the image, buffers and tables
+    def memory(self):
+        arrays = [] if self.img is None else [self.img]
+        for table in (self.buffers, self.nodes, self.escapes, self.touched):
+            if table is not None:
+                arrays.extend(table.values())
+        return sum(values.nbytes for values in arrays)
+
+    # free the buffers and tables; the next render is a full one
+    def drop_buffers(self):
+        self.buffers = self.nodes = self.escapes = self.touched = None
+
+    def report(self, kind, outcome, start, traced):
+        if self.metrics is not None:
+            self.metrics.render_finished(kind, self.options['width'], self.options['height'], outcome,
+                                         time.time() - start, traced, self.counts)
+
+    def full_render(self, key, scene_input, cancel=None):
+        options = self.options
+        h, w = options['height'], options['width']
+        # in the render precision, as gbuffer.relight gives it
+        self.img = np.zeros((h, w, 3), dtype=raytracing.precisions[options.get('precision', 'float64')]['dtype'])
+        self.drop_buffers()
+        with render.scene_lock:
+            tiles = render.tile_count(options)
+            if self.keep_gbuffer:
+                self.buffers = gbuffer.empty_buffers(h, w)
+        nodes = []
+        escapes = []
+        touched = []
+        tasks = [(key, scene_input, options, i) for i in range(tiles)]
+        self.progress.start('full', len(tasks), h * w, w, h)
+        task = render_tile_records if self.keep_gbuffer else render_tile_counted
+        for row, col, img, tables, counts in self.run_tasks(task, tasks, cancel):
+            rows = slice(row, row + img.shape[0])
+            cols = slice(col, col + img.shape[1])
+            self.img[rows, cols] = img
+            self.progress.tile_done(img.shape[0] * img.shape[1], counts['rays'], (row, col, img))
+            if tables is None:
+                continue
+            buffers, tile_nodes, tile_escapes, tile_touched = tables
+            for name, values in buffers.items():
+                self.buffers[name][rows, cols] = values
+            nodes.append(gbuffer.offset_nodes(tile_nodes, row, col))
+            escapes.append(gbuffer.offset_nodes(tile_escapes, row, col))
+            touched.append(gbuffer.offset_nodes(tile_touched, row, col))
+        if not self.keep_gbuffer:
+            return
+        self.nodes = gbuffer.concatenate_nodes(nodes)
+        self.escapes = gbuffer.concatenate_nodes(escapes, gbuffer.empty_escapes)
+        self.touched = gbuffer.concatenate_nodes(touched, gbuffer.empty_touched)
+
+    # the pixels a change of the objects at indices changed may affect (see
+    # the module docstring), scene the new objects
+    def affected_pixels(self, scene, lighting, changed):
+        affected = np.zeros(self.buffers['object'].shape, dtype=bool)
+        was_touched = np.in1d(self.touched['object'], changed)
+        affected[self.touched['row'][was_touched], self.touched['col'][was_touched]] = True
+        # the single light, shaded with or without a light list
+        lights = [(lighting['light'], np.inf)]
+        if lighting['lights'] is not None:
+            lights += [(light['position'], light['range']) for light in lighting['lights'].lights]
+        spheres = [(scene[index].position, scene[index].bounding_radius) for index in changed]
+        node_hit, escape_hit = gbuffer.traced_rays_hit_spheres(self.nodes, self.escapes, lights, spheres)
+        affected[self.nodes['row'][node_hit], self.nodes['col'][node_hit]] = True
+        affected[self.escapes['row'][escape_hit], self.escapes['col'][escape_hit]] = True
+        return affected
+
+    def partial_render(self, key, scene_input, changed, cancel=None):
+        with render.scene_lock:
+            camera_seeting, scene, lighting = render.use_scene(key, scene_input, self.options)
+            affected = self.affected_pixels(scene, lighting, changed)
+        pixels = [(int(row), int(col)) for row, col in zip(*np.nonzero(affected))]
+        tasks = [(key, scene_input, self.options, pixels[i:i + self.pixels_per_task])
+                 for i in range(0, len(pixels), self.pixels_per_task)]
+        nodes = [gbuffer.drop_nodes(self.nodes, affected)]
+        escapes = [gbuffer.drop_nodes(self.escapes, affected)]
+        touched = [gbuffer.drop_nodes(self.touched, affected)]
+        self.progress.start('objects', len(tasks), len(pixels), self.options['width'], self.options['height'])
+        for task_pixels, colors, buffers, task_nodes, task_escapes, task_touched, counts in self.run_tasks(
+                retrace_pixels, tasks, cancel):
+            rows, cols = [list(x) for x in zip(*task_pixels)]
+            self.img[rows, cols] = colors
+            for name, values in buffers.items():
+                self.buffers[name][rows, cols] = values[0]
+            nodes.append(task_nodes)
+            escapes.append(task_escapes)
+            touched.append(task_touched)
+            self.progress.tile_done(len(task_pixels), counts['rays'])
+        self.nodes = gbuffer.concatenate_nodes(nodes)
+        self.escapes = gbuffer.concatenate_nodes(escapes, gbuffer.empty_escapes)
+        self.touched = gbuffer.concatenate_nodes(touched, gbuffer.empty_touched)
+        # the changed pixels are scattered, show them as one image
+        self.progress.add_tile(0, 0, self.img.copy())
+        return len(pixels)
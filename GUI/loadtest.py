@@ -0,0 +1,390 @@
+"""
+Load test of the GUI server.
+
+Runs --users virtual users against a running app.py, each with a session of
+its own (cookies), doing what a browser does: post a scene to /ObjectFeature
+as the form does, load /Figure, render it with /Render as the figure page does
+and fetch the image. Then again with the scene edited (an object's colour, so
+only its pixels are re-traced) or, one time in --new-scene, moved around (a
+full render), until --duration seconds have passed:
+
+    python app.py &
+    python loadtest.py --users 8 --duration 120 --server-pid $! --report load.json
+
+Every request's latency and status is recorded. Every --interval seconds the
+CPU and memory of the server and its worker processes are sampled (from
+/proc, with --server-pid, Linux only), and the render queue and workers from
+its /metrics. The report gives the latency percentiles, error rate and
+throughput of each kind of request and the samples over time; --report also
+writes it, with every request, as json.
+
+A request that cannot connect, times out or answers an error status is an
+error; errors are also counted by status, so a server turning renders away
+(503) or superseding them (409) shows as such.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+try:
+    from urllib.request import build_opener, HTTPCookieProcessor, Request
+    from urllib.error import HTTPError
+    from http.cookiejar import CookieJar
+except ImportError:
+    from urllib2 import build_opener, HTTPCookieProcessor, Request, HTTPError
+    from cookielib import CookieJar
+
+# object types of the form, in the order it lists them, and how many it takes
+form_objects = [('sphere', 'Sphere'), ('cube', 'Cube'), ('tetrahedron', 'Tetrahedron'),
+                ('cylinder', 'Cylinder'), ('cone', 'Cone')]
+form_max_objects = 5
+
+# the requests of one round of a virtual user, in order
+request_kinds = ('ObjectFeature', 'Figure', 'Render', 'image')
+
+percentiles = (50, 90, 95, 99)
+
+# columns of the server samples in the report, and their headings
+sample_columns = [('cpu_percent', 'cpu %'), ('rss_bytes', 'memory'), ('processes', 'processes'),
+                  ('render_queue_running', 'rendering'), ('render_queue_waiting', 'waiting'),
+                  ('workers_busy', 'busy workers'), ('rays_per_second', 'rays/s')]
+
+
+def put_vector(form, names, values, scale=1.0):
+    for name, value in zip(names, values):
+        form[name] = str(value * scale)
+
+
+# the /ObjectFeature json of scene (a dict in the format of data.json): its
+# plane, camera and light and its first form_max_objects objects, as the
+# form's strings
+def object_feature_form(scene):
+    plane = scene['plane'][0]
+    form = {'Plane_Transparency': str(plane['transparency_level'])}
+    put_vector(form, ['Plane_Position_X', 'Plane_Position_Y', 'Plane_Position_Z'], plane['position'])
+    put_vector(form, ['Plane_Normal_X', 'Plane_Normal_Y', 'Plane_Normal_Z'], plane['normal'])
+    put_vector(form, ['Camera_C_X', 'Camera_C_Y', 'Camera_C_Z'], scene['camera_position'])
+    put_vector(form, ['Camera_L_X', 'Camera_L_Y', 'Camera_L_Z'], scene['camera_point_to'])
+    put_vector(form, ['Light_X', 'Light_Y', 'Light_Z'], scene['light'])
+
+    objects = [(name, obj) for object_type, name in form_objects for obj in scene.get(object_type) or []]
+    objects = objects[:form_max_objects]
+    for n, (name, obj) in enumerate(objects, 1):
+        form['Object%d' % n] = name
+        form['Transparency%d' % n] = str(obj['transparency_level'])
+        put_vector(form, ['%s_%s%d' % (name, axis, n) for axis in 'xyz'], obj['position'])
+        put_vector(form, ['%s_%s%d' % (name, channel, n) for channel in ('cr', 'cg', 'cb')], obj['color'], 255)
+        if name == 'Sphere':
+            form['Sphere_r%d' % n] = str(obj['radius'])
+        else:
+            if name in ('Cube', 'Tetrahedron'):
+                form['%s_l%d' % (name, n)] = str(obj['length'])
+            else:
+                form['%s_h%d' % (name, n)] = str(obj['height'])
+                form['%s_r%d' % (name, n)] = str(obj['radius'])
+            put_vector(form, ['%s_r%s%d' % (name, axis, n) for axis in 'xyz'], obj['rotation_angle'])
+    form['object_quantity'] = len(objects)
+    return form
+
+
+# scene with one object's colour changed, or with every object moved if move
+def edit_scene(scene, rng, move=False):
+    scene = json.loads(json.dumps(scene))
+    objects = [obj for object_type, name in form_objects for obj in scene.get(object_type) or []]
+    objects = objects[:form_max_objects]
+    if move:
+        for obj in objects:
+            obj['position'] = [x + rng.uniform(-0.1, 0.1) for x in obj['position']]
+    elif objects:
+        rng.choice(objects)['color'] = [round(rng.random(), 3) for i in range(3)]
+    return scene
+
+
+class request_log():
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def add(self, kind, started, latency, status, error=None):
+        with self.lock:
+            self.records.append({'kind': kind, 'time': started - self.start, 'latency': latency,
+                                 'status': status, 'error': error})
+
+
+# one browser: a cookie jar and the requests of the figure page
+class virtual_user():
+
+    def __init__(self, base_url, log, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.log = log
+        self.timeout = timeout
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+
+    # the body of a request, None if it failed or the body does not hold
+    # expect (logged either way)
+    def request(self, kind, path, data=None, content_type=None, expect=None):
+        headers = {'Content-Type': content_type} if content_type else {}
+        request = Request(self.base_url + path, data, headers)
+        started = time.time()
+        status, error, body = None, None, None
+        try:
+            response = self.opener.open(request, timeout=self.timeout)
+            status = response.getcode()
+            body = response.read()
+            if expect is not None and expect not in body:
+                error, body = 'unexpected reply: %s' % body[:200].decode('utf-8', 'replace'), None
+        except HTTPError as e:
+            status, error = e.code, e.read()[:200].decode('utf-8', 'replace')
+        except Exception as e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+        self.log.add(kind, started, time.time() - started, status, error)
+        return body
+
+    # one round: form, figure page, render and image. Returns whether the
+    # image came.
+    def round(self, scene):
+        if self.request('ObjectFeature', '/ObjectFeature', json.dumps(object_feature_form(scene)).encode('utf-8'),
+                        'application/json', b'successfully') is None:
+            return False
+        if self.request('Figure', '/Figure') is None:
+            return False
+        body = self.request('Render', '/Render', b'')
+        if body is None:
+            return False
+        return self.request('image', json.loads(body.decode('utf-8'))['image']) is not None
+
+
+# rounds of user until stop is set; after a failed one the user waits
+# retry_wait seconds, as someone trying again would, rather than flood a
+# server that is down
+def run_user(user, scene, rng, args, stop, retry_wait=1.0):
+    new = True
+    while not stop.is_set():
+        if not new:
+            scene = edit_scene(scene, rng, move=rng.random() < args.new_scene)
+        new = False
+        if not user.round(scene):
+            stop.wait(retry_wait)
+        elif args.think:
+            stop.wait(rng.expovariate(1.0 / args.think))
+
+
+# processes of the process tree under pid, from /proc
+def process_tree(pid):
+    children = {}
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open('/proc/%s/stat' % name) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except (IOError, OSError):
+                continue
+            children.setdefault(int(fields[1]), []).append(int(name))
+    tree, todo = [], [pid]
+    while todo:
+        p = todo.pop()
+        tree.append(p)
+        todo.extend(children.get(p, []))
+    return tree
+
+
+# cpu seconds used and resident bytes of the processes, from /proc
+def process_usage(pids):
+    ticks = os.sysconf('SC_CLK_TCK')
+    page = os.sysconf('SC_PAGE_SIZE')
+    cpu, rss = 0.0, 0
+    for pid in pids:
+        try:
+            with open('/proc/%d/stat' % pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError):
+            continue
+        # utime and stime are fields 14 and 15 of stat, rss 24
+        cpu += (int(fields[11]) + int(fields[12])) / float(ticks)
+        rss += int(fields[21]) * page
+    return cpu, rss
+
+
+# the unlabelled samples of a Prometheus text page, by name
+def parse_metrics(text):
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#') and '{' not in line:
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+# samples the server every interval seconds until stop is set
+def sample_server(base_url, server_pid, interval, samples, stop, log):
+    opener = build_opener()
+    last = None
+    while True:
+        sample = {'time': time.time() - log.start}
+        if server_pid:
+            pids = process_tree(server_pid)
+            cpu, rss = process_usage(pids)
+            now = time.time()
+            if last is not None:
+                sample['cpu_percent'] = 100.0 * (cpu - last[0]) / (now - last[1])
+            sample['processes'] = len(pids)
+            sample['rss_bytes'] = rss
+            last = (cpu, now)
+        try:
+            metrics = parse_metrics(opener.open(base_url.rstrip('/') + '/metrics', timeout=5).read().decode('utf-8'))
+            for name in ('raytracer_render_queue_running', 'raytracer_render_queue_waiting',
+                         'raytracer_workers_busy', 'raytracer_rays_per_second'):
+                if name in metrics:
+                    sample[name.replace('raytracer_', '')] = metrics[name]
+        except Exception:
+            pass
+        samples.append(sample)
+        if stop.wait(interval):
+            return
+
+
+# the q-th percentile of values, interpolated between the nearest two as
+# numpy.percentile does
+def percentile(values, q):
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100.0
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+# latency percentiles, error rate and throughput of each kind of request
+def summarize(records, duration):
+    summary = {}
+    for kind in request_kinds:
+        kind_records = [record for record in records if record['kind'] == kind]
+        if not kind_records:
+            continue
+        ok = [record['latency'] for record in kind_records if record['error'] is None]
+        errors = {}
+        for record in kind_records:
+            if record['error'] is not None:
+                status = str(record['status'] or 'no response')
+                errors[status] = errors.get(status, 0) + 1
+        entry = {'requests': len(kind_records), 'errors': sum(errors.values()), 'errors_by_status': errors,
+                 'error_rate': float(sum(errors.values())) / len(kind_records),
+                 'per_second': len(ok) / duration}
+        if ok:
+            for p in percentiles:
+                entry['p%d' % p] = percentile(ok, p)
+            entry['mean'] = sum(ok) / len(ok)
+            entry['max'] = max(ok)
+        summary[kind] = entry
+    return summary
+
+
+def format_report(args, summary, samples, duration):
+    lines = ['%d users for %.0f s against %s' % (args.users, duration, args.url), '']
+    header = '%-14s %8s %7s' % ('request', 'count', 'errors') + ''.join('%9s' % ('p%d' % p) for p in percentiles) + \
+        '%9s %8s' % ('max', 'per s')
+    lines.append(header)
+    for kind in request_kinds:
+        if kind not in summary:
+            continue
+        entry = summary[kind]
+        line = '%-14s %8d %6.1f%%' % (kind, entry['requests'], 100 * entry['error_rate'])
+        line += ''.join('%9s' % ('%.3f' % entry['p%d' % p] if 'p%d' % p in entry else '-') for p in percentiles)
+        line += '%9s %8.2f' % ('%.3f' % entry['max'] if 'max' in entry else '-', entry['per_second'])
+        lines.append(line)
+        if entry['errors']:
+            lines.append('%-14s errors: %s' % ('', ', '.join('%s x%d' % (status, count)
+                                                             for status, count in sorted(entry['errors_by_status'].items()))))
+    lines.append('(latencies in seconds)')
+    columns = [(name, heading) for name, heading in sample_columns if any(name in sample for sample in samples)]
+    if columns:
+        lines.append('')
+        lines.append('%8s' % 'time' + ''.join('%14s' % heading for name, heading in columns))
+        for sample in samples:
+            line = '%8.1f' % sample['time']
+            for name, heading in columns:
+                value = sample.get(name)
+                if value is None:
+                    line += '%14s' % '-'
+                elif name == 'rss_bytes':
+                    line += '%12.1fMB' % (value / 1e6)
+                else:
+                    line += '%14.1f' % value
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Load test of the GUI server (app.py).')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='server address (default %(default)s)')
+    parser.add_argument('--users', type=int, default=4, help='virtual users at once (default %(default)s)')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run (default %(default)s)')
+    parser.add_argument('--ramp-up', type=float, default=0, help='seconds over which the users start')
+    parser.add_argument('--scene', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data.json'),
+                        help='scene json the users start from, its first %d objects (default data.json)'
+                        % form_max_objects)
+    parser.add_argument('--new-scene', type=float, default=0.3,
+                        help='share of the rounds that move the objects rather than recolour one (default %(default)s)')
+    parser.add_argument('--think', type=float, default=0,
+                        help='mean seconds a user waits between rounds (default %(default)s)')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds before a request fails (default %(default)s)')
+    parser.add_argument('--server-pid', type=int, help='pid of app.py, to sample its CPU and memory')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between server samples (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the scene edits')
+    parser.add_argument('--report', help='also write the report and every request to this json file')
+    args = parser.parse_args(argv)
+    if args.users < 1 or args.duration <= 0 or args.interval <= 0:
+        parser.error('--users, --duration and --interval must be positive')
+    if not 0 <= args.new_scene <= 1:
+        parser.error('--new-scene must be from 0 to 1')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    with open(args.scene) as f:
+        scene = json.load(f)
+
+    log = request_log()
+    stop = threading.Event()
+    samples = []
+    sampler = threading.Thread(target=sample_server, args=(args.url, args.server_pid, args.interval, samples, stop, log))
+    sampler.daemon = True
+    sampler.start()
+
+    threads = []
+    for n in range(args.users):
+        user = virtual_user(args.url, log, args.timeout)
+        thread = threading.Thread(target=run_user, args=(user, scene, random.Random(args.seed + n), args, stop))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+        if args.ramp_up and n + 1 < args.users:
+            time.sleep(args.ramp_up / args.users)
+    stop.wait(max(0, args.duration - (time.time() - log.start)))
+    stop.set()
+    # the rounds running finish, within --timeout
+    for thread in threads:
+        thread.join()
+    sampler.join()
+    duration = time.time() - log.start
+
+    with log.lock:
+        records = list(log.records)
+    summary = summarize(records, duration)
+    print(format_report(args, summary, samples, duration))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'users': args.users, 'duration': duration, 'url': args.url, 'summary': summary,
+                       'samples': samples, 'requests': records}, f, indent=1, sort_keys=True)
+    return 0 if records else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""
+Metrics of the render service, in the Prometheus text format.
+
+Counters and histograms are updated by the render pipeline as renders finish
+(see incremental_renderer), gauges are read when the metrics are scraped:
+
+    raytracer_renders_total{kind="full",outcome="done"} 12
+    raytracer_render_duration_seconds_bucket{kind="full",resolution="512x512",le="5"} 9
+    raytracer_rays_total 48213377
+    raytracer_render_queue_waiting 1
+    raytracer_workers_busy 4
+
+kind is what the render had to do (full, objects, lighting or none, see
+incremental.scene_changes) and outcome how it ended (done, cancelled or
+error). Rates are left to the monitoring: rays per second over a window is
+rate(raytracer_rays_total[1m]), the compiled scene cache hit rate
+rate(raytracer_scene_cache_total{result="hit"}[5m]) over the sum of both
+results.
+"""
+
+import math
+import threading
+from collections import OrderedDict
+
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+# render durations, seconds
+duration_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and math.isnan(value):
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in zip(names, values))
+
+
+class metric():
+
+    def __init__(self, kind, name, help_text, label_names=()):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def label_values(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError('%s takes the labels %s' % (self.name, ', '.join(self.label_names)))
+        return tuple(labels[name] for name in self.label_names)
+
+    def header(self):
+        return ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+
+    def lines(self):
+        with self.lock:
+            return self.header() + ['%s%s %s' % (self.name, format_labels(self.label_names, values), format_value(value))
+                                    for values, value in self.values.items()]
+
+
+class counter(metric):
+
+    def __init__(self, name, help_text, label_names=()):
+        metric.__init__(self, 'counter', name, help_text, label_names)
+
+    def inc(self, amount=1, **labels):
+        values = self.label_values(labels)
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+
+class histogram(metric):
+
+    def __init__(self, name, help_text, label_names=(), buckets=duration_buckets):
+        metric.__init__(self, 'histogram', name, help_text, label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        values = self.label_values(labels)
+        with self.lock:
+            counts, total = self.values.get(values, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[values] = (counts, total + value)
+
+    def lines(self):
+        lines = self.header()
+        names = self.label_names + ('le',)
+        with self.lock:
+            for values, (counts, total) in self.values.items():
+                for bound, count in zip(self.buckets, counts):
+                    lines.append('%s_bucket%s %d' % (self.name, format_labels(names, values + (format_value(bound),)),
+                                                     count))
+                labels = format_labels(self.label_names, values)
+                lines.append('%s_sum%s %s' % (self.name, labels, format_value(total)))
+                lines.append('%s_count%s %d' % (self.name, labels, counts[-1]))
+        return lines
+
+
+# a value read when the metrics are scraped: function returns a number, or a
+# list of (label values, number)
+class gauge(metric):
+
+    def __init__(self, name, help_text, function, label_names=(), kind='gauge'):
+        metric.__init__(self, kind, name, help_text, label_names)
+        self.function = function
+
+    def lines(self):
+        value = self.function()
+        samples = value if isinstance(value, list) else [((), value)]
+        return self.header() + ['%s%s %s' % (self.name, format_labels(self.label_names, values), format_value(value))
+                                for values, value in samples]
+
+
+class registry():
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def add(self, item):
+        self.metrics[item.name] = item
+        return item
+
+    def counter(self, name, help_text, label_names=()):
+        return self.add(counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=duration_buckets):
+        return self.add(histogram(name, help_text, label_names, buckets))
+
+    def gauge(self, name, help_text, function, label_names=()):
+        return self.add(gauge(name, help_text, function, label_names))
+
+    # a counter kept by someone else (a total read when scraped)
+    def counter_function(self, name, help_text, function, label_names=()):
+        return self.add(gauge(name, help_text, function, label_names, kind='counter'))
+
+    def exposition(self):
+        lines = []
+        for item in self.metrics.values():
+            lines.extend(item.lines())
+        return '\n'.join(lines) + '\n'
+
+
+# the metrics the render pipeline updates itself; incremental_renderer calls
+# render_finished once per render
+class render_metrics(registry):
+
+    def __init__(self):
+        registry.__init__(self)
+        self.renders = self.counter('raytracer_renders_total', 'Renders finished, by what they did and how they ended.',
+                                    ('kind', 'outcome'))
+        self.durations = self.histogram('raytracer_render_duration_seconds',
+                                        'Time from the start of a render to its image, of the renders done.',
+                                        ('kind', 'resolution'))
+        self.pixels = self.counter('raytracer_pixels_total',
+                                   'Pixels of the finished renders, traced or kept from the image before.',
+                                   ('source',))
+        self.rays = self.counter('raytracer_rays_total', 'Camera, secondary and shadow rays traced by the workers.')
+        self.scene_cache = self.counter('raytracer_scene_cache_total',
+                                        'Compiled scene lookups of the worker tasks, by result.', ('result',))
+
+    # a render of kind of a width x height image ended with outcome ('done',
+    # 'cancelled' or 'error') after seconds, with the pixels traced and the
+    # worker counts (see incremental.worker_counts) of its tasks
+    def render_finished(self, kind, width, height, outcome, seconds, traced, counts):
+        self.renders.inc(kind=kind, outcome=outcome)
+        self.rays.inc(counts.get('rays', 0))
+        self.scene_cache.inc(counts.get('scene_hits', 0), result='hit')
+        self.scene_cache.inc(counts.get('scene_misses', 0), result='miss')
+        if outcome != 'done':
+            return
+        self.durations.observe(seconds, kind=kind, resolution='%dx%d' % (width, height))
+        self.pixels.inc(traced, source='traced')
+        self.pixels.inc(max(width * height - traced, 0), source='reused')
@@ -0,0 +1,269 @@
+"""
+Low latency previews, for moving the camera.
+
+A preview traces the primary rays of a small image only, in one vectorized
+pass over its pixels: depth 1 (no reflected or refracted rays) and no shadows,
+so a pixel is the direct light at what its primary ray hits, shaded as
+raytracing.trace_ray shades it before its shadow rays. Spheres and planes are
+intersected with every ray at once, and so are the triangles of tetrahedra and
+cubes, but only the rays through an object's bounding sphere that may still hit
+it before anything found so far are tried; cylinders and cones take those rays
+one by one with their own intersect. A preview shows the geometry of the full
+render exactly.
+
+Previews run in a worker process of their own (preview_worker), which stays
+up between previews and keeps the scenes it has compiled (render.compile_scene),
+so a new camera costs the camera and the trace of the small image only, and
+previews never wait behind the tiles of full renders in the render pool.
+"""
+
+import multiprocessing as mp
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import gbuffer
+import image_output
+import raytracing
+import render
+
+# preview size by default, and at most
+default_width = 160
+default_height = 120
+max_width = 320
+max_height = 240
+
+
+# render options of a width x height preview, from camera_position towards
+# camera_point_to (the scene's camera if None)
+def preview_options(width=default_width, height=default_height, camera_position=None, camera_point_to=None):
+    options = render.make_options(width=width, height=height, depth=1, tile=max(width, height))
+    if camera_position is not None:
+        options['camera_position'] = list(camera_position)
+    if camera_point_to is not None:
+        options['camera_point_to'] = list(camera_point_to)
+    return options
+
+
+# distance along each ray (origin, D) to the sphere, inf where it misses. From
+# inside the sphere this is where the ray leaves it, as raytracing.intersect_sphere.
+def sphere_distances(origin, D, centre, radius):
+    OS = origin - centre
+    b = np.dot(D, OS)
+    disc = b * b - (np.dot(OS, OS) - radius * radius)
+    sqrt_disc = np.sqrt(np.maximum(disc, 0))
+    t0, t1 = -b - sqrt_disc, -b + sqrt_disc
+    return np.where((disc > 0) & (t1 >= 0), np.where(t0 >= 0, t0, t1), np.inf)
+
+
+# nearest distance along each ray at which it may be inside the sphere, inf
+# where it misses
+def sphere_entries(origin, D, centre, radius):
+    OS = origin - centre
+    b = np.dot(D, OS)
+    disc = b * b - (np.dot(OS, OS) - radius * radius)
+    sqrt_disc = np.sqrt(np.maximum(disc, 0))
+    return np.where((disc > 0) & (-b + sqrt_disc >= 0), np.maximum(-b - sqrt_disc, 0), np.inf)
+
+
+def plane_distances(origin, D, obj):
+    denom = np.dot(D, obj.normal_vector)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = np.dot(obj.point - origin, obj.normal_vector) / denom
+    return np.where((np.abs(denom) >= raytracing.parallel_epsilon) & (d >= 0), d, np.inf)
+
+
+# triangle_plane.intersect of every ray (origin, D) at once
+def triangle_distances(origin, D, triangle):
+    denom = np.dot(D, triangle.normal_vector)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = np.dot(triangle.point_1 - origin, triangle.normal_vector) / denom
+    d = np.where((np.abs(denom) >= raytracing.parallel_epsilon) & (d >= 0), d, np.inf)
+    # raytracing.PointinTriangle of the points on the plane
+    on = np.nonzero(d < np.inf)[0]
+    v0 = triangle.point_3 - triangle.point_1
+    v1 = triangle.point_2 - triangle.point_1
+    v2 = origin + D[on] * d[on][:, np.newaxis] - triangle.point_1
+    dot00, dot01, dot11 = np.dot(v0, v0), np.dot(v0, v1), np.dot(v1, v1)
+    dot02, dot12 = np.dot(v2, v0), np.dot(v2, v1)
+    inverDeno = 1.0 / ((dot00 * dot11) - (dot01 * dot01))
+    u = ((dot11 * dot02) - (dot01 * dot12)) * inverDeno
+    v = ((dot00 * dot12) - (dot01 * dot02)) * inverDeno
+    inside = (u >= 0) & (u <= 1) & (v >= 0) & (v <= 1) & (u + v <= 1)
+    d[on[~inside]] = np.inf
+    return d
+
+
+# whether obj is intersected as its triangles (see raytracing.cube.intersect)
+def is_triangle_set(obj):
+    return obj.type == 'tetrahedron' or (obj.type == 'cube' and not raytracing.object_space)
+
+
+# getNormalVector of a tetrahedron or cube at every point M: the normal of
+# the first of its triangles M is on
+def triangle_set_normals(obj, M):
+    N = np.full(M.shape, np.nan)
+    for triangle in obj.triangle_planes:
+        on = np.isnan(N[:, 0]) & (np.abs(np.dot(M - triangle.point_1, triangle.normal_vector)) < raytracing.on_plane_epsilon)
+        N[on] = triangle.normal_vector
+    return N
+
+
+# plane.getColor of every point M of the plane
+def plane_colors(obj, M):
+    if obj.color_type == 1:
+        return np.tile(obj.color_1, (len(M), 1))
+    PM = obj.point - M
+    d_to_x = np.linalg.norm(PM - np.dot(PM, obj.x_coordinate)[:, np.newaxis] * obj.x_coordinate, axis=1)
+    d_to_z = np.linalg.norm(PM - np.dot(PM, obj.z_coordinate)[:, np.newaxis] * obj.z_coordinate, axis=1)
+    same = d_to_x.astype(int) % 2 == (d_to_z * 2).astype(int) % 2
+    return np.where(same[:, np.newaxis], obj.color_1, obj.color_2)
+
+
+# the object index (-1 for none) and distance of the first hit of each ray
+# (origin, D)
+def first_hits(origin, D, scene):
+    t = np.full(len(D), np.inf)
+    index = np.full(len(D), -1, dtype=int)
+    # the exact ones first, nearer solids next, so the bounding spheres of the
+    # rest rule out as many rays as they can
+    exact = [k for k, obj in enumerate(scene) if obj.type in ('sphere', 'plane')]
+    solids = sorted((k for k, obj in enumerate(scene) if obj.type not in ('sphere', 'plane')),
+                    key=lambda k: np.linalg.norm(scene[k].position - origin))
+    for k in exact + solids:
+        obj = scene[k]
+        if obj.type == 'sphere':
+            t_obj = sphere_distances(origin, D, obj.position, obj.radius)
+        elif obj.type == 'plane':
+            t_obj = plane_distances(origin, D, obj)
+        else:
+            t_obj = np.full(len(D), np.inf)
+            candidates = np.nonzero(sphere_entries(origin, D, obj.position, obj.bounding_radius) < t)[0]
+            if is_triangle_set(obj):
+                for triangle in obj.triangle_planes:
+                    t_obj[candidates] = np.minimum(t_obj[candidates], triangle_distances(origin, D[candidates], triangle))
+            else:
+                for n in candidates:
+                    t_obj[n] = obj.intersect(raytracing.ray(origin, D[n]))
+        nearer = t_obj < t
+        t[nearer] = t_obj[nearer]
+        index[nearer] = k
+    return index, t
+
+
+# direct light at every point M (normal N) seen from origin, without shadows:
+# the single light as gbuffer.direct_light, plus the light list as
+# raytracing.light_list_shading
+def shade(M, N, color, origin, lighting):
+    col = gbuffer.direct_light(M, N, color, origin, lighting)
+    if lighting['lights'] is None:
+        return col
+    toO = gbuffer.normalize_rows(origin - M)
+    for light in lighting['lights'].lights:
+        if light['range'] == 0:
+            continue
+        toL = light['position'] - M
+        distance2 = np.sum(toL * toL, axis=1)
+        toL = toL / np.sqrt(distance2)[:, np.newaxis]
+        diffuse = np.maximum(np.sum(N * toL, axis=1), 0)
+        specular = np.maximum(np.sum(N * gbuffer.normalize_rows(toL + toO), axis=1), 0) ** lighting['specular_k']
+        light_col = light['color'] * (raytracing.diffuse_c * diffuse[:, np.newaxis] * color +
+                                      raytracing.specular_c * specular[:, np.newaxis])
+        if light['range'] < np.inf:
+            falloff = np.where(distance2 < light['range'] ** 2, (1 - distance2 / light['range'] ** 2) ** 2, 0)
+            light_col *= falloff[:, np.newaxis]
+        col += light_col
+    return col
+
+
+# the width x height preview image of scene from camera_seeting
+def preview_image(camera_seeting, scene, lighting, width, height):
+    origin = camera_seeting.position
+    D = gbuffer.primary_directions(camera_seeting, width, height).reshape(-1, 3)
+    index, t = first_hits(origin, D, scene)
+    img = np.zeros((len(D), 3), dtype=raytracing.dtype)
+
+    hit = np.nonzero(index >= 0)[0]
+    M = origin + D[hit] * t[hit][:, np.newaxis]
+    N = np.zeros_like(M)
+    color = np.zeros_like(M)
+    for k in np.unique(index[hit]):
+        obj = scene[k]
+        on = index[hit] == k
+        if obj.type == 'sphere':
+            N[on] = gbuffer.normalize_rows(M[on] - obj.position)
+        elif obj.type == 'plane':
+            N[on] = obj.normal_vector
+        elif is_triangle_set(obj):
+            N[on] = triangle_set_normals(obj, M[on])
+        else:
+            N[on] = [obj.getNormalVector(point) for point in M[on]]
+        color[on] = plane_colors(obj, M[on]) if obj.type == 'plane' else obj.color
+
+    col = shade(M, N, color, origin, lighting)
+    # a primary ray starting inside an object sees no direct light there
+    col[np.sum(D[hit] * N, axis=1) >= 0] = 0
+    img[hit] = np.clip(col, 0, 1)
+    return img.reshape(height, width, 3)
+
+
+# worker task: (scene key, scene or None if compiled before, options)
+def preview_task(task):
+    key, scene_input, options = task
+    camera_seeting, scene, lighting = render.use_scene(key, scene_input, options)
+    return preview_image(camera_seeting, scene, lighting, options['width'], options['height'])
+
+
+class preview_worker():
+
+    def __init__(self):
+        self.pool = None
+        # keys of the scenes sent to the worker, oldest first, as many as it keeps
+        self.scenes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = mp.Pool(1)
+        return self.pool
+
+    def sent(self, key):
+        self.scenes.pop(key, None)
+        render.add_to_cache(self.scenes, key, True, render.compiled_scenes_max)
+
+    # compile scene_json (canonical json, see render.load_scene) in the worker
+    # before its first preview, without waiting
+    def preload(self, scene_json):
+        key = render.scene_key(scene_json)
+        with self.lock:
+            self.get_pool().apply_async(render.preload_scene, (key, scene_json, preview_options()))
+            self.sent(key)
+
+    # preview image of scene_json with options (see preview_options)
+    def render(self, scene_json, options):
+        key = render.scene_key(scene_json)
+        with self.lock:
+            pool = self.get_pool()
+            if key in self.scenes:
+                try:
+                    img = pool.apply(preview_task, ((key, None, options),))
+                    self.sent(key)
+                    return img
+                except KeyError:
+                    # the worker dropped it for newer scenes
+                    pass
+            img = pool.apply(preview_task, ((key, scene_json, options),))
+            self.sent(key)
+            return img
+
+    # render as png data
+    def render_png(self, scene_json, options):
+        return image_output.encode_image(self.render(scene_json, options))
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
@@ -0,0 +1,160 @@
+"""
+Progress of a render, for the GUI's event stream.
+
+A render_progress is updated by the process collecting a render's tiles, one
+call per finished tile (or group of re-traced pixels) with the pixels and rays
+the worker traced and the tile's image, and read from other threads:
+snapshot() gives tiles and pixels done, rays per second and the estimated time
+left, tiles_since() the finished tile images, and wait() blocks until the next
+update. event_stream turns that into server-sent events
+
+    event: progress
+    data: {"state": "rendering", "tiles_done": 12, "tiles": 64, "rays_per_second": 51234.5, "eta": 3.2, ...}
+
+    event: tile
+    data: {"row": 0, "col": 64, "width": 64, "height": 64, "png": "iVBORw0KGgo..."}
+
+so a page can paint the image as it comes, ending with a "done" or "error"
+event once the render finishes. Tiles are PNG encoded (base64) by the stream,
+for the pages that listen only. A comment line is sent as a heartbeat when
+nothing happens for a while, so a stalled render shows as no progress events
+over an open stream rather than as silence.
+"""
+
+import base64
+import json
+import threading
+import time
+
+import image_output
+
+
+class render_progress():
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+        self.state = 'idle'
+        self.kind = None
+        self.error = None
+        self.tiles = self.tiles_done = 0
+        self.pixels = self.pixels_done = 0
+        self.rays = 0
+        self.start_time = self.end_time = None
+        # image size and finished tiles (row, col, image) of the current render
+        self.render_id = 0
+        self.width = self.height = 0
+        self.finished_tiles = []
+
+    def update(self, **values):
+        with self.condition:
+            for name, value in values.items():
+                setattr(self, name, value)
+            self.version += 1
+            self.condition.notify_all()
+
+    # a render of kind ('full', 'objects', 'lighting') of a width x height
+    # image in tiles tasks over pixels pixels
+    def start(self, kind, tiles, pixels, width=0, height=0):
+        self.update(state='rendering', kind=kind, error=None, tiles=tiles, tiles_done=0, pixels=pixels,
+                    pixels_done=0, rays=0, start_time=time.time(), end_time=None, render_id=self.render_id + 1,
+                    width=width, height=height, finished_tiles=[])
+
+    # a task done; tile is its (row, col, image), if it is one piece of the image
+    def tile_done(self, pixels, rays, tile=None):
+        with self.condition:
+            self.tiles_done += 1
+            self.pixels_done += pixels
+            self.rays += rays
+            if tile is not None:
+                self.finished_tiles.append(tile)
+            self.version += 1
+            self.condition.notify_all()
+
+    # a piece of the image changed without a task of its own (the whole image
+    # after re-tracing scattered pixels)
+    def add_tile(self, row, col, img):
+        with self.condition:
+            self.finished_tiles.append((row, col, img))
+            self.version += 1
+            self.condition.notify_all()
+
+    # the tiles of render render_id finished after the first start of them
+    def tiles_since(self, render_id, start):
+        with self.condition:
+            if render_id != self.render_id:
+                return []
+            return self.finished_tiles[start:]
+
+    def finish(self, error=None):
+        self.update(state='error' if error else 'done', error=error, end_time=time.time())
+
+    def snapshot(self):
+        with self.condition:
+            now = self.end_time or time.time()
+            elapsed = now - self.start_time if self.start_time else 0.0
+            eta = None
+            if self.state == 'rendering' and self.pixels_done:
+                eta = elapsed * (self.pixels - self.pixels_done) / self.pixels_done
+            return {
+                'state': self.state, 'kind': self.kind, 'error': self.error,
+                'tiles_done': self.tiles_done, 'tiles': self.tiles,
+                'pixels_done': self.pixels_done, 'pixels': self.pixels,
+                'rays': self.rays, 'elapsed': elapsed,
+                'rays_per_second': self.rays / elapsed if elapsed > 0 else 0.0,
+                'eta': eta, 'version': self.version,
+                'render_id': self.render_id, 'width': self.width, 'height': self.height,
+            }
+
+    # wait up to timeout seconds for an update after version, returns the
+    # version now
+    def wait(self, version, timeout):
+        with self.condition:
+            if self.version == version:
+                self.condition.wait(timeout)
+            return self.version
+
+
+def format_event(event, data):
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data, sort_keys=True))
+
+
+def tile_event(row, col, img):
+    return format_event('tile', {'row': row, 'col': col, 'width': img.shape[1], 'height': img.shape[0],
+                                 'png': base64.b64encode(image_output.encode_image(img)).decode('ascii')})
+
+
+# server-sent events of progress: its state now (with the tiles finished so
+# far if a render is running), then every update and tile until the next
+# render to finish is done. Gives up after timeout seconds without any render
+# starting.
+def event_stream(progress, heartbeat=15.0, timeout=60.0):
+    snapshot = progress.snapshot()
+    version = snapshot['version']
+    yield format_event('progress', snapshot)
+    started = snapshot['state'] == 'rendering'
+    render_id = snapshot['render_id']
+    sent = 0 if started else len(progress.tiles_since(render_id, 0))
+    connected = time.time()
+    while True:
+        tiles = progress.tiles_since(render_id, sent)
+        for row, col, img in tiles:
+            yield tile_event(row, col, img)
+        sent += len(tiles)
+        if progress.wait(version, heartbeat) == version:
+            if not started and time.time() - connected > timeout:
+                return
+            yield ': heartbeat\n\n'
+            continue
+        started = True
+        snapshot = progress.snapshot()
+        version = snapshot['version']
+        if snapshot['render_id'] != render_id:
+            render_id, sent = snapshot['render_id'], 0
+        yield format_event('progress', snapshot)
+        if snapshot['state'] in ('done', 'error'):
+            tiles = progress.tiles_since(render_id, sent)
+            for row, col, img in tiles:
+                yield tile_event(row, col, img)
+            yield format_event(snapshot['state'], snapshot)
+            return
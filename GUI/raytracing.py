@@ -1,8 +1,9 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import multiprocessing as mp
 import json
 import math
+import random
+
+import transform
 
 class PositionType:
 	IN, OUT = 1, -1
@@ -10,36 +11,34 @@ class PositionType:
 class camera():
     
     def __init__(self, position, point_to):
-        self.position = np.array(position)
-        self.point_to = np.array(point_to)
+        self.position = vector(position)
+        self.point_to = vector(point_to)
         self.project_plane_normal = normalize(self.point_to - self.position)
         self.project_centre = self.position + self.project_plane_normal
         self.project_blocks = []
         self.x_project_size = 2.0
-        self.y_project_size = 2.0
+        # keep pixels square when the image is not
+        self.y_project_size = 2.0 * h / w
 
         self.rotation = self.findRotation()
         x = np.matmul(self.rotation,np.array([1,0,0]))
         y = np.matmul(self.rotation,np.array([0,1,0]))
-        self.x_coordinate_vector = np.array([x.item(0),x.item(1),x.item(2)])
-        self.y_coordinate_vector = np.array([y.item(0),y.item(1),y.item(2)])
+        self.x_coordinate_vector = vector([x.item(0),x.item(1),x.item(2)])
+        self.y_coordinate_vector = vector([y.item(0),y.item(1),y.item(2)])
 
         self.project_start = self.project_centre - self.x_project_size / 2.0 * self.x_coordinate_vector - self.y_project_size / 2.0 * self.y_coordinate_vector
 
         self.x_project_size_pre_pixel = self.x_project_size / w
-        self.y_project_size_pre_pixel = self.x_project_size / h
+        self.y_project_size_pre_pixel = self.y_project_size / h
 
-        x_project_size_pre_block = self.x_project_size / processes_divided
-        y_project_size_pre_block = self.y_project_size / processes_divided    
+        self.x_pixel_pre_block, self.y_pixel_pre_block = block_size()
 
-        self.x_pixel_pre_block = int(w / processes_divided)
-        self.y_pixel_pre_block = int(h / processes_divided)
-        
-        for i in range(processes_divided):
-            for j in range(processes_divided):
-                self.project_blocks.append(project_block(self.project_start + x_project_size_pre_block * i * self.x_coordinate_vector + y_project_size_pre_block * j * self.y_coordinate_vector,
-                    self.x_pixel_pre_block * i,
-                    self.y_pixel_pre_block * j))
+        for x_pixel_start, y_pixel_start, x_pixel_size, y_pixel_size in split_blocks():
+            self.project_blocks.append(project_block(self.project_start + x_pixel_start * self.x_project_size_pre_pixel * self.x_coordinate_vector + y_pixel_start * self.y_project_size_pre_pixel * self.y_coordinate_vector,
+                x_pixel_start,
+                y_pixel_start,
+                x_pixel_size,
+                y_pixel_size))
 
     def findRotation(self):
      
@@ -60,10 +59,38 @@ class camera():
 
 class project_block():
 
-    def __init__(self, start, x_pixel_start_index, y_pixel_start_index):
+    def __init__(self, start, x_pixel_start_index, y_pixel_start_index, x_pixel_size, y_pixel_size):
         self.start = start
         self.x_pixel_start_index = x_pixel_start_index
         self.y_pixel_start_index = y_pixel_start_index
+        self.x_pixel_size = x_pixel_size
+        self.y_pixel_size = y_pixel_size
+        # first image row covered by this block, the y axis points up the image
+        self.row = h - y_pixel_start_index - y_pixel_size
+        self.col = x_pixel_start_index
+
+# objects touched by the ray tree of one pixel (primary, reflected, refracted
+# and shadow rays), what the primary ray hit (object index, point, normal and
+# color), every hit of the ray tree as (object index, point, normal, color,
+# ray origin, share of the pixel color) and the rays of the tree that hit
+# nothing
+class ray_record():
+
+    def __init__(self):
+        self.objects = set()
+        self.object = None
+        self.hit = None
+        self.normal = None
+        self.color = None
+        self.nodes = []
+        self.escaped = []
+
+    def add_hit(self, obj_idx, M, N, color, origin, weight):
+        self.objects.add(obj_idx)
+        # the first hit recorded is the primary one
+        if self.object is None:
+            self.object, self.hit, self.normal, self.color = obj_idx, M, N, color
+        self.nodes.append((obj_idx, M, N, color, origin, weight))
 
 class ray():
 
@@ -71,7 +98,9 @@ class ray():
         self.origin = origin
         self.direction = direction
 
-    def trace_ray(self, scene):
+    def trace_ray(self, scene, record=None, pathLoss=1):
+        global rays_traced
+        rays_traced += 1
         # Find first point of intersection with the scene.
         t = np.inf
         for i, obj in enumerate(scene):
@@ -80,6 +109,8 @@ class ray():
                 t, obj_idx = t_obj, i
         # Return None if the ray does not intersect any object.
         if t == np.inf:
+            if record is not None:
+                record.escaped.append(self)
             return
         # Find the object.
         obj = scene[obj_idx]
@@ -93,43 +124,221 @@ class ray():
         else:
             color = obj.color
 
-        toL = normalize(L - M)
-        toO = normalize(self.origin - M)
+        if record is not None:
+            # only the outside of an object is lit
+            record.add_hit(obj_idx, M, N, color, self.origin, pathLoss if np.dot(self.direction, N) < 0 else 0.0)
+
+        if lights is not None:
+            return obj, M, N, light_list_shading(M, N, color, self.origin, obj_idx, scene, record)
+
         # Shadow: find if the point is shadowed or not.
-        transparent_ratio = 1.0
-        for k, obj_sh in enumerate(scene): 
-            if k != obj_idx:
-                if obj_sh.intersect(ray(M + N * .001, toL)) < np.inf:
-                    transparent_ratio *= obj_sh.simple_refractive
-
-        # Start computing the color.
-        col_ray = ambient
-        # Lambert shading (diffuse).
-        col_ray += diffuse_c * max(np.dot(N, toL), 0) * color
-        # Blinn-Phong shading (specular).
-        col_ray += specular_c * max(np.dot(N, normalize(toL + toO)), 0) ** specular_k * color_light
+        transparent_ratio = shadow_transmittance(M, N, obj_idx, scene, record)
+
+        col_ray = direct_light(M, N, color, self.origin)
         
         col_ray *= transparent_ratio ** 2
         
         return obj, M, N, col_ray
 
+# share of the light reaching M, from the objects between M and the light
+# (L, or lights.lights[light_index]). Looked up in shadow_cache when one is
+# set, unless the ray tree is recorded.
+def shadow_transmittance(M, N, obj_idx, scene, record=None, light_index=None):
+    global rays_traced
+    cache_key = None
+    if shadow_cache is not None and record is None:
+        cache_key = shadow_cache.key(M, N, obj_idx, light_index)
+        transparent_ratio = shadow_cache.lookup(cache_key)
+        if transparent_ratio is not None:
+            return transparent_ratio
+
+    rays_traced += 1
+    if light_index is None:
+        toL = normalize(L - M)
+    else:
+        toL = normalize(lights.lights[light_index]['position'] - M)
+    transparent_ratio = 1.0
+    for k, obj_sh in enumerate(scene): 
+        if k != obj_idx:
+            if obj_sh.intersect(ray(M + N * surface_bias, toL)) < np.inf:
+                transparent_ratio *= obj_sh.simple_refractive
+                if record is not None:
+                    record.objects.add(k)
+
+    if cache_key is not None:
+        shadow_cache.add(cache_key, transparent_ratio)
+    return transparent_ratio
+
+# transmittance towards each light over a spatial hash of surface points:
+# cubes of cell_size, per object, facing (dominant axis of the normal) and
+# light. A cell answers once it holds `samples` traced values at most `error`
+# apart; cells across a shadow edge disagree and keep being traced exactly.
+# Valid while the lights and the objects stay the same, set_light clears it
+# when a light moves.
+class visibility_cache():
+
+    def __init__(self, cell_size, error=0.05, samples=2):
+        self.cell_size = float(cell_size)
+        self.error = error
+        self.samples = samples
+        self.light = None
+        self.cells = {}
+        self.hits = 0
+        self.misses = 0
+
+    def set_light(self, light):
+        if self.light is None or not np.array_equal(self.light, light):
+            self.light = np.array(light, dtype=float)
+            self.cells = {}
+
+    def key(self, M, N, obj_idx, light_index=None):
+        x, y, z = M.tolist()
+        nx, ny, nz = N.tolist()
+        if abs(nx) >= abs(ny) and abs(nx) >= abs(nz):
+            facing = nx > 0
+        elif abs(ny) >= abs(nz):
+            facing = 2 + (ny > 0)
+        else:
+            facing = 4 + (nz > 0)
+        size = self.cell_size
+        return (obj_idx, facing, light_index, int(math.floor(x / size)), int(math.floor(y / size)), int(math.floor(z / size)))
+
+    def lookup(self, key):
+        values = self.cells.get(key)
+        if values is not None and len(values) >= self.samples and max(values) - min(values) <= self.error:
+            self.hits += 1
+            return sum(values) / len(values)
+        self.misses += 1
+        return None
+
+    def add(self, key, transparent_ratio):
+        values = self.cells.setdefault(key, [])
+        if len(values) < self.samples:
+            values.append(transparent_ratio)
+
+# the "lights" of a scene: point lights with a position, color (times
+# intensity) and an optional range past which they do not reach (a range of 0
+# reaches nothing). Lights with a range are binned over a grid of cells as large as the mean range, so a
+# point only looks at the lights whose range box covers its cell.
+class light_list():
+
+    max_cells_per_light = 4096
+
+    def __init__(self, lights):
+        self.lights = []
+        for light in lights:
+            self.lights.append({
+                'position': vector(light['position']),
+                'color': vector(light.get('color', [1., 1., 1.])) * float(light.get('intensity', 1.)),
+                'range': np.inf if light.get('range') is None else float(light['range']),
+            })
+        ranges = [light['range'] for light in self.lights if 0 < light['range'] < np.inf]
+        self.cell_size = float(np.mean(ranges)) if ranges else 1.
+        self.unbounded = []
+        self.grid = {}
+        for index, light in enumerate(self.lights):
+            if light['range'] == np.inf:
+                self.unbounded.append(index)
+                continue
+            if light['range'] == 0:
+                continue
+            low = np.floor((light['position'] - light['range']) / self.cell_size).astype(int)
+            high = np.floor((light['position'] + light['range']) / self.cell_size).astype(int)
+            if np.prod(high - low + 1) > self.max_cells_per_light:
+                self.unbounded.append(index)
+                continue
+            for x in range(low[0], high[0] + 1):
+                for y in range(low[1], high[1] + 1):
+                    for z in range(low[2], high[2] + 1):
+                        self.grid.setdefault((x, y, z), []).append(index)
+
+    def positions(self):
+        return np.array([light['position'] for light in self.lights])
+
+    # indices of the lights that may reach M
+    def near(self, M):
+        x, y, z = M.tolist()
+        size = self.cell_size
+        cell = (int(math.floor(x / size)), int(math.floor(y / size)), int(math.floor(z / size)))
+        return self.unbounded + self.grid.get(cell, [])
+
+# direct light at M from the single light L, ambient term and shadow as
+# without a list, plus the light list. Listed lights out of range or lighting
+# only the back of M are skipped before their shadow ray, and with
+# light_samples only that many of the rest are shadowed, picked in proportion
+# to their unshadowed light and weighted so the expected color stays the same.
+def light_list_shading(M, N, color, origin, obj_idx, scene, record=None):
+    toO = normalize(origin - M)
+    candidates = []
+    for index in lights.near(M):
+        light = lights.lights[index]
+        toL = light['position'] - M
+        distance2 = np.dot(toL, toL)
+        if distance2 >= light['range'] ** 2:
+            continue
+        toL = toL / np.sqrt(distance2)
+        diffuse = max(np.dot(N, toL), 0)
+        specular = max(np.dot(N, normalize(toL + toO)), 0) ** specular_k
+        if diffuse <= 0 and specular <= 0:
+            continue
+        col = light['color'] * (diffuse_c * diffuse * color + specular_c * specular)
+        if light['range'] < np.inf:
+            col = col * (1 - distance2 / light['range'] ** 2) ** 2
+        weight = np.sum(col)
+        if weight > 0:
+            candidates.append((index, col, weight))
+
+    if light_samples and len(candidates) > light_samples:
+        total = sum(weight for index, col, weight in candidates)
+        cumulative = np.cumsum([weight for index, col, weight in candidates])
+        sampled = []
+        for n in range(light_samples):
+            index, col, weight = candidates[min(np.searchsorted(cumulative, light_random.random() * total, 'right'), len(candidates) - 1)]
+            sampled.append((index, col * total / (light_samples * weight), weight))
+        candidates = sampled
+
+    col_ray = direct_light(M, N, color, origin) * shadow_transmittance(M, N, obj_idx, scene, record) ** 2
+    for index, col, weight in candidates:
+        col_ray += col * shadow_transmittance(M, N, obj_idx, scene, record, index) ** 2
+    return col_ray
+
+# positions of every light, to tell when a shadow cache is out of date
+def light_positions():
+    if lights is None:
+        return L
+    return np.vstack([L, lights.positions()])
+
+# light at M seen from origin, before shadows
+def direct_light(M, N, color, origin):
+    toL = normalize(L - M)
+    toO = normalize(origin - M)
+    # Start computing the color.
+    col_ray = ambient
+    # Lambert shading (diffuse).
+    col_ray += diffuse_c * max(np.dot(N, toL), 0) * color
+    # Blinn-Phong shading (specular).
+    col_ray += specular_c * max(np.dot(N, normalize(toL + toO)), 0) ** specular_k * color_light
+    return col_ray
+
 class plane():
 
     def __init__(self, point, normal_vector, transparency_level, color_type=0, color_1=np.ones(3), color_2=np.zeros(3)):
-        self.point = np.array(point)
-        self.normal_vector = np.array(normal_vector) / np.linalg.norm(np.array(normal_vector))
+        self.point = vector(point)
+        self.normal_vector = vector(normal_vector) / np.linalg.norm(vector(normal_vector))
         self.color_type = color_type
-        self.color_1 = np.array(color_1)
-        self.color_2 = np.array(color_2)
+        self.color_1 = vector(color_1)
+        self.color_2 = vector(color_2)
         self.rotation = self.findRotation()
         self.refractive_indices = getRefractiveIndices(transparency_level)
         self.simple_refractive = getSimpleRefractive(transparency_level)
         self.type = 'plane'
+        self.position = self.point
+        self.bounding_radius = np.inf
 
         x = np.matmul(self.rotation,np.array([1,0,0]))
         z = np.matmul(self.rotation,np.array([0,0,1]))
-        self.x_coordinate = np.array([x.item(0),x.item(1),x.item(2)])
-        self.z_coordinate = np.array([z.item(0),z.item(1),z.item(2)])
+        self.x_coordinate = vector([x.item(0),x.item(1),x.item(2)])
+        self.z_coordinate = vector([z.item(0),z.item(1),z.item(2)])
 
     def getColor(self,postion):
         
@@ -171,12 +380,13 @@ class plane():
 class sphere():
 
     def __init__(self, position, radius, color, transparency_level):
-        self.position = np.array(position)
+        self.position = vector(position)
         self.radius = radius
-        self.color = np.array(color)
+        self.color = vector(color)
         self.refractive_indices = getRefractiveIndices(transparency_level)
         self.simple_refractive = getSimpleRefractive(transparency_level)
         self.type = 'sphere'
+        self.bounding_radius = radius
 
     def intersect(self, ray):
         return intersect_sphere(ray, self.position, self.radius)
@@ -186,11 +396,13 @@ class sphere():
 
 class triangle_plane():
 
-    def __init__(self, point_1, point_2, point_3):
+    def __init__(self, point_1, point_2, point_3, normal_vector=None):
         self.point_1 = point_1
         self.point_2 = point_2
         self.point_3 = point_3
-        self.normal_vector = normalize(np.cross(point_2 - point_1, point_3 - point_1))
+        if normal_vector is None:
+            normal_vector = normalize(np.cross(point_2 - point_1, point_3 - point_1))
+        self.normal_vector = normal_vector
 
     def getReflectedNormalVector(self, raySource):
         if np.dot(self.point_1 - raySource, self.normal_vector) < 0:
@@ -206,7 +418,7 @@ class triangle_plane():
         return np.inf
 
     def check_on_plane(self, point):
-        if abs(np.dot(point - self.point_1, self.normal_vector)) < 0.00000000001:
+        if abs(np.dot(point - self.point_1, self.normal_vector)) < on_plane_epsilon:
             if PointinTriangle(self.point_1, self.point_2, self.point_3, point):
                 return True
 
@@ -214,29 +426,24 @@ class triangle_plane():
 
 class tetrahedron():
 
-    def __init__(self, position, length, rotation_angle, color, transparency_level):
+    def __init__(self, position, length, rotation_angle, color, transparency_level, placement=None, triangle_planes=None):
 
-        self.position = np.array(position)
+        self.position = vector(position)
         self.length = length * 1.0
         self.rotation_angle = np.array(rotation_angle)
+        self.placement = placement if placement is not None else transform.placement(position, rotation_angle)
         self.type = 'tetrahedron'
+        self.bounding_radius = np.sqrt(3.0/8) * self.length
         self.refractive_indices = getRefractiveIndices(transparency_level)
         self.simple_refractive = getSimpleRefractive(transparency_level)
-        self.color = np.array(color)
-
-        self.point_1 = self.position + rotation_vector(np.array([0, np.sqrt(3.0/8), 0]) * self.length, self.rotation_angle)
-        self.point_2 = self.position + rotation_vector(np.array([-1.0/2, -1.0/np.sqrt(24), 1.0/np.sqrt(12)]) * self.length, self.rotation_angle)
-        self.point_3 = self.position + rotation_vector(np.array([1.0/2, -1.0/np.sqrt(24), 1.0/np.sqrt(12)]) * self.length, self.rotation_angle)
-        self.point_4 = self.position + rotation_vector(np.array([0, -1.0/np.sqrt(24), -1.0/np.sqrt(3)]) * self.length, self.rotation_angle)
-
-        self.triangle_planes = [triangle_plane(self.point_1, self.point_2, self.point_3),
-                    triangle_plane(self.point_1, self.point_2, self.point_4),
-                    triangle_plane(self.point_1, self.point_3, self.point_4),
-                    triangle_plane(self.point_2, self.point_3, self.point_4)]
+        self.color = vector(color)
 
-        for i, plane in enumerate(self.triangle_planes):
-            if  np.dot(plane.point_1 - self.position, plane.normal_vector) < 0:
-                self.triangle_planes[i].normal_vector *=-1.0
+        if triangle_planes is None:
+            points = vector(self.placement.apply_points(tetrahedron_vertices * self.length))
+            triangle_planes = outward_triangle_planes(points[np.newaxis], tetrahedron_faces, self.position[np.newaxis])[0]
+        self.triangle_planes = triangle_planes
+        self.point_1, self.point_2, self.point_3 = triangle_planes[0].point_1, triangle_planes[0].point_2, triangle_planes[0].point_3
+        self.point_4 = triangle_planes[-1].point_3
 
     def intersect(self, ray):
         if intersect_sphere(ray, self.position, np.sqrt(3.0/8) * self.length) != np.inf:
@@ -246,63 +453,47 @@ class tetrahedron():
 
     def getNormalVector(self, intersected_point):
         for i, triangle_plane in enumerate(self.triangle_planes):
-            if abs(np.dot(intersected_point - triangle_plane.point_1, triangle_plane.normal_vector)) < 0.00000000001:
+            if abs(np.dot(intersected_point - triangle_plane.point_1, triangle_plane.normal_vector)) < on_plane_epsilon:
                 return triangle_plane.normal_vector
 
 
 class cube():
 
-    def __init__(self, position, length, rotation_angle, color, transparency_level):
-        self.position = np.array(position)
+    def __init__(self, position, length, rotation_angle, color, transparency_level, placement=None, triangle_planes=None):
+        self.position = vector(position)
         self.length = length * 1.0
         self.rotation_angle = np.array(rotation_angle)
-        self.color = np.array(color)
+        self.placement = placement if placement is not None else transform.placement(position, rotation_angle)
+        self.color = vector(color)
         self.refractive_indices = getRefractiveIndices(transparency_level)
         self.simple_refractive = getSimpleRefractive(transparency_level)
         self.type = 'cube'
+        self.bounding_radius = np.sqrt(3) * self.length / 2.0
 
-        square = [[], [], [], [], [], []]
-        self.triangle_planes = []
-
-        x_n_vector = rotation_vector(np.array([1.0, 0.0, 0.0]) * self.length / 2.0, self.rotation_angle)
-        y_n_vector = rotation_vector(np.array([0.0, 1.0, 0.0]) * self.length / 2.0, self.rotation_angle)
-        z_n_vector = rotation_vector(np.array([0.0, 0.0, 1.0]) * self.length / 2.0, self.rotation_angle)
-
-        # find 6 square plane of cube
-        for i, x in enumerate([x_n_vector, -1 * x_n_vector]):
-            for j, y in enumerate([y_n_vector, -1 * y_n_vector]):
-                for k, z in enumerate([z_n_vector, -1 * z_n_vector]):
-                    node = self.position + x + y + z
-                    if i == 0:
-                        square[0].append(node)
-                    if i == 1:
-                        square[1].append(node)
-                    if j == 0:
-                        square[2].append(node)
-                    if j == 1:
-                        square[3].append(node)
-                    if k == 0:
-                        square[4].append(node)
-                    if k == 1:
-                        square[5].append(node)
-
-        # split each square plane to triangle plane
-        for i, s in enumerate(square):
-            self.triangle_planes = self.triangle_planes + split_square_to_triangle(s)
-
-        for i, plane in enumerate(self.triangle_planes):
-            if  np.dot(plane.point_1 - self.position, plane.normal_vector) < 0:
-                self.triangle_planes[i].normal_vector *=-1.0
+        if triangle_planes is None:
+            points = vector(self.placement.apply_points(cube_vertices * self.length))
+            triangle_planes = outward_triangle_planes(points[np.newaxis], cube_faces, self.position[np.newaxis])[0]
+        self.triangle_planes = triangle_planes
 
     def intersect(self, ray):
         if intersect_sphere(ray, self.position, np.sqrt(3) * self.length / 2.0) != np.inf:
+            if object_space:
+                return intersect_box(self.placement.to_object_points(ray.origin),
+                    self.placement.to_object_vectors(ray.direction), self.length / 2.0)
             return intersect_TriangleSet(ray, self.triangle_planes)
         else:
             return np.inf
 
     def getNormalVector(self, intersected_point):
+        if object_space:
+            # the face whose axis the point is furthest along
+            local = self.placement.to_object_points(intersected_point)
+            axis = int(np.argmax(np.abs(local)))
+            normal = np.zeros(3)
+            normal[axis] = 1.0 if local[axis] > 0 else -1.0
+            return vector(self.placement.apply_vectors(normal))
         for i, triangle_plane in enumerate(self.triangle_planes):
-            if abs(np.dot(intersected_point - triangle_plane.point_1,triangle_plane.normal_vector)) < 0.00000000001:
+            if abs(np.dot(intersected_point - triangle_plane.point_1,triangle_plane.normal_vector)) < on_plane_epsilon:
                 return triangle_plane.normal_vector
 
 
@@ -315,7 +506,7 @@ class circle_plane():
 
     def check_on_plane(self, point):
 
-        if abs(np.dot(point - self.position, self.normal_vector)) < 0.00000000001:
+        if abs(np.dot(point - self.position, self.normal_vector)) < on_plane_epsilon:
             if (np.linalg.norm(point - self.position)) < self.radius:
                 return True
 
@@ -324,15 +515,17 @@ class circle_plane():
 
 class cylinder():
 
-    def __init__(self, position, height, radius, rotation_angle, color, transparency_level):
-        self.position = np.array(position)
+    def __init__(self, position, height, radius, rotation_angle, color, transparency_level, placement=None):
+        self.position = vector(position)
         self.height = height
         self.radius = radius
-        self.normal_vector = rotation_vector(np.array([0.0, 1.0, 0.0]), np.array(rotation_angle))
-        self.color = np.array(color)
+        self.placement = placement if placement is not None else transform.placement(position, rotation_angle)
+        self.normal_vector = vector(self.placement.apply_vectors(np.array([0.0, 1.0, 0.0])))
+        self.color = vector(color)
         self.refractive_indices = getRefractiveIndices(transparency_level)
         self.simple_refractive = getSimpleRefractive(transparency_level)
         self.type = 'cylinder'
+        self.bounding_radius = np.sqrt(radius ** 2 + (height / 2.0) ** 2)
 
         top_plane = circle_plane(self.position + self.normal_vector * (height / 2.0), radius, self.normal_vector)
         bottom_plane = circle_plane(self.position - self.normal_vector * (height / 2.0), radius, -1.0 * self.normal_vector)
@@ -386,16 +579,18 @@ class cylinder():
 
 class cone():
 
-    def __init__(self, position, height, radius, rotation_angle, color, transparency_level):
-        self.position = np.array(position)
+    def __init__(self, position, height, radius, rotation_angle, color, transparency_level, placement=None):
+        self.position = vector(position)
         self.height = height
         self.radius = radius
         self.angel = math.atan(radius / (height / 2.0))
-        self.normal_vector = rotation_vector(np.array([0.0, 1.0, 0.0]), np.array(rotation_angle))
-        self.color = np.array(color)
+        self.placement = placement if placement is not None else transform.placement(position, rotation_angle)
+        self.normal_vector = vector(self.placement.apply_vectors(np.array([0.0, 1.0, 0.0])))
+        self.color = vector(color)
         self.refractive_indices = getRefractiveIndices(transparency_level)
         self.simple_refractive = getSimpleRefractive(transparency_level)
         self.type = 'cone'
+        self.bounding_radius = np.sqrt(radius ** 2 + (height / 2.0) ** 2)
 
         top_plane = circle_plane(self.position + self.normal_vector * (height / 2.0), radius, self.normal_vector)
         bottom_plane = circle_plane(self.position - self.normal_vector * (height / 2.0), radius, -1 * self.normal_vector)
@@ -457,13 +652,17 @@ def normalize(x):
     x /= np.linalg.norm(x)
     return x
 
+# x as an array of the current precision
+def vector(x):
+    return np.array(x, dtype=dtype)
+
 
 def intersect_plane(ray, P, N):
     # Return the distance from O to the intersection of the ray (O, D) with the
     # plane (P, N), or +inf if there is no intersection.
     # O and P are 3D points, D and N (normal) are normalized vectors.
     denom = np.dot(ray.direction, N)
-    if np.abs(denom) < 1e-6:
+    if np.abs(denom) < parallel_epsilon:
         return np.inf
     d = np.dot(P - ray.origin, N) / denom
     if d < 0:
@@ -499,6 +698,27 @@ def intersect_TriangleSet(ray, triangle_planes):
     return dist
 
 
+def intersect_box(O, D, half):
+    # Return the distance from O to the box of half size half centred at the
+    # origin and aligned with the axes, or +inf if the ray (O, D) misses it.
+    # From inside the box this is the distance to where the ray leaves it.
+    t_near, t_far = -np.inf, np.inf
+    for o, d in zip(O.tolist(), D.tolist()):
+        if d == 0:
+            if o < -half or o > half:
+                return np.inf
+            continue
+        t0 = (-half - o) / d
+        t1 = (half - o) / d
+        if t0 > t1:
+            t0, t1 = t1, t0
+        t_near = max(t_near, t0)
+        t_far = min(t_far, t1)
+    if t_near > t_far or t_far < 0:
+        return np.inf
+    return t_near if t_near >= 0 else t_far
+
+
 def PointinTriangle(point_1, point_2, point_3, M):
     v0 = point_3 - point_1
     v1 = point_2 - point_1
@@ -527,17 +747,17 @@ def add_sphere(position, radius, color, transparency_level):
 def add_plane(position, normal, transparency_level):
     return plane(position, normal, transparency_level)
 
-def add_tetrahedron(position, length, rotation_angle, color, transparency_level):
-    return tetrahedron(position, length, rotation_angle, color, transparency_level)
+def add_tetrahedron(position, length, rotation_angle, color, transparency_level, placement=None, triangle_planes=None):
+    return tetrahedron(position, length, rotation_angle, color, transparency_level, placement, triangle_planes)
 
-def add_cube(position, length, rotation_angle, color, transparency_level):
-    return cube(position, length, rotation_angle, color, transparency_level)
+def add_cube(position, length, rotation_angle, color, transparency_level, placement=None, triangle_planes=None):
+    return cube(position, length, rotation_angle, color, transparency_level, placement, triangle_planes)
 
-def add_cylinder(poisition, height, radius, rotation_angle, color, transparency_level):
-    return cylinder(poisition, height, radius, rotation_angle, color, transparency_level)
+def add_cylinder(poisition, height, radius, rotation_angle, color, transparency_level, placement=None):
+    return cylinder(poisition, height, radius, rotation_angle, color, transparency_level, placement)
 
-def add_cone(poisition, height, radius, rotation_angle, color, transparency_level):
-    return cone(poisition, height, radius, rotation_angle, color, transparency_level)
+def add_cone(poisition, height, radius, rotation_angle, color, transparency_level, placement=None):
+    return cone(poisition, height, radius, rotation_angle, color, transparency_level, placement)
 
 # split square plane to two triangle plane
 def split_square_to_triangle(square_vertex):
@@ -566,53 +786,104 @@ def split_square_to_triangle(square_vertex):
 
     return [triangle_plane_1, triangle_plane_2]
 
+# corner indices of the two triangles split_square_to_triangle makes of the
+# square of the points at indices square
+def split_square_indices(points, square):
+    far = max(range(3), key=lambda i: np.linalg.norm(points[square[i]] - points[square[3]]))
+    return [square[:3], [square[i] for i in range(4) if i != far]]
+
+# corners of a tetrahedron of edge 1 around its centre, and its faces
+tetrahedron_vertices = np.array([[0, np.sqrt(3.0/8), 0],
+                                 [-1.0/2, -1.0/np.sqrt(24), 1.0/np.sqrt(12)],
+                                 [1.0/2, -1.0/np.sqrt(24), 1.0/np.sqrt(12)],
+                                 [0, -1.0/np.sqrt(24), -1.0/np.sqrt(3)]])
+tetrahedron_faces = np.array([[0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]])
+
+# corners of a cube of edge 1 around its centre (x, then y, then z from + to
+# -), and the two triangles of each of its 6 squares
+cube_vertices = np.array([[x, y, z] for x in (.5, -.5) for y in (.5, -.5) for z in (.5, -.5)])
+cube_faces = np.array([triangle for axis in range(3) for side in (.5, -.5)
+                       for triangle in split_square_indices(cube_vertices,
+                           [i for i in range(8) if cube_vertices[i][axis] == side])])
+
+# triangle planes of the faces (indices into points) of n solids of the same
+# shape, points (n, k, 3) around centres (n, 3), with their normals facing out
+def outward_triangle_planes(points, faces, centres):
+    corners = points[:, faces]
+    normals = np.cross(corners[:, :, 1] - corners[:, :, 0], corners[:, :, 2] - corners[:, :, 0])
+    normals /= np.linalg.norm(normals, axis=2)[:, :, np.newaxis]
+    normals[np.sum((corners[:, :, 0] - centres[:, np.newaxis]) * normals, axis=2) < 0] *= -1.0
+    return [[triangle_plane(corner[0], corner[1], corner[2], normal) for corner, normal in zip(solid_corners, solid_normals)]
+            for solid_corners, solid_normals in zip(corners, normals)]
+
+# placements and triangle planes of tetrahedrons or cubes (the columns of
+# object_columns), built for all of them at once
+def solid_faces(columns, vertices, faces):
+    placements = transform.placements(columns['position'], columns['rotation_angle'])
+    matrices = np.array([placement.matrix for placement in placements])
+    lengths = np.array(columns['length'], dtype=float)
+    points = vector(transform.transform_points(matrices, vertices[np.newaxis] * lengths[:, np.newaxis, np.newaxis]))
+    centres = vector(columns['position'])
+    return placements, outward_triangle_planes(points, faces, centres)
+
 # rotate a node base on given center node with specific x-axis, y-asix, z-axis
 # angle
 def rotation(node, r_centre, r_angle):
-    angle = r_angle * np.pi / 180.0
-    r_x = np.matrix([[1, 0, 0], [0, np.cos(angle[0]), np.sin(angle[0] * -1)], [0, np.sin(angle[0]), np.cos(angle[0])]])
-    r_y = np.matrix([[np.cos(angle[1]), 0, np.sin(angle[1])], [0, 1, 0], [np.sin(angle[1]) * -1, 0, np.cos(angle[1])]])
-    r_z = np.matrix([[np.cos(angle[2]), np.sin(angle[2]) * -1, 0], [np.sin(angle[2]), np.cos(angle[2]), 0], [0, 0, 1]])
-
-    tmp_node = node - r_centre
-    r_node = np.matmul(r_z, np.matmul(r_y, np.matmul(r_x, (np.matrix([[tmp_node[0]], [tmp_node[1]], [tmp_node[2]]])))))
-
-    return np.array([r_node.item(0), r_node.item(1), r_node.item(2)]) + r_centre
+    return np.dot(transform.rotation_matrix(r_angle), np.asarray(node) - r_centre) + r_centre
 
 
 def rotation_vector(vector, r_angle):
     return rotation(vector, np.array([0, 0, 0]), r_angle)
 
-#trace ray of pixel in given area
-def trace_ray_main(result_queue, project_block_index, scene_input):
-    img = np.zeros((h, w, 3))
-    camera_seeting, scene = analyse_input(scene_input)
-    current_project_block = camera_seeting.project_blocks[project_block_index]
+# trace every pixel of one block, returns the block as an image. If records is
+# given, records[row][col] is set to the ray_record of each pixel of the block.
+def trace_block(camera_seeting, current_project_block, scene, records=None):
+    img = np.zeros((current_project_block.y_pixel_size, current_project_block.x_pixel_size, 3), dtype=dtype)
+    # the same lights are sampled for a block whichever worker traces it
+    light_random.seed(current_project_block.row * 65536 + current_project_block.col)
 
-    for i in range(camera_seeting.x_pixel_pre_block):
-        for j in range(camera_seeting.y_pixel_pre_block):
+    for i in range(current_project_block.x_pixel_size):
+        for j in range(current_project_block.y_pixel_size):
             col = np.zeros(3)
             col[:] = 0
             Q = current_project_block.start + i * camera_seeting.x_project_size_pre_pixel * camera_seeting.x_coordinate_vector + j * camera_seeting.y_project_size_pre_pixel * camera_seeting.y_coordinate_vector
             D = normalize(Q - camera_seeting.position)
             depth = 0
             primaryRay = ray(camera_seeting.position, D)
-            col = reflect_and_refract(primaryRay, scene, PositionType.OUT, depth, 1,i,j)
-            img[h - (current_project_block.y_pixel_start_index + j) - 1, current_project_block.x_pixel_start_index + i, :] = np.clip(col, 0, 1)
-    result_queue.put(img) 
-
-def reflect_and_refract(primaryRay, scene, positionType, depth, pathLoss, i,j):
-
-    traced = primaryRay.trace_ray(scene)
+            record = None
+            if records is not None:
+                record = records[current_project_block.y_pixel_size - j - 1][i] = ray_record()
+            col = reflect_and_refract(primaryRay, scene, PositionType.OUT, depth, 1,i,j, record)
+            img[current_project_block.y_pixel_size - j - 1, i, :] = np.clip(col, 0, 1)
+    return img
+
+# primary ray of the pixel x (from the left), y (from the bottom) of the image
+def primary_ray(camera_seeting, x, y):
+    Q = camera_seeting.project_start + x * camera_seeting.x_project_size_pre_pixel * camera_seeting.x_coordinate_vector + y * camera_seeting.y_project_size_pre_pixel * camera_seeting.y_coordinate_vector
+    D = normalize(Q - camera_seeting.position)
+    return ray(camera_seeting.position, D)
+
+def trace_pixel(camera_seeting, x, y, scene, record=None):
+    col = reflect_and_refract(primary_ray(camera_seeting, x, y), scene, PositionType.OUT, 0, 1, x, y, record)
+    return np.clip(col, 0, 1)
+
+def reflect_and_refract(primaryRay, scene, positionType, depth, pathLoss, i,j, record=None):
+
+    traced = primaryRay.trace_ray(scene, record, pathLoss)
     
     if not traced:
         return 0. * np.zeros(3)
 
     obj, M, N, col_ray = traced
 
+    return secondary_light(primaryRay, scene, obj, M, N, pathLoss * col_ray, depth, pathLoss, i,j, record)
+
+# add the reflected and refracted light leaving M towards the ray origin to
+# col, the direct light at M
+def secondary_light(primaryRay, scene, obj, M, N, col, depth, pathLoss, i,j, record=None):
+
     if np.dot(primaryRay.direction, N) < 0:
         positionType = PositionType.OUT
-        col = pathLoss * col_ray
         n1 = 1.0
         n2 = obj.refractive_indices
         newNormal = N
@@ -626,10 +897,10 @@ def reflect_and_refract(primaryRay, scene, positionType, depth, pathLoss, i,j):
     # Reflection Ray
     reflectAmount = fresnel(n1, n2, newNormal, primaryRay.direction)
 
-    reflectRay = ray(M + newNormal * .001, normalize(primaryRay.direction - 2 * np.dot(primaryRay.direction, newNormal) * newNormal))
+    reflectRay = ray(M + newNormal * surface_bias, normalize(primaryRay.direction - 2 * np.dot(primaryRay.direction, newNormal) * newNormal))
 
     if depth + 1 < depth_max:
-        col+= reflect_and_refract(reflectRay, scene, positionType, depth + 1, pathLoss * reflectAmount, i,j)
+        col+= reflect_and_refract(reflectRay, scene, positionType, depth + 1, pathLoss * reflectAmount, i,j, record)
 
     refractionAmount = 1 - reflectAmount
 
@@ -637,7 +908,7 @@ def reflect_and_refract(primaryRay, scene, positionType, depth, pathLoss, i,j):
     if depth + 1 < depth_max and refractionAmount > 0:
             refractionRay = refraction(primaryRay, positionType, newNormal, obj, M)
             if refractionRay is not None:
-                col+= reflect_and_refract(refractionRay, scene, positionType, depth + 1, pathLoss * refractionAmount, i,j)
+                col+= reflect_and_refract(refractionRay, scene, positionType, depth + 1, pathLoss * refractionAmount, i,j, record)
 
     return col
 
@@ -658,7 +929,7 @@ def refraction(primaryRay, positionType, normal, refraction_obj, refraction_poin
 
     T = normalize(r * primaryRay.direction + (r * c1 - c2) * normal)
 
-    refraction_ray = ray(refraction_point + 0.001 * normal * -1, T)
+    refraction_ray = ray(refraction_point + surface_bias * normal * -1, T)
 
     return refraction_ray
 
@@ -711,16 +982,66 @@ def getSimpleRefractive(level):
     elif level == 5:
         return 0.9
 
+# the order analyse_input adds the objects of each type to the scene
+object_types = ['tetrahedron', 'cube', 'cylinder', 'cone', 'sphere', 'plane']
+
+# objs, a list of objects (scene json) or one array per field (see
+# scene_schema.scene_arrays), as one list per field
+def object_columns(objs):
+    if isinstance(objs, dict):
+        return dict((name, np.asarray(values).tolist()) for name, values in objs.items())
+    return dict((name, [obj[name] for obj in objs]) for name in objs[0])
+
+# the objects of object_type (one of object_types) of the scene entries objs
+# (see object_columns), in their order
+def build_objects(object_type, objs):
+    if not objs:
+        return []
+    c = object_columns(objs)
+    count = len(c['position'])
+    if object_type in ('tetrahedron', 'cube'):
+        if object_type == 'tetrahedron':
+            placements, triangle_planes = solid_faces(c, tetrahedron_vertices, tetrahedron_faces)
+            add = add_tetrahedron
+        else:
+            placements, triangle_planes = solid_faces(c, cube_vertices, cube_faces)
+            add = add_cube
+        return [add(c['position'][i], c['length'][i], c['rotation_angle'][i], c['color'][i], c['transparency_level'][i],
+                    placements[i], triangle_planes[i]) for i in range(count)]
+    if object_type in ('cylinder', 'cone'):
+        placements = transform.placements(c['position'], c['rotation_angle'])
+        add = add_cylinder if object_type == 'cylinder' else add_cone
+        return [add(c['position'][i], c['height'][i], c['radius'][i], c['rotation_angle'][i], c['color'][i],
+                    c['transparency_level'][i], placements[i]) for i in range(count)]
+    if object_type == 'sphere':
+        return [add_sphere(c['position'][i], c['radius'][i], c['color'][i], c['transparency_level'][i])
+                for i in range(count)]
+    return [add_plane(c['position'][i], c['normal'][i], c['transparency_level'][i]) for i in range(count)]
+
+# set the light and material parameters of the scene data (a decoded scene),
+# the defaults for those it leaves out
+def set_scene_lighting(data):
+    lighting = dict(default_lighting)
+    for key in lighting:
+        if data.get(key) is not None:
+            lighting[key] = data.get(key)
+    if lighting['lights']:
+        lighting['lights'] = light_list(lighting['lights'])
+    else:
+        lighting['lights'] = None
+    set_lighting(lighting)
+
 def analyse_input(scene_input):
+    return analyse_data(json.loads(scene_input))
 
-    data = json.loads(scene_input)
+# analyse_input of a decoded scene, whose objects of each type may also be
+# one array per field (see build_objects)
+def analyse_data(data):
     scene = []
     camera_position = [0, 0.35, -1]
     camera_point_to = [0,0.35,0]
-    global L
 
-    if data.get("light") is not None:
-        L = np.array(data.get("light"))
+    set_scene_lighting(data)
 
     if data.get("camera_position") is not None:
         camera_position = data.get("camera_position")
@@ -730,38 +1051,12 @@ def analyse_input(scene_input):
 
     camera_seeting = camera(camera_position, camera_point_to)
 
-    objTetrahedron = data.get("tetrahedron")
-    if objTetrahedron is not None:
-        for i, obj in enumerate(objTetrahedron):
-            scene.append(add_tetrahedron(obj['position'], obj['length'], obj['rotation_angle'], obj['color'], obj['transparency_level']))
-
-    objCube = data.get("cube")
-    if objCube is not None:
-        for i, obj in enumerate(objCube):
-            scene.append(add_cube(obj['position'], obj['length'], obj['rotation_angle'], obj['color'], obj['transparency_level']))
-
-    objCylinder = data.get("cylinder")
-    if objCylinder is not None:
-        for i, obj in enumerate(objCylinder):
-            scene.append(add_cylinder(obj['position'], obj['height'], obj['radius'], obj['rotation_angle'], obj['color'],obj['transparency_level']))
- 
-    objCone = data.get("cone")
-    if objCone is not None:
-        for i, obj in enumerate(objCone):
-            scene.append(add_cone(obj['position'], obj['height'], obj['radius'], obj['rotation_angle'], obj['color'],obj['transparency_level']))
-
-    objSphere = data.get("sphere")
-    if objSphere is not None:
-        for i, obj in enumerate(objSphere):
-            scene.append(add_sphere(obj['position'], obj['radius'], obj['color'],obj['transparency_level']))
-
-    objPlane = data.get("plane")
-    if objPlane is not None:
-        for i, obj in enumerate(objPlane):
-            scene.append(add_plane(obj['position'], obj['normal'],obj['transparency_level']))
+    for object_type in object_types:
+        scene.extend(build_objects(object_type, data.get(object_type)))
 
     return camera_seeting, scene
 
+
 w = 512
 h = 512
 
@@ -775,34 +1070,94 @@ diffuse_c = 1.
 specular_c = 1.
 specular_k = 50
 
-depth_max = 4  # Maximum number of light reflections.
-processes_divided = 8
-
-if __name__ == '__main__':
-
-    with open('data.json', 'r') as inputFile:
-        scene_input = inputFile.read()  
+# Light list (light_list) of the scene, used instead of L and color_light when set.
+lights = None
 
-    result_queue = mp.Queue()
-    ps = []
+# Scene keys analyse_input reads the light and material parameters from, and
+# the values used when a scene leaves them out.
+default_lighting = {'light': L, 'color_light': color_light, 'ambient': ambient, 'specular_k': specular_k, 'lights': None}
 
-    for i in range(processes_divided**2):
-        ps.append(mp.Process(target=trace_ray_main, args=(result_queue, i,
-        scene_input, )))
+def get_lighting():
+    return {'light': L, 'color_light': color_light, 'ambient': ambient, 'specular_k': specular_k, 'lights': lights}
 
-    img = np.zeros((h, w, 3))
+def set_lighting(lighting):
+    global L, color_light, ambient, specular_k, lights
+    L = vector(lighting['light'])
+    color_light = vector(lighting['color_light'])
+    ambient = float(lighting['ambient'])
+    specular_k = lighting['specular_k']
+    lights = lighting.get('lights')
 
-    # start processes
-    for p in ps:
-        p.start()
-
-    for i in range(len(ps)):
-        img = img + result_queue.get()
-        print(i + 1) *  1.0  / len(ps) * 100, '%'
-
-    # for debug
-    #processes_divided = 1
-    #trace_ray_main(result_queue, 0, scene_input)
-    #img = img + result_queue.get()
+depth_max = 4  # Maximum number of light reflections.
+processes_divided = 8
+tile_size = None  # Block size in pixels, None splits the image into processes_divided ** 2 blocks.
+shadow_cache = None  # visibility_cache of the current scene and light, None traces every shadow ray.
+object_space = False  # Intersect rays with cubes in their own space (a box) instead of their triangles.
+light_samples = 0  # Lights of the light list shadowed per point, 0 shadows every light in range.
+light_random = random.Random(0)  # Picks the sampled lights, seeded per block.
+rays_traced = 0  # Camera, secondary and shadow rays traced by this process, for progress reports.
+
+# Floating point type of the scene, rays and images, with the tolerances that
+# suit it: how far secondary and shadow rays start off the surface, the
+# smallest ray/plane cosine that still crosses the plane, and how far a point
+# may be off a face and still be on it. float32 rounds hit points to ~1e-7, so
+# the face tolerance grows with it; the surface offset is already well above
+# that and a larger one visibly moves reflections and refractions.
+precisions = {
+    'float64': {'dtype': np.float64, 'surface_bias': .001, 'parallel_epsilon': 1e-6, 'on_plane_epsilon': 1e-11},
+    'float32': {'dtype': np.float32, 'surface_bias': .001, 'parallel_epsilon': 1e-5, 'on_plane_epsilon': 2e-5},
+}
+precision = 'float64'
+dtype = np.float64
+surface_bias = .001
+parallel_epsilon = 1e-6
+on_plane_epsilon = 1e-11
+
+def set_precision(name):
+    global precision, dtype, surface_bias, parallel_epsilon, on_plane_epsilon
+    settings = precisions[name]
+    precision = name
+    dtype = settings['dtype']
+    surface_bias = settings['surface_bias']
+    parallel_epsilon = settings['parallel_epsilon']
+    on_plane_epsilon = settings['on_plane_epsilon']
+
+# block size in pixels
+def block_size():
+    if tile_size:
+        return tile_size, tile_size
+    return int(math.ceil(w * 1.0 / processes_divided)), int(math.ceil(h * 1.0 / processes_divided))
+
+# pixel start index and size of each block, covering the whole image
+def split_blocks():
+    x_pixel_pre_block, y_pixel_pre_block = block_size()
+    blocks = []
+    for x_pixel_start in range(0, w, x_pixel_pre_block):
+        for y_pixel_start in range(0, h, y_pixel_pre_block):
+            blocks.append((x_pixel_start, y_pixel_start,
+                min(x_pixel_pre_block, w - x_pixel_start),
+                min(y_pixel_pre_block, h - y_pixel_start)))
+    return blocks
+
+# change the render settings of this process, None keeps the current value
+def set_render_options(width=None, height=None, depth=None, tile=None, sampled_lights=None, precision=None,
+                       box_intersection=None):
+    global w, h, depth_max, tile_size, light_samples, object_space
+    if width is not None:
+        w = width
+    if height is not None:
+        h = height
+    if depth is not None:
+        depth_max = depth
+    if tile is not None:
+        tile_size = tile
+    if sampled_lights is not None:
+        light_samples = sampled_lights
+    if precision is not None:
+        set_precision(precision)
+    if box_intersection is not None:
+        object_space = box_intersection
 
-    plt.imsave('fig.png', img)
+if __name__ == '__main__':
+    import render
+    render.main()
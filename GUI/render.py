@@ -0,0 +1,400 @@
+"""
+Headless renderer.
+
+Traces a scene with a pool of worker processes, one block (tile) per task, and
+streams the finished tiles into image_output. Only the ray tracer and the
+image encoder are imported, so it starts quickly and runs without a display:
+
+    python render.py data.json -o fig.png --width 1024 --height 768 --depth 4 --workers 16
+
+Pass '-' as the scene to read it from stdin, or as the output to write the
+image to stdout. The scene json is read as it streams in, into one array per
+field of each object type (see scene_stream.py), and the workers build the
+objects from the arrays. A binary scene file (.npz, see scene_file.py) is not
+sent to the workers at all: each maps the file itself.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing as mp
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import image_output
+import raytracing
+import scene_file
+import scene_schema
+import scene_stream
+
+default_options = {
+    'width': 512,
+    'height': 512,
+    'depth': 4,
+    'tile': 64,
+    # shadow visibility cache cell size (0 traces every shadow ray) and how far
+    # apart the traced values of a cell may be for it to be reused
+    'shadow_cell': 0,
+    'shadow_error': 0.05,
+    # lights of the scene's light list shadowed per point, 0 for all of them
+    'light_samples': 0,
+    # 'float64', or 'float32' for half the memory and bandwidth (see raytracing.precisions)
+    'precision': 'float64',
+    # intersect cubes as boxes in their own space rather than as 12 triangles
+    'object_space': False,
+}
+
+# compiled scenes of this process by (scene key, precision), and their cameras
+# by (scene key, options), oldest first
+compiled_scenes = OrderedDict()
+compiled_cameras = OrderedDict()
+compiled_scenes_max = 8
+compiled_cameras_max = 32
+# compile_scene calls of this process that found the scene compiled, or not
+scene_cache_hits = 0
+scene_cache_misses = 0
+
+# shadow visibility caches of this process by (scene key, cell size, error),
+# kept across renders and frames of the same scene
+shadow_caches = OrderedDict()
+shadow_caches_max = 8
+
+# compile_scene, use_scene and tile_count set the options and lighting of the
+# raytracing module, one set per process. Threads that use them in the same
+# process (the server's renderers compile, relight and count tiles in its main
+# process) hold scene_lock from setting them until they are done with them.
+# Worker processes trace one task at a time and never take it, so a worker
+# forked while a thread holds it does not wait for it.
+scene_lock = threading.RLock()
+
+
+def make_options(**options):
+    full_options = dict(default_options)
+    for key, value in options.items():
+        if value is not None:
+            full_options[key] = value
+    return full_options
+
+
+def options_key(options):
+    return repr(sorted(options.items()))
+
+
+def scene_key(scene_input):
+    if not isinstance(scene_input, bytes):
+        scene_input = scene_input.encode('utf-8')
+    return hashlib.sha1(scene_input).hexdigest()
+
+
+# scene_input checked and in canonical form (see scene_schema), so a bad scene
+# fails here rather than in a worker. Raises scene_schema.SceneError.
+def load_scene(scene_input):
+    return scene_schema.canonical_json(scene_input)
+
+
+def apply_options(options):
+    raytracing.set_render_options(width=options['width'], height=options['height'],
+        depth=options['depth'], tile=options['tile'], sampled_lights=options.get('light_samples', 0),
+        precision=options.get('precision', 'float64'), box_intersection=options.get('object_space', False))
+
+
+def add_to_cache(cache, key, value, max_size):
+    cache[key] = value
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+# a scene sent to a worker along with what it shares with a scene the worker
+# may have compiled before, base_key: sources lists, for each object of the
+# compiled scene (in raytracing.object_types order), the index of the same
+# object in the base scene, or None for an object that is new or changed
+class scene_delta():
+
+    def __init__(self, scene_input, base_key, sources):
+        self.scene_input = scene_input
+        self.base_key = base_key
+        self.sources = sources
+
+
+# sources of a scene_delta from the scene data old_data to new_data (both
+# decoded and canonical). Objects are matched by type from both ends of their
+# list, so one object added, removed or changed leaves all the others shared.
+def object_sources(old_data, new_data):
+    sources = []
+    old_index = 0
+    for object_type in raytracing.object_types:
+        old_objects = old_data.get(object_type) or []
+        new_objects = new_data.get(object_type) or []
+        common = min(len(old_objects), len(new_objects))
+        prefix = 0
+        while prefix < common and old_objects[prefix] == new_objects[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < common - prefix and old_objects[-1 - suffix] == new_objects[-1 - suffix]:
+            suffix += 1
+        sources.extend(old_index + i for i in range(prefix))
+        sources.extend([None] * (len(new_objects) - prefix - suffix))
+        sources.extend(old_index + len(old_objects) - suffix + i for i in range(suffix))
+        old_index += len(old_objects)
+    return sources
+
+
+# the objects of the scene data, the shared ones taken from the compiled base
+# scene (see scene_delta) and only the others built
+def derive_objects(base_scene, data, sources):
+    scene = []
+    for object_type in raytracing.object_types:
+        objs = data.get(object_type) or []
+        first = len(scene)
+        scene.extend(base_scene[index] if index is not None else None for index in sources[first:first + len(objs)])
+        new = [i for i in range(len(objs)) if scene[first + i] is None]
+        for i, obj in zip(new, raytracing.build_objects(object_type, [objs[i] for i in new])):
+            scene[first + i] = obj
+    return scene
+
+
+# build the objects once per scene, and the camera once per scene and options.
+# options may move the camera with 'camera_position' and 'camera_point_to'.
+# scene_input may be a scene_delta, whose objects shared with a base scene
+# compiled here are reused rather than built again, or a
+# scene_file.array_scene, built from its arrays.
+def compile_scene(key, scene_input, options):
+    global scene_cache_hits, scene_cache_misses
+    compiled_key = (key, options.get('precision', 'float64'))
+    compiled = compiled_scenes.get(compiled_key)
+    if compiled is not None:
+        scene_cache_hits += 1
+    else:
+        scene_cache_misses += 1
+        if scene_input is None:
+            raise KeyError('Scene %s has not been sent to this worker' % key)
+        apply_options(options)
+        base = None
+        if isinstance(scene_input, scene_delta):
+            base = compiled_scenes.get((scene_input.base_key, compiled_key[1]))
+            sources, scene_input = scene_input.sources, scene_input.scene_input
+        if base is not None:
+            data = json.loads(scene_input)
+            raytracing.set_scene_lighting(data)
+            scene = derive_objects(base[0], data, sources)
+            compiled = (scene, raytracing.get_lighting(),
+                        data.get('camera_position', scene_schema.default_camera_position),
+                        data.get('camera_point_to', scene_schema.default_camera_point_to))
+        else:
+            if isinstance(scene_input, scene_file.array_scene):
+                camera_seeting, scene = raytracing.analyse_data(scene_input.data())
+            else:
+                camera_seeting, scene = raytracing.analyse_input(scene_input)
+            compiled = (scene, raytracing.get_lighting(), camera_seeting.position, camera_seeting.point_to)
+        add_to_cache(compiled_scenes, compiled_key, compiled, compiled_scenes_max)
+    scene, lighting, camera_position, camera_point_to = compiled
+
+    camera_key = (key, options_key(options))
+    camera_seeting = compiled_cameras.get(camera_key)
+    if camera_seeting is None:
+        apply_options(options)
+        camera_seeting = raytracing.camera(options.get('camera_position', camera_position),
+            options.get('camera_point_to', camera_point_to))
+        add_to_cache(compiled_cameras, camera_key, camera_seeting, compiled_cameras_max)
+    return camera_seeting, scene, lighting
+
+
+def get_shadow_cache(key, options):
+    cell_size = options.get('shadow_cell')
+    if not cell_size:
+        return None
+    error = options.get('shadow_error', default_options['shadow_error'])
+    cache_key = (key, cell_size, error)
+    cache = shadow_caches.get(cache_key)
+    if cache is None:
+        cache = raytracing.visibility_cache(cell_size, error)
+        add_to_cache(shadow_caches, cache_key, cache, shadow_caches_max)
+    return cache
+
+
+# compile_scene, and make its options, lighting and shadow cache current in
+# this process
+def use_scene(key, scene_input, options):
+    camera_seeting, scene, lighting = compile_scene(key, scene_input, options)
+    apply_options(options)
+    raytracing.set_lighting(lighting)
+    raytracing.shadow_cache = get_shadow_cache(key, options)
+    if raytracing.shadow_cache is not None:
+        raytracing.shadow_cache.set_light(raytracing.light_positions())
+    return camera_seeting, scene, lighting
+
+
+def preload_scene(key, scene_input, options):
+    compile_scene(key, scene_input, options)
+
+
+# worker task: (scene key, scene or None if preloaded, options, block index)
+def render_tile(task):
+    key, scene_input, options, project_block_index = task
+    camera_seeting, scene, lighting = use_scene(key, scene_input, options)
+    current_project_block = camera_seeting.project_blocks[project_block_index]
+    img = raytracing.trace_block(camera_seeting, current_project_block, scene)
+    return project_block_index, current_project_block.row, current_project_block.col, img
+
+
+def tile_count(options):
+    apply_options(options)
+    return len(raytracing.split_blocks())
+
+
+# render scene_input (json, or a scene_file.array_scene) into writer (see
+# image_output.tile_writer), returns the writer's image. Without a pool a new
+# one is started for this render.
+def render(scene_input, writer, options, workers=None, pool=None):
+    if isinstance(scene_input, scene_file.array_scene):
+        key = scene_input.key
+    else:
+        scene_input = load_scene(scene_input)
+        key = scene_key(scene_input)
+    task_scene = scene_input
+
+    own_pool = pool is None
+    if own_pool:
+        # every worker compiles the scene once, tasks then only carry the key
+        pool = mp.Pool(workers, initializer=preload_scene, initargs=(key, scene_input, options))
+        task_scene = None
+    tasks = [(key, task_scene, options, i) for i in range(tile_count(options))]
+    try:
+        for project_block_index, row, col, img in pool.imap_unordered(render_tile, tasks):
+            writer.add_tile(row, col, img)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+    return writer.close()
+
+
+# the scene json of the file path ('-' for stdin), which may be a binary
+# scene file
+def read_scene(path):
+    if path == '-':
+        return sys.stdin.read()
+    if path.endswith('.npz'):
+        return json.dumps(scene_file.load_scene(path), sort_keys=True)
+    with open(path, 'r') as inputFile:
+        return inputFile.read()
+
+
+def open_writer(output, options, fmt, gamma):
+    dtype = raytracing.precisions[options.get('precision', 'float64')]['dtype']
+    if output == '-':
+        f = getattr(sys.stdout, 'buffer', sys.stdout)
+        encoder = image_output.make_encoder(f, fmt or 'png', options['width'], options['height'], gamma, dtype)
+        return image_output.tile_writer(encoder, options['width'], options['height'], dtype=dtype)
+    return image_output.open_image_writer(output, options['width'], options['height'], fmt, gamma, dtype)
+
+
+# render scene_input in float64 and float32, returns both images and the
+# largest and mean difference of their pixels
+def compare_precisions(scene_input, options, workers=None):
+    images = []
+    for precision in ('float64', 'float32'):
+        precision_options = dict(options, precision=precision)
+        writer = image_output.tile_writer(None, options['width'], options['height'],
+            dtype=raytracing.precisions[precision]['dtype'])
+        images.append(render(scene_input, writer, precision_options, workers=workers))
+    difference = np.abs(images[0] - images[1].astype(np.float64))
+    return images[0], images[1], float(difference.max()), float(difference.mean())
+
+
+# output and image flags shared by the command line renderers
+def add_render_arguments(parser):
+    parser.add_argument('-o', '--output', default='fig.png',
+        help="image file, '-' writes stdout (default: %(default)s)")
+    parser.add_argument('--width', type=int, default=default_options['width'])
+    parser.add_argument('--height', type=int, default=default_options['height'])
+    parser.add_argument('--depth', type=int, default=default_options['depth'],
+        help='maximum number of reflections and refractions (depth_max)')
+    parser.add_argument('--tile-size', type=int, default=default_options['tile'],
+        help='block size in pixels handed to a worker at a time')
+    parser.add_argument('--format', choices=image_output.FORMATS,
+        help='image format, by default taken from the output file extension')
+    parser.add_argument('--gamma', type=float, default=1.0)
+    parser.add_argument('--shadow-cell', type=float, default=default_options['shadow_cell'],
+        help='cache shadow rays over cells of this size, reused across frames (default: off)')
+    parser.add_argument('--shadow-error', type=float, default=default_options['shadow_error'],
+        help='largest spread of the shadow values of a cell for it to be reused (default: %(default)s)')
+    parser.add_argument('--light-samples', type=int, default=default_options['light_samples'],
+        help="shadow only this many of the scene's lights per point, picked at random (default: all)")
+    parser.add_argument('--precision', choices=sorted(raytracing.precisions), default=default_options['precision'],
+        help='floating point type of the scene, rays and image (default: %(default)s)')
+    parser.add_argument('--object-space', action='store_true',
+        help='intersect rays with cubes in object space (one box test instead of 12 triangles)')
+
+
+def check_render_arguments(parser, args):
+    if args.width < 1 or args.height < 1 or args.depth < 1 or args.tile_size < 1:
+        parser.error('size, depth and tile size must be positive')
+    if args.shadow_cell < 0 or args.shadow_error < 0 or args.light_samples < 0:
+        parser.error('shadow cell, shadow error and light samples must not be negative')
+    return make_options(width=args.width, height=args.height, depth=args.depth, tile=args.tile_size,
+        shadow_cell=args.shadow_cell, shadow_error=args.shadow_error, light_samples=args.light_samples,
+        precision=args.precision, object_space=args.object_space)
+
+
+def parse_args(argv, default_scene):
+    parser = argparse.ArgumentParser(description='Render a ray tracing scene without the GUI.')
+    parser.add_argument('scene', nargs='?', default=default_scene,
+        help="scene json or binary scene (.npz) file, '-' reads stdin (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(),
+        help='number of worker processes (default: %(default)s)')
+    parser.add_argument('--compare-precision', type=float, metavar='TOLERANCE',
+        help='render in float64 and float32, write the float32 image and fail if '
+             'a pixel differs by more than TOLERANCE')
+    add_render_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error('workers must be positive')
+    return args, check_render_arguments(parser, args)
+
+
+def print_summary(options, workers, output, start, render_start, end):
+    pixels = options['width'] * options['height']
+    sys.stderr.write('Rendered %dx%d, depth %d, %d tiles of %dpx on %d workers\n' % (
+        options['width'], options['height'], options['depth'], tile_count(options),
+        options['tile'], workers))
+    sys.stderr.write('  read scene  %8.3fs\n' % (render_start - start))
+    sys.stderr.write('  render      %8.3fs  (%.0f pixels/s)\n' % (end - render_start,
+        pixels / max(end - render_start, 1e-9)))
+    sys.stderr.write('  total       %8.3fs  -> %s\n' % (end - start, output))
+
+
+def main(argv=None, default_scene='data.json'):
+    args, options = parse_args(argv, default_scene)
+
+    start = time.time()
+    try:
+        if args.scene.endswith('.npz'):
+            scene_input = scene_file.binary_scene(args.scene)
+        else:
+            scene_input = scene_stream.load_path(args.scene)
+    except scene_schema.SceneError as e:
+        sys.exit('%s: invalid scene: %s' % (args.scene, e))
+    if args.compare_precision is not None:
+        img64, img32, max_difference, mean_difference = compare_precisions(scene_input, options, args.workers)
+        image_output.save_image(args.output, img32, args.format, args.gamma)
+        sys.stderr.write('float32 vs float64: largest difference %.6f, mean %.6f, tolerance %g\n' % (
+            max_difference, mean_difference, args.compare_precision))
+        if max_difference > args.compare_precision:
+            sys.exit(1)
+        return
+
+    writer = open_writer(args.output, options, args.format, args.gamma)
+    render_start = time.time()
+    render(scene_input, writer, options, workers=args.workers)
+    end = time.time()
+
+    print_summary(options, args.workers, args.output, start, render_start, end)
+
+
+if __name__ == '__main__':
+    main()
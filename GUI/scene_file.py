@@ -0,0 +1,253 @@
+"""
+Binary scene files.
+
+A scene json of 100k objects is hundreds of megabytes of text that every
+worker parses again. A binary scene file holds the same scene as a NumPy
+.npz archive with one array per field per object type, stored uncompressed:
+
+    sphere.position      float64 (n, 3)
+    sphere.radius        float64 (n,)
+    sphere.color         float64 (n, 3)
+    sphere.transparency_level   int8 (n,)
+    ...
+    settings             the other keys of the scene (camera, light, lights,
+                         ...) as json text, utf-8 bytes
+    format               format_version
+
+load_arrays memory-maps every array straight from the archive, so opening a
+file costs the few small reads of its headers whatever its size, and the
+workers (raytracing.build_objects takes the arrays as they are) read the
+pages they use from the page cache the file shares between them.
+
+The conversion is lossless both ways for valid scenes: a file saved from json
+loads back as the canonical json of scene_schema.validate_scene, field for
+field. Convert on the command line with
+
+    python scene_file.py scene.json scene.npz
+    python scene_file.py scene.npz scene.json
+"""
+
+import argparse
+import hashlib
+import json
+import struct
+import sys
+import zipfile
+
+import numpy as np
+
+import scene_schema
+
+format_version = 1
+
+# array type of each kind of field
+field_dtypes = {'level': np.int8}
+
+
+def member_name(object_type, field):
+    return '%s.%s' % (object_type, field)
+
+
+# scene_input (json text or a dict) checked, as its settings (a canonical
+# scene without objects) and its objects as {object type: {field: array}}.
+# Raises scene_schema.SceneError.
+def scene_to_arrays(scene_input):
+    data, arrays = scene_schema.scene_arrays(scene_input)
+    settings = scene_schema.validate_scene(dict((name, value) for name, value in data.items()
+                                                if name not in scene_schema.object_fields))
+    arrays = dict((object_type, fields) for object_type, fields in arrays.items()
+                  if len(data[object_type]) > 0)
+    return settings, arrays
+
+
+# the canonical scene (as scene_schema.validate_scene) of settings and arrays
+def arrays_to_scene(settings, arrays):
+    scene = dict(settings)
+    for object_type, fields in arrays.items():
+        names = [name for name, kind in scene_schema.object_fields[object_type]]
+        columns = [np.asarray(fields[name]).tolist() for name in names]
+        scene[object_type] = [dict(zip(names, values)) for values in zip(*columns)]
+    return scene
+
+
+def save_arrays(path, settings, arrays):
+    members = {'format': np.array(format_version),
+               'settings': np.frombuffer(json.dumps(settings, sort_keys=True).encode('utf-8'), dtype=np.uint8)}
+    for object_type, fields in arrays.items():
+        for name, kind in scene_schema.object_fields[object_type]:
+            members[member_name(object_type, name)] = np.ascontiguousarray(fields[name],
+                                                                           dtype=field_dtypes.get(kind, np.float64))
+    # uncompressed, so every array can be mapped where it lies in the file
+    np.savez(path, **members)
+
+
+# write scene_input (json text or a dict) to path as a binary scene file.
+# Raises scene_schema.SceneError if the scene is not valid.
+def save_scene(path, scene_input):
+    settings, arrays = scene_to_arrays(scene_input)
+    save_arrays(path, settings, arrays)
+
+
+# the arrays of the .npz file path by member name, mapped into memory where
+# the member is stored uncompressed (as save_arrays writes them) and read
+# otherwise
+def open_members(path):
+    members = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                members[name] = np.lib.format.read_array(archive.open(info))
+                continue
+            # the data follows the local file header, whose name and extra
+            # field lengths may differ from the central directory's
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError('%s: %s holds python objects' % (path, name))
+            if int(np.prod(shape)) == 0:
+                members[name] = np.zeros(shape, dtype=dtype)
+            else:
+                members[name] = np.memmap(path, dtype=dtype, mode='r', shape=shape,
+                                          order='F' if fortran_order else 'C', offset=f.tell())
+    return members
+
+
+# what is wrong with the arrays of object_type read from a file, added to
+# problems
+def array_problems(object_type, fields, problems):
+    count = None
+    for name, kind in scene_schema.object_fields[object_type]:
+        array = fields.get(name)
+        if array is None:
+            problems.append('%s.%s: missing' % (object_type, name))
+            continue
+        if count is None:
+            count = len(array)
+        if len(array) != count:
+            problems.append('%s.%s: %d values for %d objects' % (object_type, name, len(array), count))
+        elif scene_schema.field_array(array, kind) is None:
+            problems.append('%s.%s: expected %s values' % (object_type, name, kind))
+
+
+# the settings and arrays (as scene_to_arrays) of the binary scene file path,
+# the arrays memory-mapped. check: validate every array first, which reads
+# the whole file once. Raises scene_schema.SceneError.
+def load_arrays(path, check=True):
+    try:
+        members = open_members(path)
+    except (IOError, OSError, ValueError, zipfile.BadZipfile) as e:
+        raise scene_schema.SceneError(['%s: not a scene file: %s' % (path, e)])
+    if members.get('format') is None or int(members['format']) != format_version:
+        raise scene_schema.SceneError(['%s: not a scene file of format %d' % (path, format_version)])
+    del members['format']
+    settings = {}
+    if 'settings' in members:
+        settings = json.loads(np.asarray(members.pop('settings')).tobytes().decode('utf-8'))
+
+    problems = []
+    arrays = {}
+    for name, array in sorted(members.items()):
+        object_type, _, field = name.partition('.')
+        if object_type not in scene_schema.object_fields or field not in dict(scene_schema.object_fields[object_type]):
+            problems.append('%s: unknown array' % name)
+            continue
+        arrays.setdefault(object_type, {})[field] = array
+    if check:
+        try:
+            settings = scene_schema.validate_scene(settings)
+        except scene_schema.SceneError as e:
+            problems.extend(e.problems)
+        for object_type, fields in sorted(arrays.items()):
+            array_problems(object_type, fields, problems)
+    if problems:
+        raise scene_schema.SceneError(problems)
+    return settings, arrays
+
+
+# the canonical scene of the binary scene file path. Raises
+# scene_schema.SceneError.
+def load_scene(path):
+    return arrays_to_scene(*load_arrays(path))
+
+
+# render key of the scene of settings and arrays: the same for the same scene
+# whenever and however it was saved
+def arrays_key(settings, arrays):
+    digest = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    for object_type in sorted(arrays):
+        for name in sorted(arrays[object_type]):
+            digest.update(member_name(object_type, name).encode('utf-8'))
+            digest.update(np.ascontiguousarray(arrays[object_type][name]).tobytes())
+    return digest.hexdigest()
+
+
+# a checked scene as settings and arrays, which render.render and its workers
+# build the objects of straight from the arrays (see render.compile_scene)
+class array_scene():
+
+    def __init__(self, settings, arrays):
+        self.settings = settings
+        self.arrays = arrays
+        self.key = arrays_key(settings, arrays)
+
+    # the scene as raytracing.analyse_data takes it
+    def data(self):
+        return dict(self.settings, **self.arrays)
+
+
+# an array_scene a renderer sends its workers by file name only: each worker
+# maps the file itself
+class binary_scene(array_scene):
+
+    # checks the file (scene_schema.SceneError if it is not valid)
+    def __init__(self, path):
+        self.path = path
+        settings, arrays = load_arrays(path)
+        self.key = arrays_key(settings, arrays)
+
+    # without checking the file again
+    def data(self):
+        settings, arrays = load_arrays(self.path, check=False)
+        return dict(settings, **arrays)
+
+
+def convert(source, target):
+    if source.endswith('.npz'):
+        scene = load_scene(source)
+        text = json.dumps(scene, sort_keys=True, indent=4)
+        if target == '-':
+            sys.stdout.write(text + '\n')
+        else:
+            with open(target, 'w') as f:
+                f.write(text)
+    else:
+        # read as it streams in, so json of any size converts (scene_stream
+        # imports this module)
+        import scene_stream
+        scene = scene_stream.load_path(source)
+        save_arrays(target, scene.settings, scene.arrays)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert a scene between json and the binary scene format.')
+    parser.add_argument('source', help="scene json ('-' for stdin), or binary scene file (.npz)")
+    parser.add_argument('target', help="binary scene file (.npz) for json, json file for .npz ('-' for stdout)")
+    args = parser.parse_args(argv)
+    if args.source.endswith('.npz') == args.target.endswith('.npz'):
+        parser.error('convert json to .npz or .npz to json')
+    try:
+        convert(args.source, args.target)
+    except scene_schema.SceneError as e:
+        sys.exit('%s: invalid scene: %s' % (args.source, e))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Small edits of a stored scene.
+
+A patch is one operation, or a list of them applied in order, on a decoded
+scene (see scene_schema):
+
+    {"op": "add", "type": "sphere", "object": {"position": [0, 1, 2], "radius": 0.5, ...}}
+    {"op": "remove", "type": "cube", "index": 2}
+    {"op": "modify", "type": "cone", "index": 0, "set": {"color": [1, 0, 0]}}
+    {"op": "camera", "camera_position": [0, 1, -3], "camera_point_to": [0, 0, 0]}
+    {"op": "light", "light": [5, 5, -10], "color_light": [1, 1, 1]}
+
+index counts the objects of the type from 0, modify replaces the fields set
+gives and keeps the others, and light sets any of the light and material
+fields (light, color_light, ambient, specular_k, lights). apply_patch checks
+the operations, not the values they write: the patched scene is validated as
+a whole by the render, like any other.
+
+Along with the new scene comes which of its objects are new or changed
+(render.scene_delta sources), so the workers rebuild only those.
+"""
+
+import copy
+
+import raytracing
+import scene_schema
+
+lighting_fields = ('light', 'color_light', 'ambient', 'specular_k', 'lights')
+camera_fields = ('camera_position', 'camera_point_to')
+
+
+# what is wrong with the index of operation number n on a list of count
+# objects, None if nothing
+def index_problem(operation, n, count):
+    index = operation.get('index')
+    if not isinstance(index, int) or isinstance(index, bool):
+        return 'operation %d: index must be an integer, got %s' % (n, scene_schema.describe(index))
+    if not 0 <= index < count:
+        return 'operation %d: no %s %d, the scene has %d' % (n, operation['type'], index, count)
+    return None
+
+
+# what is wrong with operation number n on the fields it may set, None if
+# nothing
+def fields_problem(operation, n, fields):
+    unknown = sorted(name for name in operation if name != 'op' and name not in fields)
+    if unknown:
+        return 'operation %d: unknown field %s' % (n, ', '.join(unknown))
+    if len(operation) == 1:
+        return 'operation %d: sets none of %s' % (n, ', '.join(fields))
+    return None
+
+
+# apply operation number n to data (changed in place) and sources (object
+# type -> index in the old scene of each object, None for new or changed
+# ones). Returns what is wrong with it, None if nothing.
+def apply_operation(data, sources, operation, n):
+    if not isinstance(operation, dict):
+        return 'operation %d: expected an object, got %s' % (n, scene_schema.describe(operation))
+    op = operation.get('op')
+    if op == 'camera':
+        problem = fields_problem(operation, n, camera_fields)
+        if problem is None:
+            data.update((name, operation[name]) for name in camera_fields if name in operation)
+        return problem
+    if op == 'light':
+        problem = fields_problem(operation, n, lighting_fields)
+        if problem is None:
+            data.update((name, operation[name]) for name in lighting_fields if name in operation)
+        return problem
+    if op not in ('add', 'remove', 'modify'):
+        return "operation %d: op must be 'add', 'remove', 'modify', 'camera' or 'light', got %s" % (
+            n, scene_schema.describe(op))
+    object_type = operation.get('type')
+    if object_type not in raytracing.object_types:
+        return 'operation %d: type must be one of %s, got %s' % (n, ', '.join(raytracing.object_types),
+                                                                 scene_schema.describe(object_type))
+    objects = data.setdefault(object_type, [])
+    if op == 'add':
+        if not isinstance(operation.get('object'), dict):
+            return 'operation %d: object must be an object' % n
+        objects.append(operation['object'])
+        sources[object_type].append(None)
+        return None
+    problem = index_problem(operation, n, len(objects))
+    if problem is not None:
+        return problem
+    index = operation['index']
+    if op == 'remove':
+        del objects[index]
+        del sources[object_type][index]
+        return None
+    if not isinstance(operation.get('set'), dict):
+        return 'operation %d: set must be an object' % n
+    objects[index] = dict(objects[index], **operation['set'])
+    sources[object_type][index] = None
+    return None
+
+
+# data (a decoded scene, left as it is) with patch applied. Returns the new
+# scene and its render.scene_delta sources from data. Raises
+# scene_schema.SceneError listing what is wrong with the patch.
+def apply_patch(data, patch):
+    operations = patch if isinstance(patch, list) else [patch]
+    if not operations:
+        raise scene_schema.SceneError(['the patch has no operations'])
+    new_data = copy.deepcopy(data)
+    sources = dict((object_type, list(range(len(data.get(object_type) or []))))
+                   for object_type in raytracing.object_types)
+    problems = []
+    for n, operation in enumerate(operations):
+        problem = apply_operation(new_data, sources, operation, n)
+        if problem is not None:
+            problems.append(problem)
+    if problems:
+        raise scene_schema.SceneError(problems)
+
+    # object indices in the compiled scene, types in raytracing.object_types order
+    scene_sources = []
+    offset = 0
+    for object_type in raytracing.object_types:
+        scene_sources.extend(None if index is None else offset + index for index in sources[object_type])
+        offset += len(data.get(object_type) or [])
+    return new_data, scene_sources
@@ -0,0 +1,304 @@
+"""
+Scene validation and normalization.
+
+validate_scene checks a whole scene (json text or the dict it decodes to)
+before anything is compiled or sent to a worker: the type, range and vector
+length of every field analyse_input reads, and that no unknown keys are
+present. A bad scene raises SceneError listing every problem found, instead of
+failing inside a worker (a transparency_level out of range, for example,
+leaves an object without refractive indices).
+
+A valid scene is returned in canonical form: numbers as floats (levels as
+ints), vectors as lists of 3 floats, keys in a fixed order once dumped with
+sort_keys, and empty object lists left out. The fields of each object type are
+checked as one array per field (scene_arrays), so scenes of thousands of
+objects validate in a few vectorized passes; objects are only looked at one by
+one to report what is wrong with them.
+"""
+
+import json
+import math
+
+import numpy as np
+
+# the levels getRefractiveIndices and getSimpleRefractive know
+transparency_levels = (0, 1, 2, 3, 4, 5)
+
+# what each field holds:
+#   point      3 finite numbers
+#   direction  3 finite numbers, not all 0
+#   color      3 numbers in [0, 1]
+#   intensity  3 numbers, at least 0
+#   length     a finite number above 0
+#   amount     a finite number, at least 0
+#   level      one of transparency_levels
+object_fields = {
+    'tetrahedron': [('position', 'point'), ('length', 'length'), ('rotation_angle', 'point'),
+                    ('color', 'color'), ('transparency_level', 'level')],
+    'cube': [('position', 'point'), ('length', 'length'), ('rotation_angle', 'point'),
+             ('color', 'color'), ('transparency_level', 'level')],
+    'cylinder': [('position', 'point'), ('height', 'length'), ('radius', 'length'),
+                 ('rotation_angle', 'point'), ('color', 'color'), ('transparency_level', 'level')],
+    'cone': [('position', 'point'), ('height', 'length'), ('radius', 'length'),
+             ('rotation_angle', 'point'), ('color', 'color'), ('transparency_level', 'level')],
+    'sphere': [('position', 'point'), ('radius', 'length'), ('color', 'color'),
+               ('transparency_level', 'level')],
+    'plane': [('position', 'point'), ('normal', 'direction'), ('transparency_level', 'level')],
+}
+
+scene_fields = {
+    'camera_position': 'point',
+    'camera_point_to': 'point',
+    'light': 'point',
+    'color_light': 'intensity',
+    'ambient': 'amount',
+    'specular_k': 'amount',
+}
+
+# fields of an entry of the 'lights' list and whether it must be given
+light_fields = [('position', 'point', True), ('color', 'intensity', False),
+                ('intensity', 'amount', False), ('range', 'amount', False)]
+
+vector_kinds = ('point', 'direction', 'color', 'intensity')
+
+# the camera of a scene that leaves it out (see raytracing.analyse_input)
+default_camera_position = [0.0, 0.35, -1.0]
+default_camera_point_to = [0.0, 0.35, 0.0]
+
+
+class SceneError(ValueError):
+
+    def __init__(self, problems):
+        ValueError.__init__(self, '; '.join(problems))
+        self.problems = problems
+
+
+try:
+    number_types = (int, long, float)
+except NameError:
+    number_types = (int, float)
+
+
+def is_number(x):
+    return isinstance(x, number_types) and not isinstance(x, bool) and not (math.isinf(x) or math.isnan(x))
+
+
+def describe(value):
+    try:
+        return json.dumps(value)
+    except (TypeError, ValueError):
+        return repr(value)
+
+
+# what is wrong with value as a field of kind, None if nothing
+def field_problem(value, kind):
+    if kind in vector_kinds:
+        if not isinstance(value, (list, tuple)) or len(value) != 3 or not all(is_number(x) for x in value):
+            return 'expected a list of 3 numbers, got %s' % describe(value)
+        if kind == 'direction' and not any(value):
+            return 'must not be [0, 0, 0]'
+        if kind == 'color' and not all(0 <= x <= 1 for x in value):
+            return 'expected values from 0 to 1, got %s' % describe(value)
+        if kind == 'intensity' and not all(x >= 0 for x in value):
+            return 'must not be negative, got %s' % describe(value)
+        return None
+    if kind == 'level':
+        if not is_number(value) or value not in transparency_levels:
+            return 'expected one of %s, got %s' % (', '.join(str(level) for level in transparency_levels),
+                                                   describe(value))
+        return None
+    if not is_number(value):
+        return 'expected a number, got %s' % describe(value)
+    if kind == 'length' and value <= 0:
+        return 'must be above 0, got %s' % describe(value)
+    if kind == 'amount' and value < 0:
+        return 'must not be negative, got %s' % describe(value)
+    return None
+
+
+# values (a list of n fields of kind) as one array, or None if any of them is
+# not valid. Only numbers make a numeric array: strings, booleans and ragged
+# lists give another array type and are left to field_problem.
+def field_array(values, kind):
+    shape = (len(values), 3) if kind in vector_kinds else (len(values),)
+    if len(values) == 0:
+        return np.zeros(shape, dtype=int if kind == 'level' else float)
+    try:
+        array = np.array(values)
+    except ValueError:
+        return None
+    if array.dtype.kind not in 'iuf':
+        return None
+    if array.shape != shape or not np.all(np.isfinite(array)):
+        return None
+    if kind == 'level':
+        if not np.all(np.in1d(array, transparency_levels)):
+            return None
+        return array.astype(int)
+    array = array.astype(float)
+    if kind == 'direction' and not np.all(np.any(array != 0, axis=1)):
+        return None
+    if kind == 'color' and not np.all((array >= 0) & (array <= 1)):
+        return None
+    if kind == 'intensity' and not np.all(array >= 0):
+        return None
+    if kind == 'length' and not np.all(array > 0):
+        return None
+    if kind == 'amount' and not np.all(array >= 0):
+        return None
+    return array
+
+
+# the fields of objects, a list of objects of object_type, as one array per
+# field. Adds what is wrong to problems, and returns None then.
+def object_arrays(object_type, objects, problems):
+    if not isinstance(objects, list):
+        problems.append('%s: expected a list of objects' % object_type)
+        return None
+    count = len(problems)
+    for i, obj in enumerate(objects):
+        if not isinstance(obj, dict):
+            problems.append('%s[%d]: expected an object' % (object_type, i))
+            continue
+        known = [name for name, kind in object_fields[object_type]]
+        for name in sorted(set(obj) - set(known)):
+            problems.append('%s[%d].%s: unknown field' % (object_type, i, name))
+        for name in known:
+            if name not in obj:
+                problems.append('%s[%d].%s: missing' % (object_type, i, name))
+    if len(problems) > count:
+        return None
+
+    arrays = {}
+    for name, kind in object_fields[object_type]:
+        values = [obj[name] for obj in objects]
+        arrays[name] = field_array(values, kind)
+        if arrays[name] is None:
+            for i, value in enumerate(values):
+                problem = field_problem(value, kind)
+                if problem is not None:
+                    problems.append('%s[%d].%s: %s' % (object_type, i, name, problem))
+    if len(problems) > count:
+        return None
+    return arrays
+
+
+def light_problems(lights, problems):
+    if not isinstance(lights, list):
+        problems.append('lights: expected a list of lights')
+        return
+    for i, light in enumerate(lights):
+        if not isinstance(light, dict):
+            problems.append('lights[%d]: expected an object' % i)
+            continue
+        known = [name for name, kind, required in light_fields]
+        for name in sorted(set(light) - set(known)):
+            problems.append('lights[%d].%s: unknown field' % (i, name))
+        for name, kind, required in light_fields:
+            if light.get(name) is None:
+                if required:
+                    problems.append('lights[%d].%s: missing' % (i, name))
+                continue
+            problem = field_problem(light[name], kind)
+            if problem is not None:
+                problems.append('lights[%d].%s: %s' % (i, name, problem))
+
+
+# what is wrong with a camera at position looking at point_to, both valid
+# points, added to problems
+def camera_problems(position, point_to, problems):
+    direction = np.array(point_to, dtype=float) - np.array(position, dtype=float)
+    if not np.any(direction):
+        problems.append('camera_point_to: must differ from camera_position')
+    elif direction[2] < 0 and not np.any(direction[:2]):
+        # camera.findRotation divides by 1 + cos(angle to +z)
+        problems.append('camera_point_to: the camera must not look straight along -z')
+
+
+def canonical_value(value, kind):
+    if kind == 'level':
+        return int(value)
+    if kind in vector_kinds:
+        return [float(x) for x in value]
+    return float(value)
+
+
+# check scene_input (json text or a dict), returns its dict and the fields of
+# every object type as arrays: {object type: {field: array}}, (n, 3) for
+# vectors and (n,) for numbers. Raises SceneError with every problem found.
+def scene_arrays(scene_input):
+    if isinstance(scene_input, dict):
+        data = scene_input
+    else:
+        try:
+            data = json.loads(scene_input)
+        except ValueError as e:
+            raise SceneError(['not valid json: %s' % e])
+        if not isinstance(data, dict):
+            raise SceneError(['expected a json object'])
+
+    problems = []
+    for name in sorted(set(data) - set(object_fields) - set(scene_fields) - set(['lights'])):
+        problems.append('%s: unknown key' % name)
+    for name, kind in sorted(scene_fields.items()):
+        if data.get(name) is not None:
+            problem = field_problem(data[name], kind)
+            if problem is not None:
+                problems.append('%s: %s' % (name, problem))
+    if data.get('lights') is not None:
+        light_problems(data['lights'], problems)
+    if not problems:
+        camera_problems(data.get('camera_position', default_camera_position),
+                        data.get('camera_point_to', default_camera_point_to), problems)
+
+    arrays = {}
+    for object_type in object_fields:
+        if data.get(object_type) is not None:
+            arrays[object_type] = object_arrays(object_type, data[object_type], problems)
+    if problems:
+        raise SceneError(problems)
+    return data, arrays
+
+
+# check scene_input (json text or a dict) and return it in canonical form.
+# Raises SceneError with every problem found.
+def validate_scene(scene_input):
+    data, arrays = scene_arrays(scene_input)
+    scene = {}
+    for name, kind in scene_fields.items():
+        if data.get(name) is not None:
+            scene[name] = canonical_value(data[name], kind)
+    if data.get('lights'):
+        scene['lights'] = []
+        for light in data['lights']:
+            scene['lights'].append(dict((name, canonical_value(light[name], kind))
+                                        for name, kind, required in light_fields if light.get(name) is not None))
+    for object_type, fields in arrays.items():
+        if len(data[object_type]) == 0:
+            continue
+        columns = [fields[name].tolist() for name, kind in object_fields[object_type]]
+        names = [name for name, kind in object_fields[object_type]]
+        scene[object_type] = [dict(zip(names, values)) for values in zip(*columns)]
+    return scene
+
+
+# check a camera (position and point_to, either None for the default) and
+# return it in canonical form. Raises SceneError with every problem found.
+def validate_camera(position=None, point_to=None):
+    problems = []
+    position = default_camera_position if position is None else position
+    point_to = default_camera_point_to if point_to is None else point_to
+    for name, value in (('camera_position', position), ('camera_point_to', point_to)):
+        problem = field_problem(value, 'point')
+        if problem is not None:
+            problems.append('%s: %s' % (name, problem))
+    if not problems:
+        camera_problems(position, point_to, problems)
+    if problems:
+        raise SceneError(problems)
+    return canonical_value(position, 'point'), canonical_value(point_to, 'point')
+
+
+# validate_scene as json text, the same for every way of writing one scene
+def canonical_json(scene_input):
+    return json.dumps(validate_scene(scene_input), sort_keys=True)
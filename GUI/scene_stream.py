@@ -0,0 +1,282 @@
+"""
+Streaming loader for large scene json.
+
+json.loads of a scene file builds a dict per object, several times the size
+of the file, before anything else can start. load_arrays reads the file a
+chunk at a time instead: the objects of each type are decoded one by one and
+their fields go, chunk_objects at a time, into one array per field, the form
+scene_file stores (float64, int8 levels). What stays in memory is the read
+buffer, one chunk of objects and the arrays, about 100 bytes an object,
+whatever the size of the file; the other keys of the scene (camera, light,
+lights, ...) are small and decoded whole.
+
+The scene is checked as scene_schema.validate_scene checks it, with the same
+problems reported for the same mistakes, and comes back as a
+scene_file.array_scene that render.render and its workers take as it is:
+
+    python render.py huge_scene.json -o fig.png
+"""
+
+import io
+import json
+import re
+import sys
+
+import numpy as np
+
+import scene_file
+import scene_schema
+
+whitespace = ' \t\n\r'
+
+# a value decoded or failing this close to the end of the buffer may be cut
+# off there (a keyword, number or escape split between two chunks)
+cut_off_tail = 16
+
+
+# where in the text the decode error e is, None if it does not say
+def error_position(e):
+    if getattr(e, 'pos', None) is not None:
+        return e.pos
+    match = re.search(r'\(char (\d+)', str(e))
+    return int(match.group(1)) if match else None
+
+
+class array_builder():
+
+    # the objects of object_type, fields added chunk_objects at a time
+    def __init__(self, object_type, chunk_objects):
+        self.object_type = object_type
+        self.fields = scene_schema.object_fields[object_type]
+        self.names = [name for name, kind in self.fields]
+        self.chunk_objects = chunk_objects
+        self.count = 0
+        self.pending = []
+        self.chunks = dict((name, []) for name in self.names)
+        # an object is not an object with the fields of the type, or a field
+        # is not valid; values are only checked while the objects are right
+        self.wrong_objects = self.wrong_values = False
+
+    # add the decoded object obj, adding what is wrong with it to problems
+    def add(self, obj, problems):
+        index = self.count + len(self.pending)
+        count = len(problems)
+        if not isinstance(obj, dict):
+            problems.append('%s[%d]: expected an object' % (self.object_type, index))
+        else:
+            for name in sorted(set(obj) - set(self.names)):
+                problems.append('%s[%d].%s: unknown field' % (self.object_type, index, name))
+            for name in self.names:
+                if name not in obj:
+                    problems.append('%s[%d].%s: missing' % (self.object_type, index, name))
+        self.wrong_objects |= len(problems) > count
+        self.pending.append(obj)
+        if len(self.pending) >= self.chunk_objects:
+            self.flush(problems)
+
+    # the pending objects into arrays
+    def flush(self, problems):
+        if self.pending and not self.wrong_objects:
+            for name, kind in self.fields:
+                values = [obj[name] for obj in self.pending]
+                array = scene_schema.field_array(values, kind)
+                if array is None:
+                    for i, value in enumerate(values):
+                        problem = scene_schema.field_problem(value, kind)
+                        if problem is not None:
+                            problems.append('%s[%d].%s: %s' % (self.object_type, self.count + i, name, problem))
+                    self.wrong_values = True
+                    continue
+                self.chunks[name].append(array.astype(scene_file.field_dtypes.get(kind, np.float64)))
+        self.count += len(self.pending)
+        self.pending = []
+
+    # one array per field, None if there are no objects
+    def finish(self, problems):
+        self.flush(problems)
+        if not self.count or self.wrong_objects or self.wrong_values:
+            return None
+        return dict((name, np.concatenate(self.chunks[name])) for name in self.names)
+
+
+# a file read chunk_size characters at a time, and decoded json value by value.
+# A value may take at most max_value characters. Errors give their position
+# in characters from the start of the file, whatever the chunk size.
+class json_reader():
+
+    def __init__(self, f, chunk_size, max_value=1 << 26):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.max_value = max_value
+        self.buffer = ''
+        self.pos = 0
+        # characters before the buffer, dropped once decoded
+        self.consumed = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+        # the pure python decoder, which says where it failed when the C one
+        # of python 2 does not
+        self.exact_decoder = json.JSONDecoder()
+        self.exact_decoder.parse_string = json.decoder.py_scanstring
+        self.exact_decoder.scan_once = json.scanner.py_make_scanner(self.exact_decoder)
+
+    # read another chunk, False at the end of the file
+    def more(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # drop what has been decoded already
+        self.consumed += self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    # the next character that is not whitespace, '' at the end of the file
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.more():
+                return ''
+
+    # the position in the file of position in the buffer, self.pos by default
+    def file_position(self, position=None):
+        return self.consumed + (self.pos if position is None else position)
+
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError('expected %s at character %d, got %s' % (
+                ' or '.join("'%s'" % c for c in characters), self.file_position(),
+                repr(character) if character else 'the end'))
+        self.pos += 1
+        return character
+
+    # the decode error e of the value at self.pos, at its position in the file
+    def file_error(self, e):
+        if error_position(e) is None:
+            try:
+                self.exact_decoder.raw_decode(self.buffer, self.pos)
+            except ValueError as exact_error:
+                e = exact_error
+        position = error_position(e)
+        message = re.sub(r'( at)?:? line \d+ column \d+.*$', '', str(e))
+        return ValueError('%s at character %d' % (message, self.file_position(position)))
+
+    # the next json value, read to its end
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError as e:
+                # read on only if the value may be cut off at the end of the
+                # buffer, not for a mistake before it
+                if self.cut_off(e) and self.more():
+                    continue
+                raise self.file_error(e)
+            # a number may go on in the next chunk ("0." decodes as 0)
+            if end > len(self.buffer) - cut_off_tail and self.more():
+                continue
+            self.pos = end
+            return value
+
+    def cut_off(self, e):
+        if len(self.buffer) - self.pos > self.max_value:
+            raise ValueError('a value at character %d is longer than %d characters' % (self.file_position(),
+                                                                                        self.max_value))
+        if error_position(e) is None:
+            try:
+                self.exact_decoder.raw_decode(self.buffer, self.pos)
+            except ValueError as exact_error:
+                e = exact_error
+        if str(e).startswith('No JSON object'):
+            # the value itself does not start like one
+            position = self.pos
+        elif str(e).startswith('Unterminated string'):
+            # reported where the string starts, however long it is
+            return True
+        else:
+            position = error_position(e)
+            if position is None:
+                # a string cut right after its opening quote
+                return True
+        return position >= len(self.buffer) - cut_off_tail
+
+
+def read_object(reader, settings, builders, chunk_objects, problems):
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.pos += 1
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name in scene_schema.object_fields and reader.peek() == '[':
+            # a later key of the same name replaces an earlier one, as in json.loads
+            builder = builders[name] = array_builder(name, chunk_objects)
+            reader.pos += 1
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    builder.add(reader.value(), problems)
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            value = reader.value()
+            if name in scene_schema.object_fields:
+                builders.pop(name, None)
+                if value is not None:
+                    problems.append('%s: expected a list of objects' % name)
+            else:
+                settings[name] = value
+        if reader.expect(',}') == '}':
+            return
+
+
+# the scene json of the file f, read chunk_size characters at a time, checked
+# and as a scene_file.array_scene. Raises scene_schema.SceneError.
+def load_arrays(f, chunk_size=1 << 20, chunk_objects=4096):
+    reader = json_reader(f, chunk_size)
+    settings = {}
+    builders = {}
+    # of the objects; those of the rest of the scene come first
+    problems = []
+    try:
+        if reader.peek() != '{':
+            reader.value()
+            raise scene_schema.SceneError(['expected a json object'])
+        read_object(reader, settings, builders, chunk_objects, problems)
+        if reader.peek():
+            raise ValueError('extra data at character %d' % reader.file_position())
+    except scene_schema.SceneError:
+        raise
+    except ValueError as e:
+        raise scene_schema.SceneError(['not valid json: %s' % e])
+
+    arrays = {}
+    for object_type, builder in sorted(builders.items()):
+        fields = builder.finish(problems)
+        if fields is not None:
+            arrays[object_type] = fields
+    try:
+        settings = scene_schema.validate_scene(settings)
+    except scene_schema.SceneError as e:
+        problems = e.problems + problems
+    if problems:
+        raise scene_schema.SceneError(problems)
+    return scene_file.array_scene(settings, arrays)
+
+
+# load_arrays of the scene file path, '-' for stdin
+def load_path(path, chunk_size=1 << 20):
+    if path == '-':
+        return load_arrays(sys.stdin, chunk_size)
+    with io.open(path, 'r', encoding='utf-8') as f:
+        return load_arrays(f, chunk_size)
@@ -0,0 +1,175 @@
+"""
+Render a camera path through one scene, for turntables and fly-throughs.
+
+The scene is compiled once per worker and the worker pool is started once for
+the whole sequence; a frame only changes camera_position and camera_point_to,
+so each worker just builds a new camera for it. Tiles of all frames go through
+the same pool, and every frame is written to a numbered image as soon as its
+last tile is back.
+
+    python sequence.py data.json --path camera_path.json -o frames/frame_%04d.png
+    python sequence.py data.json --turntable 120 -o frames/frame_%04d.png
+
+The camera path is a json file with either an explicit list of frames
+
+    {"frames": [{"camera_position": [0, 0.35, -5], "camera_point_to": [0, 0, 0]}, ...]}
+
+or keyframes which are interpolated linearly
+
+    {"frame_count": 100,
+     "keyframes": [{"frame": 0, "camera_position": [...], "camera_point_to": [...]},
+                   {"frame": 99, "camera_position": [...], "camera_point_to": [...]}]}
+"""
+
+import argparse
+import json
+import math
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import numpy as np
+
+import image_output
+import raytracing
+import render
+import scene_schema
+
+
+def interpolate_keyframes(keyframes, frame_count=None):
+    keyframes = sorted(keyframes, key=lambda keyframe: keyframe['frame'])
+    if frame_count is None:
+        frame_count = keyframes[-1]['frame'] + 1
+    key_frames = [keyframe['frame'] for keyframe in keyframes]
+    frames = []
+    for frame in range(frame_count):
+        camera = {}
+        for name in ('camera_position', 'camera_point_to'):
+            values = np.array([keyframe[name] for keyframe in keyframes], dtype=float)
+            camera[name] = [float(np.interp(frame, key_frames, values[:, axis])) for axis in range(3)]
+        frames.append(camera)
+    return frames
+
+
+# orbit the camera around the point it looks at, keeping its height
+def turntable_path(camera_position, camera_point_to, frame_count):
+    offset = np.array(camera_position, dtype=float) - np.array(camera_point_to, dtype=float)
+    radius = math.hypot(offset[0], offset[2])
+    start = math.atan2(offset[2], offset[0])
+    frames = []
+    for frame in range(frame_count):
+        angle = start + 2.0 * math.pi * frame / frame_count
+        position = [camera_point_to[0] + radius * math.cos(angle),
+                    camera_position[1],
+                    camera_point_to[2] + radius * math.sin(angle)]
+        frames.append({'camera_position': position, 'camera_point_to': list(camera_point_to)})
+    return frames
+
+
+def load_camera_path(path):
+    with open(path, 'r') as inputFile:
+        data = json.load(inputFile)
+    if isinstance(data, list):
+        return data
+    if 'frames' in data:
+        return data['frames']
+    return interpolate_keyframes(data['keyframes'], data.get('frame_count'))
+
+
+# worker task: (frame number, render.render_tile task)
+def render_frame_tile(task):
+    frame, tile_task = task
+    return frame, render.render_tile(tile_task)
+
+
+def frame_options(options, camera):
+    return dict(options,
+        camera_position=[float(x) for x in camera['camera_position']],
+        camera_point_to=[float(x) for x in camera['camera_point_to']])
+
+
+# render every camera of frames, writing frame n to output_pattern % n.
+# Returns the time each frame was finished, from the start of the sequence.
+def render_sequence(scene_input, output_pattern, options, frames, workers=None, fmt=None, gamma=1.0):
+    scene_input = render.load_scene(scene_input)
+    key = render.scene_key(scene_input)
+    tiles = render.tile_count(options)
+    # frames are written in the render precision, as render.open_writer writes them
+    dtype = raytracing.precisions[options.get('precision', 'float64')]['dtype']
+    start = time.time()
+
+    pool = mp.Pool(workers, initializer=render.preload_scene, initargs=(key, scene_input, options))
+    tasks = ((frame, (key, None, frame_options(options, camera), i))
+             for frame, camera in enumerate(frames) for i in range(tiles))
+
+    writers = {}
+    remaining = {}
+    finished = [None] * len(frames)
+    try:
+        for frame, (project_block_index, row, col, img) in pool.imap_unordered(render_frame_tile, tasks):
+            if frame not in writers:
+                writers[frame] = image_output.open_image_writer(output_pattern % frame,
+                    options['width'], options['height'], fmt, gamma, dtype)
+                remaining[frame] = tiles
+            writers[frame].add_tile(row, col, img)
+            remaining[frame] -= 1
+            if remaining[frame] == 0:
+                writers.pop(frame).close()
+                finished[frame] = time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+        for writer in writers.values():
+            writer.close()
+    return finished
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render a camera path through one scene.')
+    parser.add_argument('scene', help="scene json or binary scene (.npz) file, '-' reads stdin")
+    path_group = parser.add_mutually_exclusive_group(required=True)
+    path_group.add_argument('--path', help='camera path json file (frames or keyframes)')
+    path_group.add_argument('--turntable', type=int, metavar='FRAMES',
+        help='orbit the scene camera around the point it looks at')
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(),
+        help='number of worker processes (default: %(default)s)')
+    render.add_render_arguments(parser)
+    parser.set_defaults(output='frame_%04d.png')
+    args = parser.parse_args(argv)
+    options = render.check_render_arguments(parser, args)
+    if args.workers < 1:
+        parser.error('workers must be positive')
+
+    start = time.time()
+    try:
+        scene_input = render.load_scene(render.read_scene(args.scene))
+    except scene_schema.SceneError as e:
+        sys.exit('%s: invalid scene: %s' % (args.scene, e))
+    if args.path:
+        frames = load_camera_path(args.path)
+    else:
+        data = json.loads(scene_input)
+        frames = turntable_path(data.get('camera_position', [0, 0.35, -1]),
+            data.get('camera_point_to', [0, 0.35, 0]), args.turntable)
+    if not frames:
+        parser.error('the camera path has no frames')
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    render_start = time.time()
+    finished = render_sequence(scene_input, args.output, options, frames, args.workers, args.format, args.gamma)
+    end = time.time()
+
+    sys.stderr.write('Rendered %d frames of %dx%d, depth %d on %d workers\n' % (
+        len(frames), options['width'], options['height'], options['depth'], args.workers))
+    sys.stderr.write('  read scene  %8.3fs\n' % (render_start - start))
+    sys.stderr.write('  first frame %8.3fs\n' % min(finished))
+    sys.stderr.write('  per frame   %8.3fs\n' % ((end - render_start) / len(frames)))
+    sys.stderr.write('  total       %8.3fs  -> %s\n' % (end - start, args.output))
+
+
+if __name__ == '__main__':
+    main()
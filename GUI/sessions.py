@@ -0,0 +1,216 @@
+"""
+Per-user scene state of the GUI.
+
+Every browser session gets its own scene (generate_output.OutputGenerator),
+incremental renderer and image file, so users building and rendering scenes
+at the same time no longer overwrite each other's scene or image. The
+renderers of all sessions share one worker pool: renders of different users
+run concurrently with their tiles interleaved in the pool's queue, and the
+CPU the server uses stays bounded by the pool size however many users render.
+
+Images are named by the hash of their content, so their URLs can be cached
+for good: a new render gets a new name. Sessions showing the same image share
+its file, which is removed once no session shows it.
+
+Camera previews of every session run in one more worker process of their own
+(preview.preview_worker), kept warm with the scenes last rendered.
+
+A new render of a session cancels the one before it, and renders are
+cancelled after render_timeout seconds (see incremental.cancel_token).
+
+Sessions are kept in least recently used order, at most max_sessions of them;
+a dropped session loses its last image and geometry buffer. The buffers and
+tables a renderer keeps for incremental renders take about 400 bytes a pixel,
+so their total is held under max_memory bytes as well: after every render
+those of the least recently used idle sessions are freed until it fits, and
+the next render of such a session is a full one.
+"""
+
+import hashlib
+import multiprocessing as mp
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
+import image_output
+from generate_output import OutputGenerator
+from incremental import incremental_renderer, cancel_token
+from preview import preview_worker
+
+
+class user_session():
+
+    def __init__(self, session_id, options, pool, workers=None, snapshot_dir=None, render_timeout=None,
+                 metrics=None):
+        self.id = session_id
+        snapshot_file = None
+        if snapshot_dir is not None:
+            snapshot_file = os.path.join(snapshot_dir, '%s.json' % session_id)
+        self.scene = OutputGenerator(snapshot_file)
+        self.renderer = incremental_renderer(dict(options), workers=workers, pool=pool, metrics=metrics)
+        self.render_timeout = render_timeout
+        # cancel_token of the latest render
+        self.cancel = None
+        self.cancel_lock = threading.Lock()
+        # file name of the last image in the image directory, None before the first
+        self.image_name = None
+        # one request of a session at a time changes its scene or renderer
+        self.lock = threading.Lock()
+
+    # a cancel_token for a new render; the render before it, running or
+    # waiting, is superseded and stops
+    def new_render(self):
+        with self.cancel_lock:
+            if self.cancel is not None:
+                self.cancel.cancel('superseded')
+            self.cancel = cancel_token(self.render_timeout)
+            return self.cancel
+
+    def cancel_render(self, reason):
+        with self.cancel_lock:
+            if self.cancel is not None:
+                self.cancel.cancel(reason)
+
+
+class session_store():
+
+    # render_timeout: seconds after which a render is cancelled, None for no
+    # limit. metrics (metrics.render_metrics) gets the outcome of every render.
+    # max_memory: bytes the renderers of all sessions may keep, None for no
+    # limit.
+    def __init__(self, options, image_dir, workers=None, max_sessions=64, snapshot_dir=None, render_timeout=None,
+                 metrics=None, max_memory=None):
+        self.options = options
+        self.max_memory = max_memory
+        self.metrics = metrics
+        self.render_timeout = render_timeout
+        self.image_dir = image_dir
+        self.workers = workers
+        self.max_sessions = max_sessions
+        self.snapshot_dir = snapshot_dir
+        self.sessions = OrderedDict()
+        # number of sessions showing each image file
+        self.images = {}
+        self.pool = None
+        # pids of the pool's live workers, and how many have died
+        self.worker_pids = set()
+        self.worker_crashes = 0
+        self.preview = preview_worker()
+        self.lock = threading.Lock()
+        for directory in (image_dir, snapshot_dir):
+            if directory is not None and not os.path.isdir(directory):
+                os.makedirs(directory)
+        # images of an earlier run belong to no session
+        for name in os.listdir(image_dir):
+            if name.endswith('.png'):
+                os.remove(os.path.join(image_dir, name))
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = mp.Pool(self.workers)
+            self.worker_pids = set(process.pid for process in self.pool._pool)
+        return self.pool
+
+    # count the workers of the pool that died since the last check. The pool
+    # starts new ones, but the tasks they were running are lost. Reads the
+    # pool's own list of processes (Pool._pool), multiprocessing has no other.
+    def check_workers(self):
+        with self.lock:
+            if self.pool is None:
+                return
+            alive = set(process.pid for process in self.pool._pool if process.exitcode is None)
+            self.worker_crashes += len(self.worker_pids - alive)
+            self.worker_pids = alive
+
+    # the sessions, the pool and what it is doing now, for monitoring
+    def status(self):
+        self.check_workers()
+        with self.lock:
+            renderers = [user.renderer for user in self.sessions.values()]
+            started = self.pool is not None
+        workers = self.workers or mp.cpu_count()
+        in_flight = sum(renderer.in_flight for renderer in renderers)
+        snapshots = [renderer.progress.snapshot() for renderer in renderers]
+        return {'sessions': len(renderers), 'workers': workers if started else 0,
+                'tasks_in_flight': in_flight, 'workers_busy': min(workers, in_flight),
+                'rays_per_second': sum(snapshot['rays_per_second'] for snapshot in snapshots
+                                       if snapshot['state'] == 'rendering'),
+                'worker_crashes': self.worker_crashes}
+
+    def new_id(self):
+        return uuid.uuid4().hex
+
+    # the session session_id, a new one if it is unknown or was dropped. Ids
+    # name files, so only those new_id makes are taken.
+    def get(self, session_id):
+        if session_id is not None and not re.match(r'^[0-9a-f]{32}$', session_id):
+            session_id = None
+        with self.lock:
+            user = self.sessions.pop(session_id, None)
+            if user is None:
+                user = user_session(session_id or self.new_id(), self.options, self.get_pool(), self.workers,
+                                    self.snapshot_dir, self.render_timeout, self.metrics)
+            self.sessions[user.id] = user
+            while len(self.sessions) > self.max_sessions:
+                session_id, dropped = self.sessions.popitem(last=False)
+                self.release_image(dropped.image_name)
+            return user
+
+    # free the buffers of the least recently used sessions not rendering now
+    # (user, rendering, holds its lock) until the renderers fit in max_memory
+    def trim_memory(self):
+        if self.max_memory is None:
+            return
+        with self.lock:
+            sessions = list(self.sessions.values())
+        memory = sum(user.renderer.memory() for user in sessions)
+        for user in sessions:
+            if memory <= self.max_memory:
+                return
+            if user.renderer.nodes is None or not user.lock.acquire(False):
+                continue
+            try:
+                before = user.renderer.memory()
+                user.renderer.drop_buffers()
+                memory -= before - user.renderer.memory()
+            finally:
+                user.lock.release()
+
+    def release_image(self, image_name):
+        if image_name is None:
+            return
+        self.images[image_name] -= 1
+        if self.images[image_name] == 0:
+            del self.images[image_name]
+            os.remove(os.path.join(self.image_dir, image_name))
+
+    # make img the image of user, stored as a png named by its hash. Returns
+    # the file name.
+    def set_image(self, user, img):
+        data = image_output.encode_image(img)
+        image_name = '%s.png' % hashlib.sha1(data).hexdigest()[:20]
+        path = os.path.join(self.image_dir, image_name)
+        with self.lock:
+            if image_name not in self.images:
+                # write aside and rename, so the URL never serves a partial file
+                temp_path = '%s.%s.tmp' % (path, user.id)
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.rename(temp_path, path)
+                self.images[image_name] = 0
+            self.images[image_name] += 1
+            self.release_image(user.image_name)
+            user.image_name = image_name
+        self.trim_memory()
+        return image_name
+
+    def close(self):
+        with self.lock:
+            self.sessions.clear()
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        self.preview.close()
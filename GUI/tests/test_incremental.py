@@ -0,0 +1,169 @@
+"""
+Incremental renders against full renders of the same scene, and sessions
+rendering at once in one process against each rendering alone.
+
+Run from GUI/ with
+
+    python -m unittest discover tests
+"""
+
+import copy
+import json
+import multiprocessing as mp
+import os
+import sys
+import threading
+import unittest
+
+import numpy as np
+
+gui = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, gui)
+
+import incremental
+import raytracing
+import render
+
+
+def load_scene():
+    with open(os.path.join(gui, 'data.json')) as f:
+        return json.load(f)
+
+
+class object_edits(unittest.TestCase):
+
+    def setUp(self):
+        self.options = render.make_options(width=48, height=48, tile=16)
+        self.renderer = incremental.incremental_renderer(self.options, workers=2)
+
+    def tearDown(self):
+        self.renderer.close()
+
+    def full_render(self, data):
+        renderer = incremental.incremental_renderer(self.options, workers=2)
+        try:
+            return renderer.render(data)[0]
+        finally:
+            renderer.close()
+
+    # renders data, then each edit of it in turn incrementally, each compared
+    # with a full render
+    def check_edits(self, data, edits):
+        self.renderer.render(data)
+        for edit in edits:
+            data = copy.deepcopy(data)
+            edit(data)
+            img, traced = self.renderer.render(data)
+            self.assertLess(traced, self.options['width'] * self.options['height'])
+            np.testing.assert_allclose(img, self.full_render(data), rtol=0, atol=1e-9)
+
+    def test_move(self):
+        def move_cube(data):
+            data['cube'][0]['position'] = [0.5, 0.2, -0.5]
+
+        def move_sphere(data):
+            data['sphere'][0]['position'][0] += 0.5
+        self.check_edits(load_scene(), [move_cube, move_sphere])
+
+    # the objects each pixel touched come from the new shadows after a relight
+    def test_edit_after_relight(self):
+        def move_light(data):
+            data['light'] = [2.0, 6.0, -6.0]
+
+        def recolor_cone(data):
+            data['cone'][0]['color'] = [0.1, 0.1, 0.9]
+        self.check_edits(load_scene(), [move_light, recolor_cone])
+
+    # without the buffers, every render is full and only the image is kept
+    def test_without_buffers(self):
+        renderer = incremental.incremental_renderer(self.options, workers=2, keep_gbuffer=False)
+        try:
+            data = load_scene()
+            img = renderer.render(data)[0]
+            np.testing.assert_array_equal(img, self.renderer.render(data)[0])
+            self.assertEqual(renderer.memory(), renderer.img.nbytes)
+            data['light'] = [2.0, 6.0, -6.0]
+            self.assertEqual(renderer.render(data)[1], self.options['width'] * self.options['height'])
+        finally:
+            renderer.close()
+
+    def test_move_with_light_list(self):
+        data = load_scene()
+        data['lights'] = [{'position': [3.0, 4.0, -4.0]},
+                          {'position': [-2.0, 2.0, -3.0], 'color': [1.0, 0.5, 0.5], 'range': 4.0}]
+
+        def move_cone(data):
+            data['cone'][0]['position'] = [0.0, 0.25, -1.0]
+        self.check_edits(data, [move_cone])
+
+
+# the scene with its light at x = 1 + n / 2 and the colour of its cube by n,
+# so one edit after another is a relight and the next an object edit
+def edit(data, n):
+    data = copy.deepcopy(data)
+    data['light'][0] = 1.0 + (n // 2) / 2.0
+    data['cube'][0]['color'] = [0.2 + 0.1 * ((n + 1) // 2 % 5), 0.1, 0.3]
+    return data
+
+
+class concurrent_sessions(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = mp.Pool(2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.pool.join()
+
+    # the images of edits 0 .. count - 1 of data by one renderer with options
+    def render_edits(self, options, data, count, images):
+        renderer = incremental.incremental_renderer(options, pool=self.pool)
+        for n in range(count):
+            if n % 6 == 0:
+                images.append(renderer.render(edit(data, n), full=True)[0])
+            else:
+                images.append(renderer.render(edit(data, n))[0])
+
+    # two sessions of different sizes and precisions rendering at once in
+    # the same process get the images each renders alone
+    def test_two_sessions(self):
+        data = load_scene()
+        sessions = [render.make_options(width=20, height=12, tile=8),
+                    render.make_options(width=14, height=22, tile=16, precision='float32')]
+        count = 40
+        alone = []
+        for options in sessions:
+            alone.append([])
+            self.render_edits(options, data, count, alone[-1])
+        together = [[] for options in sessions]
+        threads = [threading.Thread(target=self.render_edits, args=(options, data, count, images))
+                   for options, images in zip(sessions, together)]
+        # switch threads as often as possible, so they interleave anywhere
+        if hasattr(sys, 'setswitchinterval'):
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+        else:
+            interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if hasattr(sys, 'setswitchinterval'):
+                sys.setswitchinterval(interval)
+            else:
+                sys.setcheckinterval(interval)
+        for options, images, expected in zip(sessions, together, alone):
+            self.assertEqual(len(images), count)
+            for img, expected_img in zip(images, expected):
+                self.assertEqual(img.shape, (options['height'], options['width'], 3))
+                # rendered and relit in the session's own precision
+                self.assertEqual(img.dtype, raytracing.precisions[options['precision']]['dtype'])
+                self.assertEqual(img.dtype, expected_img.dtype)
+                np.testing.assert_allclose(img, expected_img, rtol=0, atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+"""
+float32 renders against float64 renders of the same scene.
+
+Run from GUI/ with
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+gui = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, gui)
+
+import render
+
+# largest difference of a pixel channel (about 2.5 levels of 255), and mean
+# difference over the image, a float32 render may have from a float64 one
+max_tolerance = 0.01
+mean_tolerance = 1e-4
+
+
+class precisions(unittest.TestCase):
+
+    def test_float32_close_to_float64(self):
+        with open(os.path.join(gui, 'data.json')) as f:
+            scene_input = f.read()
+        options = render.make_options(width=32, height=32, tile=16)
+        img64, img32, max_difference, mean_difference = render.compare_precisions(scene_input, options, workers=2)
+        self.assertEqual(img64.dtype, np.float64)
+        self.assertEqual(img32.dtype, np.float32)
+        self.assertEqual(img32.shape, (32, 32, 3))
+        self.assertLessEqual(max_difference, max_tolerance)
+        self.assertLessEqual(mean_difference, mean_tolerance)
+
+
+if __name__ == '__main__':
+    unittest.main()
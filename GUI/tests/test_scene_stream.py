@@ -0,0 +1,51 @@
+"""
+Scene json read as it streams in, whatever the chunk size.
+
+Run from GUI/ with
+
+    python -m unittest discover tests
+"""
+
+import io
+import os
+import sys
+import unittest
+
+gui = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, gui)
+
+import scene_schema
+import scene_stream
+
+chunk_sizes = (1, 2, 3, 7, 1 << 20)
+
+
+# the problems load_arrays finds in text read chunk_size characters at a time
+def problems(text, chunk_size):
+    try:
+        scene_stream.load_arrays(io.StringIO(text), chunk_size=chunk_size)
+    except scene_schema.SceneError as e:
+        return e.problems
+    return []
+
+
+class malformed_json(unittest.TestCase):
+
+    # a mistake is reported at its character in the file
+    def test_position_from_start_of_file(self):
+        text = u'{"camera_position": [0, 1, -4], "sphere": [{"position": [1, 2, 3] "radius": 1}]}'
+        for chunk_size in chunk_sizes:
+            self.assertEqual(problems(text, chunk_size), ["not valid json: Expecting ',' delimiter at character 66"])
+
+    def test_same_problems_for_every_chunk_size(self):
+        for text in (u'{"camera_position": [0, 1, -4], "light": "abc',
+                     u'{"camera_position": [0, 1, -4]} x',
+                     u'{"camera_position": [0, 1, -4], "sphere": [{"position": [1,, 2]}]}'):
+            found = [problems(text, chunk_size) for chunk_size in chunk_sizes]
+            self.assertTrue(found[0])
+            for chunk_problems in found[1:]:
+                self.assertEqual(chunk_problems, found[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
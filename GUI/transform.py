@@ -0,0 +1,99 @@
+"""
+Object transforms.
+
+A solid is placed by one 4x4 affine matrix: rotation by its rotation_angle
+(degrees, about x, then y, then z) followed by the move to its position. The
+matrix is kept with its inverse, so points and directions go between object
+space and world space in bulk, and the matrices of all the objects of a scene
+are built in one vectorized pass (affine_matrices).
+"""
+
+import numpy as np
+
+
+# rotation matrices (n, 3, 3) of n (x, y, z) angles in degrees, z . y . x
+def rotation_matrices(angles):
+    angles = np.radians(np.asarray(angles, dtype=float).reshape(-1, 3))
+    c, s = np.cos(angles), np.sin(angles)
+    one, zero = np.ones(len(angles)), np.zeros(len(angles))
+    r_x = np.stack([one, zero, zero,
+                    zero, c[:, 0], -s[:, 0],
+                    zero, s[:, 0], c[:, 0]], axis=-1).reshape(-1, 3, 3)
+    r_y = np.stack([c[:, 1], zero, s[:, 1],
+                    zero, one, zero,
+                    -s[:, 1], zero, c[:, 1]], axis=-1).reshape(-1, 3, 3)
+    r_z = np.stack([c[:, 2], -s[:, 2], zero,
+                    s[:, 2], c[:, 2], zero,
+                    zero, zero, one], axis=-1).reshape(-1, 3, 3)
+    return np.matmul(r_z, np.matmul(r_y, r_x))
+
+
+def rotation_matrix(angles):
+    return rotation_matrices(angles)[0]
+
+
+# affine matrices (n, 4, 4) rotating by angles then moving to positions
+def affine_matrices(positions, angles):
+    rotations = rotation_matrices(angles)
+    matrices = np.zeros((len(rotations), 4, 4))
+    matrices[:, :3, :3] = rotations
+    matrices[:, :3, 3] = np.asarray(positions, dtype=float).reshape(-1, 3)
+    matrices[:, 3, 3] = 1.0
+    return matrices
+
+
+# inverses of rigid affine matrices (rotation and move only)
+def rigid_inverses(matrices):
+    inverses = np.zeros_like(matrices)
+    rotations_t = np.swapaxes(matrices[:, :3, :3], 1, 2)
+    inverses[:, :3, :3] = rotations_t
+    inverses[:, :3, 3] = -np.matmul(rotations_t, matrices[:, :3, 3, np.newaxis])[:, :, 0]
+    inverses[:, 3, 3] = 1.0
+    return inverses
+
+
+# points (n, k, 3) of n objects from their object space to world space, by
+# their matrices (n, 4, 4)
+def transform_points(matrices, points):
+    return np.einsum('nij,nkj->nki', matrices[:, :3, :3], points) + matrices[:, np.newaxis, :3, 3]
+
+
+class transform():
+
+    def __init__(self, matrix, inverse=None):
+        self.matrix = matrix
+        self.inverse = inverse if inverse is not None else np.linalg.inv(matrix)
+        # the blocks used per ray, sliced once
+        self.linear_t = np.ascontiguousarray(matrix[:3, :3].T)
+        self.translation = matrix[:3, 3].copy()
+        self.inverse_linear_t = np.ascontiguousarray(self.inverse[:3, :3].T)
+        self.inverse_translation = self.inverse[:3, 3].copy()
+
+    # points (..., 3) from object to world space
+    def apply_points(self, points):
+        return np.dot(points, self.linear_t) + self.translation
+
+    # directions (..., 3) from object to world space
+    def apply_vectors(self, vectors):
+        return np.dot(vectors, self.linear_t)
+
+    # points (..., 3) from world to object space
+    def to_object_points(self, points):
+        return np.dot(points, self.inverse_linear_t) + self.inverse_translation
+
+    def to_object_vectors(self, vectors):
+        return np.dot(vectors, self.inverse_linear_t)
+
+
+def placement(position, angles):
+    matrix = affine_matrices([position], [angles])
+    return transform(matrix[0], rigid_inverses(matrix)[0])
+
+
+# one transform per (position, angles) pair, built together
+def placements(positions, angles):
+    if len(positions) == 0:
+        return []
+    matrices = affine_matrices(positions, angles)
+    inverses = rigid_inverses(matrices)
+    return [transform(matrices[i], inverses[i]) for i in range(len(matrices))]
@@ -1,9 +1,8 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import multiprocessing as mp
 import json
 import math
 import os
+import sys
 
 class PositionType:
 	IN, OUT = 1, -1
@@ -584,24 +583,6 @@ def rotation(node, r_centre, r_angle):
 def rotation_vector(vector, r_angle):
     return rotation(vector, np.array([0, 0, 0]), r_angle)
 
-#trace ray of pixel in given area
-def trace_ray_main(result_queue, project_block_index, scene_input):
-    img = np.zeros((h, w, 3))
-    camera_seeting, scene = analyse_input(scene_input)
-    current_project_block = camera_seeting.project_blocks[project_block_index]
-
-    for i in range(camera_seeting.x_pixel_pre_block):
-        for j in range(camera_seeting.y_pixel_pre_block):
-            col = np.zeros(3)
-            col[:] = 0
-            Q = current_project_block.start + i * camera_seeting.x_project_size_pre_pixel * camera_seeting.x_coordinate_vector + j * camera_seeting.y_project_size_pre_pixel * camera_seeting.y_coordinate_vector
-            D = normalize(Q - camera_seeting.position)
-            depth = 0
-            primaryRay = ray(camera_seeting.position, D)
-            col = reflect_and_refract(primaryRay, scene, PositionType.OUT, depth, 1,i,j)
-            img[h - (current_project_block.y_pixel_start_index + j) - 1, current_project_block.x_pixel_start_index + i, :] = np.clip(col, 0, 1)
-    result_queue.put(img) 
-
 def reflect_and_refract(primaryRay, scene, positionType, depth, pathLoss, i,j):
 
     traced = primaryRay.trace_ray(scene)
@@ -780,30 +761,9 @@ depth_max = 4  # Maximum number of light reflections.
 processes_divided = 8
 
 if __name__ == '__main__':
-    path = os.path.abspath('..')
-    with open(os.path.abspath(path + '\GUI\data.json'), 'r') as inputFile:
-        scene_input = inputFile.read()  
-
-    result_queue = mp.Queue()
-    ps = []
-
-    for i in range(processes_divided**2):
-        ps.append(mp.Process(target=trace_ray_main, args=(result_queue, i,
-        scene_input, )))
-
-    img = np.zeros((h, w, 3))
-
-    # start processes
-    for p in ps:
-        p.start()
-
-    for i in range(len(ps)):
-        img = img + result_queue.get()
-        print(i + 1) *  1.0  / len(ps) * 100, '%'
-
-    # for debug
-    #processes_divided = 1
-    #trace_ray_main(result_queue, 0, scene_input)
-    #img = img + result_queue.get()
-
-    plt.imsave('fig.png', img)
+    # the command line renderer lives next to the GUI copy of the ray tracer,
+    # see GUI/render.py for the options
+    gui_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'GUI')
+    sys.path.insert(0, gui_path)
+    import render
+    render.main(default_scene=os.path.join(gui_path, 'data.json'))